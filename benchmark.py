@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = "duc_tin"
+__copyright__ = "Copyright 2015+, duc_tin"
+__license__ = "GPLv2"
+__version__ = "1.0"
+__maintainer__ = "duc_tin"
+__email__ = "nguyenbaduc.tin@gmail.com"
+
+# Time the hot paths of vpn_core against local stand-ins, no network needed.
+# A fake mirror serves a synthetic /api/iphone/ csv and a farm of loopback
+# listeners plays the vpn servers. Results are written as JSON so two runs
+# can be compared: ./run bench --rows 5000 -o new.json --compare old.json
+
+import os
+import sys
+import json
+import time
+import random
+import select
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+from Queue import Queue
+from threading import Thread
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+REPO_DIR = os.path.dirname(os.path.realpath(__file__))
+
+CSV_HEADER = ('*vpn_servers\n#HostName,IP,Score,Ping,Speed,CountryLong,CountryShort,NumVpnSessions,Uptime,'
+              'TotalUsers,TotalTraffic,LogType,Operator,Message,OpenVPN_ConfigData_Base64\n')
+COUNTRIES = [('Japan', 'JP'), ('Korea Republic of', 'KR'), ('United States', 'US'), ('Viet Nam', 'VN'),
+             ('Thailand', 'TH'), ('Russian Federation', 'RU'), ('Canada', 'CA')]
+
+
+def make_csv(rows, endpoints, seed=0):
+    """ A vpngate.net like csv of rows servers, each pointing to one of endpoints [(ip, port, proto)] """
+    rnd = random.Random(seed)
+    cert = ''.join(rnd.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/') for i in range(1200))
+    lines = [CSV_HEADER]
+    for i in range(rows):
+        ip, port, proto = endpoints[i % len(endpoints)]
+        config = ('client\r\ndev tun\r\nproto %s\r\nremote %s %d\r\ncipher AES-128-CBC\r\nauth SHA1\r\n'
+                  'resolv-retry infinite\r\nnobind\r\nverb 3\r\n<ca>\r\n%s\r\n</ca>\r\n' % (proto, ip, port, cert))
+        country_long, country_short = rnd.choice(COUNTRIES)
+        lines.append(','.join(['vpn%06d' % i, ip, str(rnd.randint(1000, 3000000)), str(rnd.randint(1, 300)),
+                               str(rnd.randint(10 ** 6, 10 ** 9)), country_long, country_short,
+                               str(rnd.randint(1, 200)), str(rnd.randint(10 ** 6, 10 ** 10)), '1000', '100000',
+                               '2weeks', 'bench', '', config.encode('base64').replace('\n', '')]) + '\n')
+    lines.append('*\n')
+    return ''.join(lines)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeMirror:
+    """ Serve payload at /api/iphone/ on loopback, answering after latency seconds """
+
+    def __init__(self, payload, latency=0.0):
+        mirror = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                time.sleep(mirror.latency)
+                if self.path.rstrip('/').endswith('/api/iphone'):
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain')
+                    self.send_header('Content-Length', str(len(mirror.payload)))
+                    self.end_headers()
+                    self.wfile.write(mirror.payload)
+                else:
+                    self.send_error(404)
+
+            def log_message(self, *args):
+                pass
+
+        self.payload = payload
+        self.latency = latency
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def start(self):
+        t = Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ListenerFarm:
+    """ count loopback listeners that stand in for vpn servers
+
+        tcp: live listeners accept, answer one line after latency seconds and close.
+             A dropped one never accepts and has its backlog filled, so new SYNs
+             are ignored and clients time out like with a dead server.
+        udp: echo every datagram after latency seconds, a dropped one never answers.
+        drop: fraction of dead listeners
+    """
+
+    def __init__(self, count, proto='tcp', latency=0.0, drop=0.0, seed=0):
+        self.proto = proto
+        self.latency = latency
+        self.endpoints = []
+        self.live = []
+        self.fillers = []  # client sockets that keep the backlog of dead tcp listeners full
+        self.pending = []  # (due time, socket, data, address)
+        self.running = False
+
+        rnd = random.Random(seed)
+        dead = set(rnd.sample(range(count), int(round(count * drop))))
+        for i in range(count):
+            if proto == 'tcp':
+                sock = socket.socket()
+                sock.bind(('127.0.0.1', 0))
+                if i in dead:
+                    sock.listen(0)
+                    self.fill_backlog(sock.getsockname())
+                else:
+                    sock.listen(128)
+            else:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.bind(('127.0.0.1', 0))
+
+            ip, port = sock.getsockname()
+            self.endpoints.append((ip, port, proto))
+            if i in dead:
+                self.fillers.append(sock)
+            else:
+                self.live.append(sock)
+
+    def fill_backlog(self, address):
+        for i in range(2):
+            client = socket.socket()
+            client.setblocking(0)
+            client.connect_ex(address)
+            self.fillers.append(client)
+
+    def start(self):
+        self.running = True
+        t = Thread(target=self.serve)
+        t.daemon = True
+        t.start()
+        return self
+
+    def serve(self):
+        while self.running:
+            now = time.time()
+            while self.pending and self.pending[0][0] <= now:
+                _, sock, data, address = self.pending.pop(0)
+                try:
+                    if address:
+                        sock.sendto(data, address)
+                    else:
+                        sock.sendall(data)
+                        sock.close()
+                except socket.error:
+                    pass
+
+            timeout = max(self.pending[0][0] - now, 0) if self.pending else 0.2
+            try:
+                readable, _, _ = select.select(self.live, [], [], timeout)
+            except (select.error, socket.error):
+                return  # sockets closed by stop()
+            for sock in readable:
+                if self.proto == 'tcp':
+                    try:
+                        client, _ = sock.accept()
+                    except socket.error:
+                        continue
+                    self.pending.append((time.time() + self.latency, client, 'hello\n', None))
+                else:
+                    data, address = sock.recvfrom(2048)
+                    self.pending.append((time.time() + self.latency, sock, data, address))
+            self.pending.sort(key=lambda job: job[0])
+
+    def stop(self):
+        self.running = False
+        for sock in self.live + self.fillers:
+            sock.close()
+
+
+def stats(samples):
+    samples = sorted(samples)
+    return {'runs': len(samples), 'min': round(samples[0], 6), 'max': round(samples[-1], 6),
+            'median': round(samples[len(samples) // 2], 6), 'mean': round(sum(samples) / len(samples), 6)}
+
+
+def timeit(func, runs, setup=None):
+    samples = []
+    for i in range(runs):
+        if setup:
+            setup()
+        start = time.time()
+        func()
+        samples.append(time.time() - start)
+    return stats(samples)
+
+
+def make_connection(mirror_url, workdir):
+    """ A vpn_core.Connection with a throwaway home, config and mirror list """
+    from config import Setting
+
+    home = os.path.join(workdir, 'home')
+    config_dir = home + '/.config/vpngate-with-proxy'
+    os.makedirs(config_dir)
+    cfg = Setting(config_dir + '/config.ini')
+    cfg.mirror['url'] = mirror_url
+    cfg.write()
+
+    # Connection keeps symlinks to its config in the working directory
+    shutil.copy(os.path.join(REPO_DIR, 'user_script.sh.tmp'), workdir)
+    os.chdir(workdir)
+    sys.argv = [os.path.join(REPO_DIR, 'vpnproxy_tui.py'), home]
+
+    import vpn_core
+    ovpn = vpn_core.Connection()
+    vpn_core.mirrors[:] = [mirror_url]
+    return ovpn
+
+
+def run(options):
+    sys.path.insert(0, REPO_DIR)
+    from vpn_core import Server
+    import vpn_core
+
+    from mock_proxy import MockProxy
+
+    farm = ListenerFarm(options.listeners, options.proto, options.latency, options.drop).start()
+    payload = make_csv(options.rows, farm.endpoints)
+    mirror = FakeMirror(payload, options.mirror_latency).start()
+    proxy = None
+    if options.proxy:
+        proxy = MockProxy(latency=options.proxy_latency, max_conns=options.proxy_conns,
+                          rate=options.proxy_rate).start()
+    workdir = tempfile.mkdtemp(prefix='vpngate_bench_')
+    cwd = os.getcwd()
+
+    results = {}
+    try:
+        ovpn = make_connection(mirror.url, workdir)
+        ovpn.test_timeout = options.timeout
+        proxies = {}
+        if proxy:
+            # the proxied paths: CONNECT in probe, proxies= in get_csv
+            ovpn.use_proxy, ovpn.proxy, ovpn.ip, ovpn.port = 'yes', '127.0.0.1', '127.0.0.1', str(proxy.address[1])
+            ovpn.test_interval = options.interval
+            proxies = {'http': 'http://127.0.0.1:%d' % proxy.address[1]}
+
+        def parse():
+            servers = [line.split(',') for line in payload.replace('\r', '').split('\n')]
+            return dict((s[0], Server(s)) for s in servers[2:] if len(s) > 1)
+
+        results['parse'] = timeit(parse, options.runs)
+
+        def get_data():
+            vpn_core.mirrors[:] = [mirror.url]
+            ovpn.get_data()
+
+        results['fetch'] = timeit(lambda: ovpn.get_csv(mirror.url, Queue(), proxies), options.runs)
+        if not proxy:
+            # get_data pings the proxy first, which would time ping rather than us
+            results['get_data'] = timeit(get_data, options.runs)
+        else:
+            queue = Queue()
+            ovpn.get_csv(mirror.url, queue, proxies)
+            ovpn.vpndict = queue.get()[1]
+        fetched = dict(ovpn.vpndict)
+
+        def reset():
+            ovpn.vpndict = dict(fetched)
+
+        ovpn.filters = {'country': 'all', 'port': 'all', 'score': 'all'}
+        results['sort'] = timeit(lambda: ovpn.refresh_data(resort_only=True), options.runs, reset)
+        ovpn.filters = {'country': 'japan', 'port': '>1000', 'score': '100000'}
+        results['filter_sort'] = timeit(lambda: ovpn.refresh_data(resort_only=True), options.runs, reset)
+
+        to_probe = dict(fetched.items()[:options.probe_rows])
+        results['probe'] = timeit(ovpn.probe, options.probe_runs, lambda: setattr(ovpn, 'vpndict', dict(to_probe)))
+        results['probe']['servers'] = len(to_probe)
+        results['probe']['alive'] = len(ovpn.vpndict)
+        if proxy:
+            results['proxy'] = dict(proxy.stats)
+    finally:
+        os.chdir(cwd)
+        if proxy:
+            proxy.stop()
+        mirror.stop()
+        farm.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'host': platform.node(), 'options': vars(options), 'results': results}
+
+
+def compare(new, old):
+    print '%-12s %12s %12s %8s' % ('case', 'old median', 'new median', 'ratio')
+    for case in sorted(new['results']):
+        if case in old['results']:
+            a, b = old['results'][case]['median'], new['results'][case]['median']
+            print '%-12s %12.6f %12.6f %8.2f' % (case, a, b, b / a if a else float('inf'))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark fetch/parse/filter/probe against local stand-ins')
+    parser.add_argument('--rows', type=int, default=1000, help='servers in the fake csv (100 to 50000)')
+    parser.add_argument('--runs', type=int, default=5, help='runs of each fast case')
+    parser.add_argument('--listeners', type=int, default=100, help='loopback listeners playing vpn servers')
+    parser.add_argument('--proto', choices=['tcp', 'udp'], default='tcp',
+                        help='listener protocol, probe only speaks tcp so udp servers all look dead to it')
+    parser.add_argument('--latency', type=float, default=0.0, help='listener answer delay, seconds')
+    parser.add_argument('--drop', type=float, default=0.0, help='fraction of dead listeners')
+    parser.add_argument('--mirror-latency', type=float, default=0.0, help='fake mirror answer delay, seconds')
+    parser.add_argument('--probe-rows', type=int, default=200, help='servers given to probe')
+    parser.add_argument('--probe-runs', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=2, help='probe connect timeout, seconds')
+    parser.add_argument('--proxy', action='store_true', help='fetch and probe through a local mock CONNECT proxy')
+    parser.add_argument('--proxy-latency', type=float, default=0.0, help='proxy answer delay, seconds')
+    parser.add_argument('--proxy-conns', type=int, default=0, help='connections the proxy serves at once, 0: any')
+    parser.add_argument('--proxy-rate', type=float, default=0, help='connections per second, 0: unlimited')
+    parser.add_argument('--interval', type=float, default=0.25, help='pause between proxied probes, seconds')
+    parser.add_argument('-o', '--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+    options = parser.parse_args(argv)
+
+    report = run(options)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print text
+
+    if options.compare:
+        with open(options.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
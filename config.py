@@ -46,8 +46,12 @@ def get_input(s, option):
         sys.exit()
 
     while 1:
-        use_proxy, proxy, port, ip, sort_by, s_country, s_port, s_score, fix_dns, dns, verbose, mirrors = s[:]
-        mirrors = mirrors.split(', ')
+        use_proxy, proxy, port, ip = s.proxy.values()[:4]
+        sort_by = s.sort['key']
+        s_country, s_port, s_score = s.filter.values()[:3]
+        fix_dns, dns = s.dns['fix_dns'], s.dns['dns']
+        verbose = s.openvpn['verbose']
+        mirrors = s.mirror['url'].split(', ')
 
         print ctext('\n Current settings:', 'B')
         print ctext('    1. Proxy address:', 'yB'), proxy, ctext('\t2. port: ', 'yB'), port
@@ -181,10 +185,42 @@ class Setting:
         self.filter = OrderedDict([('country', 'all'), ('port', 'all'), ('score', 'all')])
 
         self.dns = OrderedDict([('fix_dns', 'yes'),
-                                ('dns', '8.8.8.8, 84.200.69.80, 208.67.222.222')])
+                                ('dns', '8.8.8.8, 84.200.69.80, 208.67.222.222'),
+                                ('backend', 'file')])  # file | resolvconf | systemd-resolved
 
         self.openvpn = {'verbose': 'yes'}
 
+        # hooks_dir: leave blank to use hooks.d in the config folder
+        self.hooks = OrderedDict([('timeout', '30'), ('hooks_dir', '')])
+
+        # event_log: file to append tunnel/refresh events as JSON lines, blank for none
+        # profile: record timing spans of the hot paths (also VPNGATE_PROFILE=1)
+        self.monitor = OrderedDict([('event_log', ''), ('profile', 'no')])
+
+        # vpn.log rotation, max_size in KB, rotated files are gzipped if compress is yes
+        self.log = OrderedDict([('max_size', '1024'), ('backups', '3'), ('compress', 'no')])
+
+        # tunnels: number of tunnels the daemon keeps and spreads flows across, 1 for a single tunnel
+        # table: routing table of the multipath route, tunnels use the next ones
+        # namespaces: yes to put each tunnel in its own network namespace (vpngate0...) instead
+        self.balance = OrderedDict([('tunnels', '1'), ('table', '200'), ('namespaces', 'no')])
+
+        # listen: ip:port of a SOCKS5/HTTP CONNECT proxy into the tunnel, blank for none (eg: 127.0.0.1:1080)
+        # hold: seconds a new connection waits for a tunnel while none is up
+        self.local_proxy = OrderedDict([('listen', ''), ('hold', '15')])
+
+        # split tunnel: only these go through the vpn, the routes pushed by the server are ignored
+        # networks, domains, countries: comma separated, eg: 10.8.0.0/16, example.com, jp
+        # zone_dir: folder of <country>.zone files (one CIDR per line), blank for zones in the config folder
+        # rules_file: more rules, one per line: a CIDR, a domain or country:<code>
+        self.split = OrderedDict([('enabled', 'no'), ('networks', ''), ('domains', ''), ('countries', ''),
+                                  ('zone_dir', ''), ('rules_file', '')])
+
+        # database: file built by 'python geoip.py build' from ip2asn-v4.tsv of iptoasn.com, blank for none
+        # exclude_asn: AS numbers to drop, avoid: network types to drop, prefer: network type listed first
+        # network types are residential, mobile, business and datacenter
+        self.geoip = OrderedDict([('database', ''), ('exclude_asn', ''), ('avoid', ''), ('prefer', '')])
+
         self.mirror = {'url': "http://p76ed4cd5.tokynt01.ap.so-net.ne.jp:16169, "
                               "http://103.1.249.67:29858, "
                               "http://211.217.242.42:3230, "
@@ -195,6 +231,13 @@ class Setting:
                                      ('country_filter', self.filter),
                                      ('DNS_leak', self.dns),
                                      ('openvpn', self.openvpn),
+                                     ('hooks', self.hooks),
+                                     ('monitor', self.monitor),
+                                     ('log', self.log),
+                                     ('balance', self.balance),
+                                     ('local_proxy', self.local_proxy),
+                                     ('split_tunnel', self.split),
+                                     ('geoip', self.geoip),
                                      ('mirror', self.mirror)])
 
     def __getitem__(self, index):
@@ -224,3 +267,6 @@ class Setting:
                 except ConfigParser.NoSectionError:
                     self.parser.add_section(sect)
                     self.parser.set(sect, content, self.sections[sect][content])
+                except ConfigParser.NoOptionError:
+                    # option added by a newer version, keep its default
+                    self.parser.set(sect, content, self.sections[sect][content])
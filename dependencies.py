@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = "duc_tin"
+__copyright__ = "Copyright 2015+, duc_tin"
+__license__ = "GPLv2"
+__version__ = "1.0"
+__maintainer__ = "duc_tin"
+__email__ = "nguyenbaduc.tin@gmail.com"
+
+import os
+
+PKG_MANAGERS = ['apt-get', 'yum', 'dnf']  # the last one found wins
+SBIN_DIRS = ['/usr/local/sbin', '/usr/sbin', '/sbin']
+
+
+def find_program(name):
+    """ Full path of an executable, looked up in PATH and the sbin folders without forking """
+    for folder in os.environ.get('PATH', '').split(os.pathsep) + SBIN_DIRS:
+        path = os.path.join(folder, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def missing_modules(modules):
+    need = []
+    for module in modules:
+        try:
+            __import__(module)
+        except ImportError:
+            need.append(module)
+    return need
+
+
+def missing_programs(programs):
+    return [prog for prog in programs if not find_program(prog)]
+
+
+def package_manager(cache_dir):
+    """ Name of the system package manager, remembered in cache_dir/pkg_mgr.
+        Only needed when something has to be installed.
+    """
+    cache = os.path.join(cache_dir, 'pkg_mgr')
+    try:
+        with open(cache) as f:
+            name = f.read().strip()
+        if name and find_program(name):
+            return name
+    except IOError:
+        pass
+
+    name = None
+    for pkg in PKG_MANAGERS:
+        if find_program(pkg):
+            name = pkg
+
+    if name:
+        try:
+            with open(cache, 'w') as f:
+                f.write(name + '\n')
+        except IOError:
+            pass
+    return name
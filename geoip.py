@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = "duc_tin"
+__copyright__ = "Copyright 2015+, duc_tin"
+__license__ = "GPLv2"
+__version__ = "1.0"
+__maintainer__ = "duc_tin"
+__email__ = "nguyenbaduc.tin@gmail.com"
+
+import os
+import sys
+import mmap
+import socket
+import struct
+
+MAGIC = 'VGGEO1\0\0'
+HEADER = '!8sII'  # magic, number of ranges, offset of the text area
+RANGE = '!IIII'  # first ip, last ip, asn, offset of 'country\tas name\ttype\tcity' in the text area
+HEADER_SIZE = struct.calcsize(HEADER)
+RANGE_SIZE = struct.calcsize(RANGE)
+
+NET_TYPES = ('residential', 'mobile', 'business', 'datacenter')
+# rough guess used when the source has no type column, first match in the AS name wins
+TYPE_WORDS = [('datacenter', ['hosting', 'cloud', 'data center', 'datacenter', 'server', 'vps', 'colo',
+                              'amazon', 'google', 'microsoft', 'digitalocean', 'ovh', 'hetzner', 'linode', 'vultr',
+                              'alibaba', 'tencent', 'oracle', 'leaseweb', 'contabo', 'choopa', 'm247']),
+              ('mobile', ['mobile', 'wireless', 'cellular', 'lte', '4g', '5g']),
+              ('residential', ['broadband', 'cable', 'dsl', 'fiber', 'fibre', 'home', 'telecom', 'telekom',
+                               'communications', 'internet', ' isp ', ' net ', 'ocn', 'so-net', 'kddi', 'kt corp',
+                               'chinanet', 'viettel', 'vnpt'])]
+
+
+def ip2int(ip):
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+def classify(as_name):
+    name = ' %s ' % as_name.lower()
+    for net_type, words in TYPE_WORDS:
+        if [word for word in words if word in name]:
+            return net_type
+    return 'business'
+
+
+def build(source, path):
+    """ Compile a tab separated source into the database file at path
+
+        Each line: first_ip, last_ip, asn, country, as_name[, type[, city]]
+        which is the format of iptoasn.com's ip2asn-v4.tsv plus two optional
+        columns. Without a type, it is guessed from the AS name.
+        :return: number of ranges
+    """
+    ranges, texts, text_area = [], {}, []
+    size = 0
+    with open(source) as f:
+        for line in f:
+            cols = line.rstrip('\r\n').split('\t')
+            if len(cols) < 5 or cols[0].startswith('#'):
+                continue
+            try:
+                first, last, asn = ip2int(cols[0]), ip2int(cols[1]), int(cols[2])
+            except (socket.error, ValueError):
+                continue
+            if not asn:
+                continue  # 'Not routed'
+            net_type = cols[5] if len(cols) > 5 and cols[5] in NET_TYPES else classify(cols[4])
+            text = '\t'.join([cols[3], cols[4], net_type, cols[6] if len(cols) > 6 else '']) + '\n'
+            if text not in texts:
+                texts[text] = size
+                text_area.append(text)
+                size += len(text)
+            ranges.append((first, last, asn, texts[text]))
+
+    ranges.sort()
+    with open(path + '.tmp', 'wb') as f:
+        f.write(struct.pack(HEADER, MAGIC, len(ranges), HEADER_SIZE + RANGE_SIZE * len(ranges)))
+        for r in ranges:
+            f.write(struct.pack(RANGE, *r))
+        f.write(''.join(text_area))
+    os.rename(path + '.tmp', path)
+    return len(ranges)
+
+
+class GeoDB:
+    """ Offline ASN, network type and city of ipv4 addresses
+
+        The file (see build()) is memory-mapped, never read as a whole.
+        A lookup is a binary search over its sorted, fixed size ranges:
+        O(log n) page touches and no network request.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)  # ValueError when empty
+        if len(self.map) < HEADER_SIZE or self.map[:len(MAGIC)] != MAGIC:
+            self.map.close()
+            raise ValueError('%s is not a geoip database, build it with "python geoip.py build"' % path)
+
+        _, self.count, self.texts = struct.unpack_from(HEADER, self.map, 0)
+        # every text ends with a newline, a cut anywhere is seen without reading the whole file
+        if len(self.map) < self.texts or self.count and self.map[-1] != '\n':
+            self.map.close()
+            raise ValueError('%s is truncated, build it again' % path)
+
+    def find(self, ip):
+        """ :return: (asn, country, as_name, type, city) or None """
+        try:
+            value = ip2int(ip)
+        except socket.error:
+            return None
+
+        low, high = 0, self.count  # first range that starts after value
+        while low < high:
+            mid = (low + high) // 2
+            if struct.unpack_from('!I', self.map, HEADER_SIZE + mid * RANGE_SIZE)[0] <= value:
+                low = mid + 1
+            else:
+                high = mid
+        if not low:
+            return None
+
+        first, last, asn, offset = struct.unpack_from(RANGE, self.map, HEADER_SIZE + (low - 1) * RANGE_SIZE)
+        if value > last:
+            return None
+        start = self.texts + offset
+        country, as_name, net_type, city = self.map[start:self.map.find('\n', start)].split('\t')
+        return asn, country, as_name, net_type, city
+
+    def enrich(self, servers):
+        """ Set asn, as_name, net_type and city of each vpn_core.Server, :return: how many were found """
+        found = 0
+        for server in servers:
+            info = self.find(server.ip)
+            if info:
+                server.asn, _, server.as_name, server.net_type, server.city = info
+                found += 1
+        return found
+
+    def close(self):
+        self.map.close()
+
+
+if __name__ == '__main__':
+    # python geoip.py build <ip2asn-v4.tsv> <geoip.bin> | python geoip.py <geoip.bin> <ip>...
+    if len(sys.argv) == 4 and sys.argv[1] == 'build':
+        print 'Wrote %d ranges to %s' % (build(sys.argv[2], sys.argv[3]), sys.argv[3])
+    elif len(sys.argv) > 2:
+        db = GeoDB(sys.argv[1])
+        for address in sys.argv[2:]:
+            print address, db.find(address)
+    else:
+        print 'Usage: python geoip.py build <source.tsv> <database>\n       python geoip.py <database> <ip> ...'
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = "duc_tin"
+__copyright__ = "Copyright 2015+, duc_tin"
+__license__ = "GPLv2"
+__version__ = "1.0"
+__maintainer__ = "duc_tin"
+__email__ = "nguyenbaduc.tin@gmail.com"
+
+import os
+import signal
+import time
+from Queue import Queue
+from threading import Thread, Timer
+from subprocess import Popen, PIPE, STDOUT
+from profiler import profiler
+
+
+TIMEOUT = 30
+
+
+class HookRunner:
+    """ Run user_script.sh and every executable in hooks dir with 'up' or 'down'
+
+        Events are handled one after another by a worker thread, so 'down' never
+        overtakes 'up', but scripts of the same event run in parallel. A script
+        that runs longer than timeout seconds is killed with its whole process group.
+    """
+
+    def __init__(self, user_script='user_script.sh', hooks_dir='', timeout=TIMEOUT, logger=None):
+        self.user_script = user_script
+        self.hooks_dir = hooks_dir
+        self.timeout = timeout
+        self.log = logger or (lambda msg: None)
+
+        self.events = Queue()
+        self.worker = None
+
+    def set_timeout(self, value):
+        """ Take timeout from the config text, a bad value falls back to the default """
+        try:
+            self.timeout = int(value)
+            if self.timeout <= 0:
+                raise ValueError
+        except ValueError:
+            self.timeout = TIMEOUT
+            self.log(' hooks timeout %r is not a positive integer, use %ds' % (value, TIMEOUT))
+
+    def scripts(self):
+        found = []
+        if os.path.exists(self.user_script):
+            found.append(['bash', self.user_script])
+
+        if self.hooks_dir and os.path.isdir(self.hooks_dir):
+            for name in sorted(os.listdir(self.hooks_dir)):
+                path = os.path.join(self.hooks_dir, name)
+                if os.path.isfile(path) and os.access(path, os.X_OK) and not name.startswith('.'):
+                    found.append([path])
+        return found
+
+    def run(self, when, done=None):
+        """ Queue event 'up' or 'down' and return immediately,
+            done is called once every script of the event has finished
+        """
+        if not self.worker or not self.worker.isAlive():
+            self.worker = Thread(target=self._work)
+            self.worker.daemon = True
+            self.worker.start()
+        self.events.put((when, done))
+
+    def wait(self):
+        """ Block until all queued events are done """
+        self.events.join()
+
+    def _work(self):
+        while True:
+            when, done = self.events.get()
+            threads = []
+            for cmd in self.scripts():
+                t = Thread(target=self._call, args=(cmd, when))
+                t.daemon = True
+                t.start()
+                threads.append(t)
+
+            for t in threads: t.join()
+            if done:
+                done()
+            self.events.task_done()
+
+    def _call(self, cmd, when):
+        name = os.path.basename(cmd[-1])
+        start = time.time()
+        try:
+            p = Popen(cmd + [when], stdout=PIPE, stderr=STDOUT, preexec_fn=os.setsid, close_fds=True)
+        except OSError as e:
+            self.log(' hook %s %s: %s' % (name, when, e))
+            return
+
+        killer = Timer(self.timeout, self._kill, args=(p,))
+        killer.daemon = True
+        killer.start()
+        out = p.communicate()[0]
+        killer.cancel()
+
+        for line in out.splitlines():
+            if line.strip():
+                self.log('  [%s] %s' % (name, line))
+
+        elapsed = time.time() - start
+        profiler.record('hook.' + when, start, script=name)
+        if p.returncode in (-signal.SIGKILL, -signal.SIGTERM) and elapsed >= self.timeout:
+            self.log(' hook %s %s: killed after %.0fs timeout' % (name, when, self.timeout))
+        else:
+            self.log(' hook %s %s: exit %s in %.2fs' % (name, when, p.returncode, elapsed))
+
+    @staticmethod
+    def _kill(p):
+        try:
+            os.killpg(p.pid, signal.SIGTERM)
+            time.sleep(1)
+            os.killpg(p.pid, signal.SIGKILL)  # raise ESRCH if the group is already gone
+        except OSError:
+            pass
@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = "duc_tin"
+__copyright__ = "Copyright 2015+, duc_tin"
+__license__ = "GPLv2"
+__version__ = "1.0"
+__maintainer__ = "duc_tin"
+__email__ = "nguyenbaduc.tin@gmail.com"
+
+import time
+import errno
+import base64
+import select
+import socket
+import struct
+from threading import Thread, Lock
+import netns
+
+SO_BINDTODEVICE = 25  # linux/socket.h, missing from the socket module of python 2
+
+# SOCKS5 replies, RFC 1928
+SUCCEEDED, FAILURE, NET_UNREACHABLE, HOST_UNREACHABLE, REFUSED, NOT_SUPPORTED = 0, 1, 3, 4, 5, 7
+
+
+def recv_exact(sock, size):
+    data = ''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise socket.error('client closed the connection')
+        data += chunk
+    return data
+
+
+class Relay:
+    """ Move the bytes of every established pair of sockets on one thread
+
+        Each socket has one receive buffer. Data is read into it and sent from
+        a memoryview of it, so bytes are never copied in python. While a peer
+        has not taken everything, the socket feeding it is not read (backpressure),
+        so the buffer is never overwritten before it is sent. EOF is passed on
+        as a half close, a pair is closed once both directions are done.
+    """
+
+    def __init__(self, bufsize=65536):
+        self.bufsize = bufsize
+        self.poller = select.epoll()
+        self.lock = Lock()
+        self.peers = {}  # fd -> (socket, fd of its peer)
+        self.buffers = {}  # fd -> bytearray that fd is read into
+        self.pending = {}  # fd -> memoryview not sent to fd yet
+        self.eof = set()  # fds that will not send anything more
+        self.parked = set()  # hung up fds taken out of the poller until watch() wants them again
+        self.bytes = 0
+        self.running = False
+
+    def add(self, a, b):
+        """ Relay between two connected sockets, from any thread """
+        a.setblocking(0)
+        b.setblocking(0)
+        with self.lock:
+            for sock, peer in [(a, b), (b, a)]:
+                self.peers[sock.fileno()] = sock, peer.fileno()
+                self.buffers[sock.fileno()] = bytearray(self.bufsize)
+                self.poller.register(sock.fileno(), select.EPOLLIN)
+
+    def active(self):
+        return len(self.peers) / 2
+
+    def start(self):
+        self.running = True
+        t = Thread(target=self.loop)
+        t.daemon = True
+        t.start()
+        return self
+
+    def loop(self):
+        while self.running:
+            try:
+                events = self.poller.poll(1)
+            except IOError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            with self.lock:
+                for fd, event in events:
+                    if fd not in self.peers:
+                        continue  # closed by an earlier event of this round
+                    if event & select.EPOLLOUT:
+                        self.on_write(fd)
+                    if fd in self.peers and event & select.EPOLLIN:
+                        self.on_read(fd)
+                    elif fd in self.peers and event & select.EPOLLERR:
+                        self.close(fd)
+                    elif fd in self.peers and event & select.EPOLLHUP:
+                        self.hang_up(fd)
+
+    def stop(self):
+        self.running = False
+        with self.lock:
+            for fd in self.peers.keys():
+                if fd in self.peers:
+                    self.close(fd)
+
+    # ------------------------- events ----------------------------
+    def on_read(self, fd):
+        sock, peer = self.peers[fd]
+        buf = self.buffers[fd]
+        try:
+            size = sock.recv_into(buf)
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                self.close(fd)
+            return
+
+        if not size:
+            self.eof.add(fd)
+            self.watch(fd)
+            if peer not in self.pending:
+                self.half_close(peer)
+            return
+        self.bytes += size
+        self.send(peer, memoryview(buf)[:size])
+
+    def on_write(self, fd):
+        self.send(fd, self.pending.pop(fd))
+        peer = self.peers[fd][1] if fd in self.peers else None
+        if peer in self.eof and fd not in self.pending:
+            self.half_close(fd)
+
+    def send(self, fd, data):
+        sock, peer = self.peers[fd]
+        try:
+            sent = sock.send(data)
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                self.close(fd)
+                return
+            sent = 0
+        if sent < len(data):
+            self.pending[fd] = data[sent:]
+        self.watch(fd)
+        self.watch(peer)
+
+    def watch(self, fd):
+        """ Read fd unless it is done or its peer still has to send what came from it, write fd while it has pending """
+        peer = self.peers[fd][1]
+        mask = 0
+        if fd not in self.eof and peer not in self.pending:
+            mask |= select.EPOLLIN
+        if fd in self.pending:
+            mask |= select.EPOLLOUT
+        if fd not in self.parked:
+            self.poller.modify(fd, mask)
+        elif mask:
+            self.parked.discard(fd)
+            self.poller.register(fd, mask)
+
+    def hang_up(self, fd):
+        """ Both directions of fd are shut, but it may still hold data to read or its peer
+            data to send. Close the pair when nothing is left, else stop polling fd,
+            epoll would report the hang up again at once
+        """
+        peer = self.peers[fd][1]
+        if fd in self.eof and peer in self.eof and fd not in self.pending and peer not in self.pending:
+            self.close(fd)
+            return
+        self.poller.unregister(fd)
+        self.parked.add(fd)
+
+    def half_close(self, fd):
+        """ Tell fd that its peer sent everything, close the pair when both sides are done
+            and nothing is left to send, else the last on_write() closes it
+        """
+        sock, peer = self.peers[fd]
+        try:
+            sock.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+        if fd in self.eof and peer in self.eof and fd not in self.pending and peer not in self.pending:
+            self.close(fd)
+
+    def close(self, fd):
+        for one in [fd, self.peers[fd][1]]:
+            sock, _ = self.peers.pop(one)
+            self.buffers.pop(one, None)
+            self.pending.pop(one, None)
+            self.eof.discard(one)
+            self.parked.discard(one)
+            try:
+                self.poller.unregister(one)
+            except (IOError, ValueError):
+                pass
+            sock.close()
+
+
+class LocalProxy:
+    """ SOCKS5 and HTTP CONNECT proxy on one local port that only goes out through a tunnel
+
+        The exit is the current tunnel of Connection, or the tunnels of its pool
+        in turn. A client picks one pool tunnel by giving its slot as the user
+        name: socks5h://1@127.0.0.1:1080 or http://1:@127.0.0.1:1080.
+        Sockets to the target are bound to the tun device, to the tunnel's
+        address (pool) or opened inside its namespace (isolated pool), so
+        nothing leaks to the normal route.
+
+        When no tunnel is up, eg: while switching servers, a new connection is
+        held and retried for up to 'hold' seconds before it is refused.
+
+        Handshakes run on one short thread per client, the established pairs
+        are relayed by a single Relay thread.
+    """
+
+    def __init__(self, connection, host='127.0.0.1', port=1080, hold=15, timeout=10):
+        """ :type connection: vpn_core.Connection """
+        self.ovpn = connection
+        self.hold = hold
+        self.timeout = timeout
+        self.relay = Relay()
+        self.lock = Lock()
+        self.stats = dict((k, 0) for k in ['connections', 'socks', 'http', 'held', 'failed'])
+
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(128)
+        self.address = self.sock.getsockname()
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.relay.start()
+        t = Thread(target=self.serve)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.sock.close()
+        self.relay.stop()
+
+    def serve(self):
+        while self.running:
+            try:
+                client, _ = self.sock.accept()
+            except socket.error:
+                break
+            with self.lock:
+                self.stats['connections'] += 1
+                turn = self.stats['connections']
+            t = Thread(target=self.handle, args=(client, turn))
+            t.daemon = True
+            t.start()
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def status(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats.update(listen='%s:%d' % self.address, active=self.relay.active(), bytes=self.relay.bytes)
+        return stats
+
+    # ------------------------- exits -----------------------------
+    def exit(self, slot, turn):
+        """ :return: ('netns', name), ('addr', ip) or ('dev', tun) of a tunnel that is up, None if there is none """
+        tunnels = [t for s, t in sorted(self.ovpn.pool.tunnels.items()) if t.state == 'up']
+        if slot is not None:
+            tunnels = [t for t in tunnels if t.slot == slot]
+        if tunnels:
+            t = tunnels[turn % len(tunnels)]
+            return ('netns', t.netns) if t.netns else ('addr', t.addr) if t.addr else ('dev', t.dev)
+        if slot is None and self.ovpn.is_connected == 2 and self.ovpn.tun_dev:
+            return 'dev', self.ovpn.tun_dev
+        return None
+
+    def open(self, way, host, port):
+        kind, name = way
+        if kind == 'netns':
+            return netns.connect(name, (host, port), self.timeout)
+        if kind == 'addr':
+            return socket.create_connection((host, port), self.timeout, (name, 0))
+
+        family, kind, proto, _, address = socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM)[0]
+        sock = socket.socket(family, kind, proto)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE, name + '\0')
+            sock.settimeout(self.timeout)
+            sock.connect(address)
+        except socket.error:
+            sock.close()
+            raise
+        return sock
+
+    def connect(self, host, port, slot, turn):
+        """ Socket to host:port through a tunnel, waiting for one while none is up """
+        deadline = time.time() + self.hold
+        held = False
+        while True:
+            way = self.exit(slot, turn)
+            if way:
+                try:
+                    return self.open(way, host, port)
+                except socket.error:
+                    # the target refused us, or the tunnel went down under us
+                    if self.exit(slot, turn) == way or time.time() > deadline:
+                        raise
+            elif time.time() > deadline:
+                raise socket.error(errno.ENETUNREACH, 'no tunnel is up')
+            if not held:
+                held = True
+                self.count('held')
+            time.sleep(0.25)
+
+    # ------------------------- clients ---------------------------
+    def handle(self, client, turn):
+        client.settimeout(self.timeout)
+        try:
+            first = client.recv(1, socket.MSG_PEEK)
+            if first == '\x05':
+                upstream = self.socks(client, turn)
+            elif first:
+                upstream = self.http(client, turn)
+            else:
+                upstream = None
+        except (socket.error, ValueError, struct.error):
+            upstream = None
+            self.count('failed')
+
+        if upstream:
+            self.relay.add(client, upstream)
+        else:
+            client.close()
+
+    def socks(self, client, turn):
+        self.count('socks')
+        _, count = struct.unpack('BB', recv_exact(client, 2))
+        methods = recv_exact(client, count)
+
+        slot = None
+        if '\x02' in methods:
+            # user name picks the tunnel, the password is ignored (RFC 1929)
+            client.sendall('\x05\x02')
+            _, size = struct.unpack('BB', recv_exact(client, 2))
+            user = recv_exact(client, size)
+            recv_exact(client, ord(recv_exact(client, 1)))
+            client.sendall('\x01\x00')
+            slot = int(user) if user.isdigit() else None
+        elif '\x00' in methods:
+            client.sendall('\x05\x00')
+        else:
+            client.sendall('\x05\xff')
+            return None
+
+        _, cmd, _, kind = struct.unpack('BBBB', recv_exact(client, 4))
+        if kind == 1:
+            host = socket.inet_ntoa(recv_exact(client, 4))
+        elif kind == 3:
+            host = recv_exact(client, ord(recv_exact(client, 1)))
+        elif kind == 4:
+            host = socket.inet_ntop(socket.AF_INET6, recv_exact(client, 16))
+        else:
+            client.sendall(self.socks_reply(NOT_SUPPORTED))
+            return None
+        port, = struct.unpack('!H', recv_exact(client, 2))
+
+        if cmd != 1:  # only CONNECT
+            client.sendall(self.socks_reply(NOT_SUPPORTED))
+            return None
+        try:
+            upstream = self.connect(host, port, slot, turn)
+        except socket.error as e:
+            self.count('failed')
+            code = {errno.ENETUNREACH: NET_UNREACHABLE, errno.EHOSTUNREACH: HOST_UNREACHABLE,
+                    errno.ECONNREFUSED: REFUSED}.get(e.errno, FAILURE)
+            client.sendall(self.socks_reply(code))
+            return None
+        client.sendall(self.socks_reply(SUCCEEDED, upstream.getsockname()))
+        return upstream
+
+    @staticmethod
+    def socks_reply(code, bound=('0.0.0.0', 0)):
+        return struct.pack('BBBB', 5, code, 0, 1) + socket.inet_aton(bound[0]) + struct.pack('!H', bound[1])
+
+    def http(self, client, turn):
+        self.count('http')
+        head = ''
+        while '\r\n\r\n' not in head:
+            data = client.recv(4096)
+            if not data or len(head) > 65536:
+                return None
+            head += data
+        head, rest = head.split('\r\n\r\n', 1)
+        lines = head.split('\r\n')
+        method, target = lines[0].split()[:2]
+        if method != 'CONNECT':
+            client.sendall('HTTP/1.1 405 Method Not Allowed\r\nAllow: CONNECT\r\nContent-Length: 0\r\n\r\n')
+            return None
+
+        slot = None
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            if name.strip().lower() == 'proxy-authorization' and value.split()[:1] == ['Basic']:
+                try:
+                    user = base64.b64decode(value.split()[1]).split(':')[0]
+                except (IndexError, TypeError):  # no credentials, or not base64: any tunnel
+                    continue
+                slot = int(user) if user.isdigit() else None
+
+        host, port = target.rsplit(':', 1)
+        try:
+            upstream = self.connect(host.strip('[]'), int(port), slot, turn)
+        except socket.error:
+            self.count('failed')
+            client.sendall('HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\n\r\n')
+            return None
+        client.sendall('HTTP/1.1 200 Connection established\r\n\r\n')
+        if rest:
+            upstream.sendall(rest)
+        return upstream
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = "duc_tin"
+__copyright__ = "Copyright 2015+, duc_tin"
+__license__ = "GPLv2"
+__version__ = "1.0"
+__maintainer__ = "duc_tin"
+__email__ = "nguyenbaduc.tin@gmail.com"
+
+import os
+import gzip
+import shutil
+from collections import deque
+from threading import Thread, Event, Lock, RLock
+
+
+class LogWriter:
+    """ Append lines to a log file from a background thread
+
+        write() only puts the line in a bounded ring buffer, so it never
+        touches the disk. The writer thread flushes the buffer in one batch
+        every flush_interval seconds, keeping the file open between batches.
+        When the file grows over max_bytes it is rotated to path.1 .. path.N
+        (path.1.gz .. when compress is set). If the disk is too slow the oldest
+        unwritten lines are dropped and counted in self.dropped.
+    """
+
+    def __init__(self, path, max_bytes=1024 ** 2, backups=3, compress=False, flush_interval=1.0,
+                 buffer_len=2000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self.flush_interval = flush_interval
+
+        self.buffer = deque(maxlen=buffer_len)
+        self.dropped = 0
+        self.lock = Lock()  # guards buffer and dropped, held only for a moment
+        self.io_lock = RLock()  # guards the file, held while writing or rotating
+        self.wakeup = Event()
+        self.running = False
+        self.thread = None
+        self.log = None
+
+    def write(self, line):
+        if not self.running:
+            self.start()
+
+        with self.lock:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.dropped += 1
+            self.buffer.append(line)
+
+    def start(self):
+        """ Start the writer thread, only once however many threads call it """
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+            self.thread = Thread(target=self.writer)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def new_session(self, *lines):
+        """ Rotate out the log of the last session and start a new file with lines """
+        self.start()
+        with self.io_lock:
+            self.flush()
+            try:
+                if os.path.exists(self.path) and os.path.getsize(self.path):
+                    self.rotate()
+            except (IOError, OSError):
+                pass  # an unwritable log must not stop the program, flush() gives up the same way
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        """ Write out everything buffered in one batch """
+        with self.io_lock:
+            with self.lock:
+                lines, dropped = list(self.buffer), self.dropped
+                self.buffer.clear()
+                self.dropped = 0
+            if dropped:
+                lines.insert(0, '... %d log lines dropped' % dropped)
+            if not lines:
+                return
+
+            try:
+                if not self.log:
+                    self.log = open(self.path, 'a')
+                self.log.write('\n'.join(lines) + '\n')
+                self.log.flush()
+                if self.log.tell() > self.max_bytes:
+                    self.rotate()
+            except (IOError, OSError):
+                pass
+
+    def rotate(self):
+        if self.log:
+            self.log.close()
+            self.log = None
+
+        ext = '.gz' if self.compress else ''
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists('%s.%d%s' % (self.path, i, ext)):
+                os.rename('%s.%d%s' % (self.path, i, ext), '%s.%d%s' % (self.path, i + 1, ext))
+
+        if not self.backups:
+            os.remove(self.path)
+        elif self.compress:
+            with open(self.path, 'rb') as src:
+                dst = gzip.open(self.path + '.1.gz', 'wb')
+                shutil.copyfileobj(src, dst)
+                dst.close()
+            os.remove(self.path)
+        else:
+            os.rename(self.path, self.path + '.1')
+
+    def writer(self):
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def close(self):
+        """ Stop the writer thread and write out what is left """
+        if self.running:
+            self.running = False
+            self.wakeup.set()
+            self.thread.join()
+        with self.io_lock:
+            self.flush()
+            if self.log:
+                self.log.close()
+                self.log = None
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = "duc_tin"
+__copyright__ = "Copyright 2015+, duc_tin"
+__license__ = "GPLv2"
+__version__ = "1.0"
+__maintainer__ = "duc_tin"
+__email__ = "nguyenbaduc.tin@gmail.com"
+
+from threading import Lock
+from collections import OrderedDict, deque
+
+
+class MessageBus:
+    """ Messages from the vpn engine threads to the front end
+
+        Line topics (country, status) hold the few lines on display; new lines
+        push the old ones out. Queue topics (debug) are bounded FIFOs that the
+        front end drains in one batch; when one is full its oldest message is
+        dropped and counted. Every call holds the lock only for a list or deque
+        operation, so producers never wait on the consumer.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.lines = OrderedDict()
+        self.queues = OrderedDict()
+        self.dropped = {}
+        self.version = 0  # bumped on every change, compare it to skip a redraw
+
+    def add_lines(self, topic, count):
+        self.lines[topic] = [' '] * count
+
+    def add_queue(self, topic, maxlen):
+        self.queues[topic] = deque(maxlen=maxlen)
+        self.dropped[topic] = 0
+
+    def set(self, topic, *lines):
+        """ Add lines to a line topic, the same as deque(maxlen=count) += lines """
+        with self.lock:
+            count = len(self.lines[topic])
+            self.lines[topic] = (self.lines[topic] + list(lines))[-count:]
+            self.version += 1
+
+    def set_line(self, topic, index, line):
+        with self.lock:
+            self.lines[topic][index] = line
+            self.version += 1
+
+    def get(self, topic):
+        with self.lock:
+            return list(self.lines[topic])
+
+    def put(self, topic, msg):
+        with self.lock:
+            queue = self.queues[topic]
+            if len(queue) == queue.maxlen:
+                self.dropped[topic] += 1
+            queue.append(msg)
+            self.version += 1
+
+    def drain(self, topic):
+        """ Take every queued message of topic, oldest first """
+        with self.lock:
+            return self._drain(topic)
+
+    def _drain(self, topic):
+        msgs = list(self.queues[topic])
+        self.queues[topic].clear()
+        if self.dropped[topic]:
+            msgs.insert(0, ' ... %d messages dropped' % self.dropped[topic])
+            self.dropped[topic] = 0
+        return msgs
+
+    def snapshot(self):
+        """ Version, lines of every line topic and drained queues, all taken at the same moment """
+        with self.lock:
+            lines = OrderedDict((topic, list(self.lines[topic])) for topic in self.lines)
+            queued = dict((topic, self._drain(topic)) for topic in self.queues)
+            return self.version, lines, queued
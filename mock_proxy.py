@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = "duc_tin"
+__copyright__ = "Copyright 2015+, duc_tin"
+__license__ = "GPLv2"
+__version__ = "1.0"
+__maintainer__ = "duc_tin"
+__email__ = "nguyenbaduc.tin@gmail.com"
+
+import sys
+import time
+import base64
+import select
+import socket
+from threading import Thread, Lock
+
+
+class MockProxy:
+    """ A local HTTP proxy that behaves like a slow or strict corporate one
+
+        Handles CONNECT tunnels (used by probe and openvpn) and plain
+        'GET http://...' forwarding (used by requests with proxies=).
+
+        latency : seconds to wait before answering each connection
+        max_conns: connections served at once, extra ones get 503
+        auth    : 'user:password', clients without it get 407
+        deny    : targets refused with 403, 'host:port' or ':port'
+        rate    : new connections allowed per second, extra ones get 429
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, max_conns=0, auth=None, deny=(), rate=0):
+        self.latency = latency
+        self.max_conns = max_conns
+        self.auth = 'Basic ' + base64.b64encode(auth) if auth else None
+        self.deny = set(deny)
+        self.rate = rate
+
+        self.lock = Lock()
+        self.active = 0
+        self.tokens, self.last_fill = float(rate), time.time()
+        self.stats = dict((k, 0) for k in ['connections', 'tunnels', 'forwarded', 'auth_failed', 'denied',
+                                           'rate_limited', 'busy', 'failed', 'peak'])
+
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(128)
+        self.address = self.sock.getsockname()
+        self.running = False
+
+    def start(self):
+        self.running = True
+        t = Thread(target=self.serve)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.sock.close()
+
+    def serve(self):
+        while self.running:
+            try:
+                client, _ = self.sock.accept()
+            except socket.error:
+                break
+            t = Thread(target=self.handle, args=(client,))
+            t.daemon = True
+            t.start()
+
+    # ------------------------- admission -------------------------
+    def take_token(self):
+        if not self.rate:
+            return True
+        now = time.time()
+        self.tokens = min(self.rate, self.tokens + (now - self.last_fill) * self.rate)
+        self.last_fill = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def admit(self):
+        """ :return: None if the connection may go on, else the status line to refuse it """
+        with self.lock:
+            self.stats['connections'] += 1
+            if not self.take_token():
+                self.stats['rate_limited'] += 1
+                return '429 Too Many Requests'
+            if self.max_conns and self.active >= self.max_conns:
+                self.stats['busy'] += 1
+                return '503 Service Unavailable'
+            self.active += 1
+            self.stats['peak'] = max(self.stats['peak'], self.active)
+        return None
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    # ------------------------- requests --------------------------
+    @staticmethod
+    def read_head(client):
+        head = ''
+        while '\r\n\r\n' not in head:
+            data = client.recv(4096)
+            if not data:
+                return None, ''
+            head += data
+        head, rest = head.split('\r\n\r\n', 1)
+        return head.split('\r\n'), rest
+
+    @staticmethod
+    def reply(client, status, extra=''):
+        try:
+            client.sendall('HTTP/1.0 %s\r\n%sContent-Length: 0\r\n\r\n' % (status, extra))
+        except socket.error:
+            pass
+
+    def handle(self, client):
+        client.settimeout(10)
+        refused = self.admit()
+        try:
+            lines, rest = self.read_head(client)
+            if not lines:
+                return
+            if refused:
+                self.reply(client, refused)
+                return
+            time.sleep(self.latency)
+
+            method, target = lines[0].split()[:2]
+            headers = dict(line.split(':', 1) for line in lines[1:] if ':' in line)
+            headers = dict((k.strip().lower(), v.strip()) for k, v in headers.items())
+
+            if self.auth and headers.get('proxy-authorization') != self.auth:
+                self.count('auth_failed')
+                self.reply(client, '407 Proxy Authentication Required', 'Proxy-Authenticate: Basic realm="mock"\r\n')
+                return
+
+            if method == 'CONNECT':
+                host, port = target.rsplit(':', 1)
+            else:
+                # absolute uri: http://host[:port]/path
+                hostport, _, path = target.split('://', 1)[-1].partition('/')
+                host, _, port = hostport.partition(':')
+                port = port or '80'
+
+            if host + ':' + port in self.deny or ':' + port in self.deny:
+                self.count('denied')
+                self.reply(client, '403 Forbidden')
+                return
+
+            try:
+                upstream = socket.create_connection((host, int(port)), timeout=10)
+            except (socket.error, ValueError):
+                self.count('failed')
+                self.reply(client, '502 Bad Gateway')
+                return
+
+            if method == 'CONNECT':
+                self.count('tunnels')
+                client.sendall('HTTP/1.0 200 Connection established\r\n\r\n')
+            else:
+                self.count('forwarded')
+                kept = [line for line in lines[1:] if not line.lower().startswith(('proxy-', 'connection'))]
+                upstream.sendall('\r\n'.join(['%s /%s %s' % (method, path, lines[0].split()[2])] + kept +
+                                             ['Connection: close', '', '']))
+            if rest:
+                upstream.sendall(rest)
+            self.relay(client, upstream)
+        except (socket.error, ValueError, IndexError):
+            self.count('failed')
+        finally:
+            client.close()
+            if not refused:
+                self.release()
+
+    @staticmethod
+    def relay(client, upstream):
+        peers = {client: upstream, upstream: client}
+        try:
+            while True:
+                readable, _, _ = select.select(peers.keys(), [], [], 30)
+                if not readable:
+                    return
+                for sock in readable:
+                    data = sock.recv(65536)
+                    if not data:
+                        return
+                    peers[sock].sendall(data)
+        finally:
+            upstream.close()
+
+
+if __name__ == '__main__':
+    # standalone: python mock_proxy.py [port] [latency]
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 3128
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    proxy = MockProxy(port=port, latency=latency).start()
+    print 'Mock proxy on %s:%d, Ctrl+C to stop' % proxy.address
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        proxy.stop()
+        print proxy.stats
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = "duc_tin"
+__copyright__ = "Copyright 2015+, duc_tin"
+__license__ = "GPLv2"
+__version__ = "1.0"
+__maintainer__ = "duc_tin"
+__email__ = "nguyenbaduc.tin@gmail.com"
+
+import os
+import re
+import socket
+import struct
+from subprocess import call, Popen, PIPE
+
+# rtnetlink constants, see linux/netlink.h and linux/rtnetlink.h
+NETLINK_ROUTE = 0
+RTM_DELLINK = 17
+NLMSG_ERROR = 2
+NLM_F_REQUEST = 1
+NLM_F_ACK = 4
+
+NLMSGHDR = 'IHHII'  # len, type, flags, seq, pid
+IFINFOMSG = 'BxHiII'  # family, pad, type, index, flags, change
+
+TUN_OPENED = re.compile(r'TUN/TAP device (\S+) opened')
+# 'ip addr add dev tun0 10.211.1.5/16', 'ifconfig tun0 10.211.1.5 netmask', 'net_addr_v4_add: 10.211.1.5/16'
+TUN_ADDR = re.compile(r'(?:addr add dev \S+ |ifconfig [a-z]\S* |net_addr_v4_add: )(\d+\.\d+\.\d+\.\d+)')
+
+
+# pushed 'ifconfig 10.211.1.5 255.255.0.0' (subnet) or 'ifconfig 10.8.0.6 10.8.0.5' (net30, p2p)
+PUSHED_IFCONFIG = re.compile(r"PUSH_REPLY.*[,']ifconfig (\d+\.\d+\.\d+\.\d+) (\d+\.\d+\.\d+\.\d+)")
+# 'Mon Oct 19 10:00:00 2026 ', or '2026-10-19 10:00:00 ' with --machine-readable-output
+LOG_TIME = re.compile(r'^(?:\w{3} \w{3} +\d+ \d\d:\d\d:\d\d \d{4}|\d{4}-\d\d-\d\d \d\d:\d\d:\d\d) ')
+PUSHED_DNS = re.compile(r'dhcp-option DNS (\d+\.\d+\.\d+\.\d+)')
+
+
+def ip(*args):
+    """ Run one 'ip' command quietly, True on success """
+    with open(os.devnull, 'w') as null:
+        return call(('ip',) + args, stdout=null, stderr=null) == 0
+
+
+def ip_batch(commands):
+    """ Run many 'ip' commands (without the leading 'ip') with a single fork,
+        going on after errors. :return: how many of them failed
+    """
+    if not commands:
+        return 0
+    try:
+        p = Popen(['ip', '-force', '-batch', '-'], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        _, err = p.communicate('\n'.join(commands) + '\n')
+    except OSError:
+        return len(commands)
+    return err.count('Command failed')
+
+
+def strip_time(line):
+    """ openvpn output line without its timestamp, if it has one """
+    return LOG_TIME.sub('', line.strip())
+
+
+def tun_from_log(line):
+    """ Name of the tun device that openvpn reports in its output, or None """
+    found = TUN_OPENED.search(line)
+    return found.group(1) if found else None
+
+
+def addr_from_log(line):
+    """ Local ipv4 address that openvpn gives its tun device, or None """
+    found = TUN_ADDR.search(line)
+    return found.group(1) if found else None
+
+
+def ifconfig_from_push(line):
+    """ (local address, netmask or peer address) pushed by the server, or None """
+    found = PUSHED_IFCONFIG.search(line)
+    return found.groups() if found else None
+
+
+def dns_from_push(line):
+    """ DNS servers pushed by the server in a PUSH_REPLY line, maybe [] """
+    return PUSHED_DNS.findall(line) if 'PUSH_REPLY' in line else []
+
+
+def link_index(dev):
+    """ Interface index of dev, 0 if it does not exist. Read from sysfs, no fork """
+    try:
+        with open('/sys/class/net/%s/ifindex' % dev) as f:
+            return int(f.read())
+    except (IOError, ValueError):
+        return 0
+
+
+def delete_link(dev):
+    """ Remove network device dev with a single RTM_DELLINK request.
+        Fall back to 'ip link delete' when netlink is not usable.
+        :return: True if the device is gone
+    """
+    index = link_index(dev)
+    if not index:
+        return True
+
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    except (AttributeError, socket.error):
+        return call(['ip', 'link', 'delete', dev]) == 0
+
+    try:
+        sock.bind((0, 0))
+        body = struct.pack(IFINFOMSG, socket.AF_UNSPEC, 0, index, 0, 0)
+        header = struct.pack(NLMSGHDR, struct.calcsize(NLMSGHDR) + len(body), RTM_DELLINK,
+                             NLM_F_REQUEST | NLM_F_ACK, 1, 0)
+        sock.send(header + body)
+
+        reply = sock.recv(4096)
+        _, msg_type, _, _, _ = struct.unpack(NLMSGHDR, reply[:16])
+        if msg_type == NLMSG_ERROR:
+            error = struct.unpack('i', reply[16:20])[0]
+            return error == 0 or not link_index(dev)
+        return not link_index(dev)
+    except socket.error:
+        return call(['ip', 'link', 'delete', dev]) == 0
+    finally:
+        sock.close()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = "duc_tin"
+__copyright__ = "Copyright 2015+, duc_tin"
+__license__ = "GPLv2"
+__version__ = "1.0"
+__maintainer__ = "duc_tin"
+__email__ = "nguyenbaduc.tin@gmail.com"
+
+import os
+import errno
+import ctypes
+import random
+import shutil
+import socket
+import struct
+from threading import Thread
+from netlink import ip
+from resolv_manager import atomic_write
+
+PREFIX = 'vpngate'  # namespaces are vpngate0, vpngate1... one per tunnel slot
+NETNS_DIR = '/var/run/netns'
+NETNS_ETC = '/etc/netns'  # 'ip netns exec' mounts NETNS_ETC/<name>/resolv.conf over /etc/resolv.conf
+CLONE_NEWNET = 0x40000000
+DNS_TIMEOUT = 3  # seconds for each server of a namespace's resolv.conf
+
+
+def ns_name(slot):
+    return PREFIX + str(slot)
+
+
+def existing():
+    """ Our namespaces that exist now, including the ones left by a crashed run """
+    try:
+        return [name for name in os.listdir(NETNS_DIR) if name.startswith(PREFIX)]
+    except OSError:
+        return []
+
+
+def create(name, dns):
+    """ New namespace with only a loopback device, programs in it resolve with dns (may be [] for now) """
+    destroy(name)
+    if not ip('netns', 'add', name):
+        return False
+    ip('-n', name, 'link', 'set', 'lo', 'up')
+
+    set_dns(name, dns)
+    return True
+
+
+def set_dns(name, dns):
+    """ Write the resolv.conf that programs in namespace name see """
+    folder = os.path.join(NETNS_ETC, name)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    atomic_write(folder + '/resolv.conf', ''.join('nameserver %s\n' % server for server in dns))
+
+
+def attach(name, dev, local, mask):
+    """ Move the tun device of an openvpn into namespace name, give it the pushed address
+        and make it the default route there. openvpn keeps its socket in the host namespace.
+        :param mask: netmask, or the peer address for a point to point (net30) tunnel
+    """
+    if not ip('link', 'set', 'dev', dev, 'netns', name):
+        return False
+
+    if mask.startswith('255.'):
+        prefix = sum(bin(int(byte)).count('1') for byte in mask.split('.'))
+        address = [local + '/%d' % prefix]
+    else:
+        address = ['local', local, 'peer', mask]
+    return (ip('-n', name, 'addr', 'add', *(address + ['dev', dev])) and
+            ip('-n', name, 'link', 'set', 'dev', dev, 'up') and
+            ip('-n', name, 'route', 'replace', 'default', 'dev', dev))
+
+
+def destroy(name):
+    """ Remove namespace name, the tun device in it goes with it """
+    if os.path.exists(os.path.join(NETNS_DIR, name)):
+        ip('netns', 'delete', name)
+    shutil.rmtree(os.path.join(NETNS_ETC, name), ignore_errors=True)
+
+
+def nameservers(name):
+    """ DNS servers in the resolv.conf of namespace name """
+    try:
+        with open(os.path.join(NETNS_ETC, name, 'resolv.conf')) as f:
+            return [line.split()[1] for line in f if line.startswith('nameserver') and len(line.split()) > 1]
+    except IOError:
+        return []
+
+
+def query_a(host, server, timeout=DNS_TIMEOUT):
+    """ First ipv4 address of host in the answer of server to one A query over UDP, or None """
+    labels = host.rstrip('.').split('.')
+    if not all(0 < len(label) < 64 for label in labels):
+        return None
+    ident = random.randint(0, 0xffff)
+    question = ''.join(chr(len(label)) + label for label in labels) + '\0' + struct.pack('!HH', 1, 1)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.settimeout(timeout)
+        sock.sendto(struct.pack('!HHHHHH', ident, 0x0100, 1, 0, 0, 0) + question, (server, 53))
+        data = sock.recv(4096)
+    except socket.error:
+        return None
+    finally:
+        sock.close()
+
+    try:
+        answer_id, flags, _, count, _, _ = struct.unpack_from('!HHHHHH', data)
+        if answer_id != ident or flags & 0x000f:
+            return None
+        offset = 12 + len(question)
+        for i in range(count):
+            while ord(data[offset]):  # owner name: labels, maybe ending with a pointer
+                if ord(data[offset]) & 0xc0 == 0xc0:
+                    offset += 1
+                    break
+                offset += ord(data[offset]) + 1
+            kind, _, _, size = struct.unpack_from('!HHIH', data, offset + 1)
+            offset += 11
+            if kind == 1 and size == 4:
+                return socket.inet_ntoa(data[offset:offset + 4])
+            offset += size  # CNAME and others
+    except (IndexError, struct.error):
+        pass
+    return None
+
+
+def resolve(name, host):
+    """ ipv4 address of host with the DNS of namespace name, must run inside the namespace.
+        getaddrinfo() would read the host's /etc/resolv.conf and ask over the host's route.
+    """
+    for family in [socket.AF_INET, socket.AF_INET6]:
+        try:
+            socket.inet_pton(family, host)
+            return host
+        except socket.error:
+            pass
+    for server in nameservers(name):
+        address = query_a(host, server)
+        if address:
+            return address
+    raise socket.gaierror(socket.EAI_NONAME, 'cannot resolve %s in %s' % (host, name))
+
+
+def connect(name, address, timeout=10):
+    """ Socket connected to address from inside namespace name, for a process that stays outside.
+        setns() only moves the calling thread, so a short thread enters the namespace,
+        resolves, connects and ends. The socket keeps belonging to the namespace.
+    """
+    result = []
+
+    def enter_and_connect():
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            with open(os.path.join(NETNS_DIR, name)) as f:
+                if libc.setns(f.fileno(), CLONE_NEWNET):
+                    err = ctypes.get_errno()
+                    raise socket.error(err, 'setns %s: %s' % (name, os.strerror(err)))
+            result.append(socket.create_connection((resolve(name, address[0]), address[1]), timeout))
+        except socket.error as e:  # a subclass of IOError, keep its errno
+            result.append(e)
+        except IOError as e:  # the namespace file is gone
+            result.append(socket.error(errno.ENETUNREACH, str(e)))
+
+    t = Thread(target=enter_and_connect)
+    t.start()
+    t.join()
+    if isinstance(result[0], socket.error):
+        raise result[0]
+    return result[0]
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = "duc_tin"
+__copyright__ = "Copyright 2015+, duc_tin"
+__license__ = "GPLv2"
+__version__ = "1.0"
+__maintainer__ = "duc_tin"
+__email__ = "nguyenbaduc.tin@gmail.com"
+
+import os
+import tempfile
+
+# tmpfs, configs hold keys and never need to touch the disk
+RUNTIME_DIR = '/run/vpngate-with-proxy' if os.path.isdir('/run') else tempfile.gettempdir() + '/vpngate-with-proxy'
+
+
+class OvpnConfig:
+    """ An openvpn config as a list of directives
+
+        Each entry is (name, args) for a normal line or (name, body) for an
+        inline block such as <ca>...</ca>. Comments and blank lines are dropped.
+    """
+
+    def __init__(self, text=''):
+        self.entries = []
+        self.parse(text)
+
+    def parse(self, text):
+        block, body = None, []
+        for line in text.splitlines():
+            line = line.strip()
+            if block:
+                if line == '</%s>' % block:
+                    self.entries.append(('<%s>' % block, '\n'.join(body)))
+                    block, body = None, []
+                else:
+                    body.append(line)
+            elif not line or line[0] in '#;':
+                continue
+            elif line[0] == '<' and line[-1] == '>':
+                block = line[1:-1]
+            else:
+                words = line.split()
+                self.entries.append((words[0], words[1:]))
+
+    def get(self, name):
+        for key, args in self.entries:
+            if key == name:
+                return args
+        return None
+
+    def set(self, name, *args):
+        """ Replace the first 'name' directive or add one, later duplicates are removed """
+        args = [str(a) for a in args]
+        done = False
+        for i, (key, _) in enumerate(self.entries):
+            if key == name:
+                if done:
+                    self.entries[i] = None
+                else:
+                    self.entries[i] = (name, args)
+                    done = True
+        self.entries = [e for e in self.entries if e]
+        if not done:
+            # keep inline blocks at the end, like the original files
+            blocks = [i for i, e in enumerate(self.entries) if e[0][0] == '<']
+            self.entries.insert(blocks[0] if blocks else len(self.entries), (name, args))
+
+    def remove(self, name):
+        self.entries = [e for e in self.entries if e[0] != name]
+
+    def render(self):
+        lines = []
+        for key, args in self.entries:
+            if key[0] == '<':
+                lines += [key, args, '</%s' % key[1:]]
+            else:
+                lines.append(' '.join([key] + args))
+        return '\n'.join(lines) + '\n'
+
+
+def write_runtime(text, tag='vpn'):
+    """ Write text to a new private file under RUNTIME_DIR and return its path.
+        Every connection gets its own file so concurrent tunnels never clash.
+    """
+    if not os.path.isdir(RUNTIME_DIR):
+        os.makedirs(RUNTIME_DIR, 0700)
+
+    fd, path = tempfile.mkstemp(prefix=tag + '_', suffix='.ovpn', dir=RUNTIME_DIR)  # mode 0600
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+    return path
+
+
+def remove_runtime(path):
+    if path and path.startswith(RUNTIME_DIR) and os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = "duc_tin"
+__copyright__ = "Copyright 2015+, duc_tin"
+__license__ = "GPLv2"
+__version__ = "1.0"
+__maintainer__ = "duc_tin"
+__email__ = "nguyenbaduc.tin@gmail.com"
+
+import os
+import json
+import time
+from threading import Lock
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+
+
+class Profiler:
+    """ Wall time spans of the hot paths, off unless enabled
+
+        Turn it on with VPNGATE_PROFILE=1 or 'profile = yes' in the [monitor]
+        section of config.ini. When off, span() and record() cost one if.
+    """
+
+    def __init__(self, enabled=False, keep=2000):
+        self.enabled = enabled
+        self.spans = deque(maxlen=keep)  # (name, start, elapsed, tags), newest last
+        self.lock = Lock()
+
+    @contextmanager
+    def span(self, name, **tags):
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, start, **tags)
+
+    def record(self, name, start, end=None, **tags):
+        """ Add a span that began at start, for work that does not fit in a with block """
+        if self.enabled:
+            elapsed = (end or time.time()) - start
+            with self.lock:
+                self.spans.append((name, start, elapsed, tags))
+
+    def summary(self):
+        """ {name: {count, total, mean, max, last}} in the order names first appeared """
+        with self.lock:
+            spans = list(self.spans)
+
+        result = OrderedDict()
+        for name, start, elapsed, tags in spans:
+            s = result.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+            s['count'] += 1
+            s['total'] += elapsed
+            s['max'] = max(s['max'], elapsed)
+            s['last'] = elapsed
+        for s in result.values():
+            s['mean'] = s['total'] / s['count']
+            for key in s:
+                s[key] = round(s[key], 4)
+        return result
+
+    def report(self):
+        """ Summary as short text lines for the debug pane """
+        lines = [' %-16s %5s %8s %8s %8s' % ('span', 'n', 'mean', 'max', 'last')]
+        for name, s in self.summary().items():
+            lines.append(' %-16s %5d %8.3f %8.3f %8.3f' % (name[:16], s['count'], s['mean'], s['max'], s['last']))
+        return lines
+
+    def dump(self, path):
+        with self.lock:
+            spans = [{'name': n, 'start': round(t, 4), 'elapsed': round(e, 4), 'tags': tags}
+                     for n, t, e, tags in self.spans]
+        with open(path, 'w') as f:
+            json.dump({'summary': self.summary(), 'spans': spans}, f, indent=1)
+
+
+# shared by every module, vpn_core.Connection turns it on from config.ini
+profiler = Profiler(os.environ.get('VPNGATE_PROFILE', '') not in ('', '0', 'no'))
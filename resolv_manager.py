@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = "duc_tin"
+__copyright__ = "Copyright 2015+, duc_tin"
+__license__ = "GPLv2"
+__version__ = "1.0"
+__maintainer__ = "duc_tin"
+__email__ = "nguyenbaduc.tin@gmail.com"
+
+import os
+import tempfile
+from Queue import Queue
+from threading import Thread
+from subprocess import Popen, PIPE
+from profiler import profiler
+
+RESOLV = '/etc/resolv.conf'
+RESOLV_BAK = '/etc/resolv.conf.bak'
+
+
+def atomic_write(path, data):
+    """ Write data to a temp file next to path then rename it over path.
+        Readers see either the old or the new content, never a half-written file.
+        The mode and owner of an existing path are kept, a new one is 0644 root.
+    """
+    path = os.path.realpath(path)  # /etc/resolv.conf may be a symlink
+    folder, name = os.path.split(path)
+    try:
+        st = os.stat(path)
+        mode, uid, gid = st.st_mode & 07777, st.st_uid, st.st_gid
+    except OSError:
+        mode, uid, gid = 0644, 0, 0
+    fd, tmp = tempfile.mkstemp(prefix='.' + name + '.', dir=folder)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if (uid, gid) != (os.geteuid(), os.getegid()):  # mkstemp made it ours
+            os.chown(tmp, uid, gid)
+        os.chmod(tmp, mode)
+        os.rename(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class ResolvManager:
+    """ Change and restore the system DNS without spawning 'cp'
+
+        backend:
+            file             : rewrite /etc/resolv.conf by atomic rename (default)
+            resolvconf       : register nameservers via 'resolvconf -a'
+            systemd-resolved : set per-link dns via 'resolvectl', needs tun device
+    """
+    label = 'tun.vpngate'  # interface record for resolvconf
+
+    def __init__(self, backend='file', logger=None):
+        self.backend = backend
+        self.log = logger or (lambda msg: None)
+        self.original = None  # in memory copy of the original resolv.conf
+        self.via = None  # backend that applied the last change
+        self.dev = None  # link that got dns from systemd-resolved
+
+        self.jobs = Queue()
+        self.worker = None
+
+    def backup(self):
+        if self.original is not None:
+            return
+
+        # leftover of a crashed season is the real original
+        src = RESOLV_BAK if os.path.exists(RESOLV_BAK) else RESOLV
+        try:
+            with open(src) as f:
+                self.original = f.read()
+        except IOError as e:
+            self.log(' Backup DNS failed: ' + str(e))
+            return
+
+        if not os.path.exists(RESOLV_BAK):
+            atomic_write(RESOLV_BAK, self.original)
+
+    def change(self, dns, dev=None):
+        """ :type dns: list """
+        self.backup()
+        content = ''.join('nameserver %s\n' % ip for ip in dns)
+
+        if self.backend == 'resolvconf':
+            if self._run(['resolvconf', '-a', self.label], content):
+                self.via = 'resolvconf'
+                return
+        elif self.backend == 'systemd-resolved':
+            if dev and self._run(['resolvectl', 'dns', dev] + dns) and self._run(['resolvectl', 'domain', dev, '~.']):
+                self.via, self.dev = 'systemd-resolved', dev
+                return
+            elif not dev:
+                self.log(' systemd-resolved needs a tun device, fall back to file')
+
+        atomic_write(RESOLV, content)
+        self.via = 'file'
+
+    def restore(self):
+        via, self.via = self.via, None
+        if via == 'resolvconf':
+            restored = self._run(['resolvconf', '-d', self.label])
+        elif via == 'systemd-resolved':
+            restored = self._run(['resolvectl', 'revert', self.dev])
+            self.dev = None
+        else:
+            if self.original is None and os.path.exists(RESOLV_BAK):
+                with open(RESOLV_BAK) as f:
+                    self.original = f.read()
+            if self.original is None:
+                return
+            atomic_write(RESOLV, self.original)
+            restored = True
+
+        if restored:
+            # back to the original, a backup left now would pass for it after the next crash
+            self.original = None
+            if os.path.exists(RESOLV_BAK):
+                os.remove(RESOLV_BAK)
+
+    def _run(self, cmd, stdin=None):
+        try:
+            p = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+            out, err = p.communicate(stdin)
+        except OSError as e:
+            self.log(' %s: %s' % (cmd[0], e))
+            return False
+        if p.returncode:
+            self.log(' %s: %s' % (cmd[0], err.strip()))
+        return p.returncode == 0
+
+    def do(self, action, *args):
+        """ Run action right now, in the caller's thread """
+        try:
+            with profiler.span('dns.' + action, backend=self.backend):
+                getattr(self, action)(*args)
+        except (IOError, OSError) as e:
+            self.log(' DNS %s failed: %s' % (action, e))
+
+    def submit(self, action, *args, **kwargs):
+        """ Queue action for the worker thread and return immediately.
+            Jobs run one by one in the order they were submitted.
+            kwargs 'done': called by the worker once the action has run
+        """
+        if not self.worker or not self.worker.isAlive():
+            self.worker = Thread(target=self._work)
+            self.worker.daemon = True
+            self.worker.start()
+        self.jobs.put((action, args, kwargs.get('done')))
+
+    def _work(self):
+        while True:
+            action, args, done = self.jobs.get()
+            self.do(action, *args)
+            if done:
+                done()
+            self.jobs.task_done()
+
+    def wait(self):
+        """ Block until every submitted job is done """
+        self.jobs.join()
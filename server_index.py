@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = "duc_tin"
+__copyright__ = "Copyright 2015+, duc_tin"
+__license__ = "GPLv2"
+__version__ = "1.0"
+__maintainer__ = "duc_tin"
+__email__ = "nguyenbaduc.tin@gmail.com"
+
+from bisect import bisect_left
+
+
+class ServerIndex:
+    """ Prefix search over the loaded servers, no network involved
+
+        Every server is indexed by its country code, words of its country
+        name, ip, port and protocol. A query matches a server when each of
+        its words is the prefix of one of those tokens: 'jp', 'korea',
+        '219.100', '1194', 'kor udp'...
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.words = []  # sorted tokens
+        self.positions = []  # position in self.keys of each token
+        self.cache = {}  # word -> set of positions
+
+    def build(self, keys, vpndict):
+        """ Index keys (in display order) of vpndict """
+        tokens = []
+        for pos, key in enumerate(keys):
+            server = vpndict[key]
+            words = [server.country_short, server.ip, server.port, server.proto]
+            words += server.country_long.replace(',', ' ').split()
+            tokens += [(word, pos) for word in set(w.lower() for w in words if w)]
+        tokens.sort()
+
+        self.keys = keys
+        self.words = [token[0] for token in tokens]
+        self.positions = [token[1] for token in tokens]
+        self.cache = {}
+
+    def match(self, word):
+        """ Positions of servers having a token that starts with word """
+        if word not in self.cache:
+            lo = bisect_left(self.words, word)
+            hi = bisect_left(self.words, word + '\xff', lo)
+            self.cache[word] = set(self.positions[lo:hi])
+        return self.cache[word]
+
+    def find(self, query):
+        """ Keys matching every word of query, in display order """
+        if isinstance(query, unicode):
+            query = query.encode('utf-8')
+        words = query.lower().split()
+        if not words:
+            return list(self.keys)
+
+        found = self.match(words[0])
+        for word in words[1:]:
+            found = found & self.match(word)
+        return [self.keys[pos] for pos in sorted(found)]
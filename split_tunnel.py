@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = "duc_tin"
+__copyright__ = "Copyright 2015+, duc_tin"
+__license__ = "GPLv2"
+__version__ = "1.0"
+__maintainer__ = "duc_tin"
+__email__ = "nguyenbaduc.tin@gmail.com"
+
+import os
+import time
+import socket
+import struct
+from Queue import Queue, Empty
+from threading import Thread, Lock
+from netlink import ip_batch
+
+
+def to_range(cidr):
+    """ '10.0.0.0/8' -> (first, last) address as integers """
+    net, _, bits = cidr.partition('/')
+    bits = int(bits) if bits else 32
+    if not 0 <= bits <= 32:
+        raise ValueError('bad prefix length: ' + cidr)
+    mask = (0xffffffff << (32 - bits)) & 0xffffffff
+    start = struct.unpack('!I', socket.inet_aton(net))[0] & mask
+    return start, start | (~mask & 0xffffffff)
+
+
+def merge(ranges):
+    """ Sorted ranges with the overlapping and adjacent ones joined """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1] = merged[-1][0], end
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def to_cidrs(start, end):
+    """ The fewest prefixes that cover exactly start..end """
+    cidrs = []
+    while start <= end:
+        host_bits = 32
+        while host_bits and (start & ((1 << host_bits) - 1) or start + (1 << host_bits) - 1 > end):
+            host_bits -= 1
+        cidrs.append('%s/%d' % (socket.inet_ntoa(struct.pack('!I', start)), 32 - host_bits))
+        start += 1 << host_bits
+    return cidrs
+
+
+def exclude(cidrs, address):
+    """ cidrs with address cut out of the ones that hold it """
+    inside = to_range(address)[0]
+    result = []
+    for cidr in cidrs:
+        first, last = to_range(cidr)
+        if first <= inside <= last:
+            result += to_cidrs(first, inside - 1) + to_cidrs(inside + 1, last)
+        else:
+            result.append(cidr)
+    return result
+
+
+class SplitTunnel:
+    """ Send only some destinations through the tunnel
+
+        Rules are networks (CIDR), domains and country codes, from config.ini
+        and from an optional file with one rule per line ('country:jp' for a
+        country). They are compiled ahead of the connection on a worker thread:
+        domains are resolved in parallel, countries are read from
+        '<zone_dir>/<cc>.zone' files (one CIDR per line, eg: from ipdeny.com),
+        then everything is merged into the fewest prefixes. Once the tunnel is
+        up, apply() adds all of them with one 'ip -batch', and they go away
+        with the tun device.
+    """
+
+    def __init__(self, logger=None):
+        self.log = logger or (lambda msg: None)
+        self.enabled = False
+        self.rules = None  # (networks, domains, countries, zone_dir), what prefixes were compiled from
+        self.prefixes = []
+        self.compiler = None
+        self.lock = Lock()
+
+    def configure(self, enabled, networks, domains, countries, zone_dir, rules_file='', extra=()):
+        """ Set the rules, compile them in the background if they changed
+            :param extra: more networks, eg: the dns servers that must go through the tunnel too
+        """
+        self.enabled = enabled
+        if not enabled:
+            return
+        networks, domains, countries = self.split(networks), self.split(domains), self.split(countries)
+        networks += list(extra)
+        if rules_file:
+            self.read_rules(rules_file, networks, domains, countries)
+
+        rules = networks, domains, countries, zone_dir
+        with self.lock:
+            if rules == self.rules:
+                return
+            self.rules = rules
+        self.compiler = Thread(target=self.compile, args=rules)
+        self.compiler.daemon = True
+        self.compiler.start()
+
+    @staticmethod
+    def split(text):
+        return [word.strip().lower() for word in text.split(',') if word.strip()]
+
+    def read_rules(self, path, networks, domains, countries):
+        try:
+            with open(path) as f:
+                lines = f.read().splitlines()
+        except IOError as e:
+            self.log(' Split tunnel: %s' % e)
+            return
+        for line in lines:
+            rule = line.split('#')[0].strip().lower()
+            if rule.startswith('country:'):
+                countries.append(rule[8:].strip())
+            elif rule and rule[0].isdigit():
+                networks.append(rule)
+            elif rule:
+                domains.append(rule)
+
+    # ------------------------- compile ---------------------------
+    def compile(self, networks, domains, countries, zone_dir):
+        start = time.time()
+        cidrs = list(networks) + self.resolve(domains)
+        for code in countries:
+            try:
+                with open(os.path.join(zone_dir, code + '.zone')) as f:
+                    cidrs += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+            except IOError:
+                self.log(' Split tunnel: no zone file for country %s in %s' % (code, zone_dir))
+
+        ranges = []
+        for cidr in cidrs:
+            try:
+                ranges.append(to_range(cidr))
+            except (ValueError, socket.error):
+                self.log(' Split tunnel: skip bad network %s' % cidr)
+
+        prefixes = []
+        for first, last in merge(ranges):
+            prefixes += to_cidrs(first, last)
+        with self.lock:
+            if self.rules == (networks, domains, countries, zone_dir):  # not replaced meanwhile
+                self.prefixes = prefixes
+        self.log(' Split tunnel: %d rules compiled to %d prefixes in %.2fs' %
+                 (len(cidrs), len(prefixes), time.time() - start))
+
+    def resolve(self, domains, workers=16):
+        """ ipv4 addresses of every domain as /32, looked up by a few threads at once """
+        jobs, found = Queue(), []
+        for name in domains:
+            jobs.put(name)
+
+        def worker():
+            while True:
+                try:
+                    name = jobs.get_nowait()
+                except Empty:
+                    return
+                try:
+                    found.extend(addr + '/32' for addr in socket.gethostbyname_ex(name)[2])
+                except socket.error:
+                    self.log(' Split tunnel: cannot resolve %s' % name)
+
+        threads = [Thread(target=worker) for i in range(min(workers, len(domains)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return found
+
+    # ------------------------- apply -----------------------------
+    def apply(self, dev, peer=None):
+        """ Route every prefix through dev with a single 'ip -batch', :return: number of failed routes
+            :param peer: address openvpn talks to (server or proxy), never routed into its own tunnel
+        """
+        if self.compiler:
+            self.compiler.join()
+        with self.lock:
+            prefixes = self.prefixes
+        if peer:
+            try:
+                prefixes = exclude(prefixes, peer)
+            except socket.error:
+                self.log(' Split tunnel: cannot keep %s out of the routes, not an ipv4 address' % peer)
+        start = time.time()
+        failed = ip_batch(['route replace %s dev %s' % (prefix, dev) for prefix in prefixes])
+        self.log(' Split tunnel: %d routes via %s in %.3fs%s' % (len(prefixes), dev, time.time() - start,
+                                                                  ', %d failed' % failed if failed else ''))
+        return failed
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = "duc_tin"
+__copyright__ = "Copyright 2015+, duc_tin"
+__license__ = "GPLv2"
+__version__ = "1.0"
+__maintainer__ = "duc_tin"
+__email__ = "nguyenbaduc.tin@gmail.com"
+
+import os
+import shutil
+import tempfile
+import unittest
+from geoip import build, GeoDB, HEADER_SIZE
+
+SOURCE = '\n'.join([
+    '# range_start\trange_end\tAS_number\tcountry_code\tAS_description',
+    '1.0.0.0\t1.0.0.255\t13335\tUS\tCLOUDFLARENET',
+    '1.0.4.0\t1.0.7.255\t38803\tAU\tWirefreebroadband\tresidential\tMelbourne',
+    '1.0.16.0\t1.0.16.255\t2519\tJP\tARTERIA Networks Corporation\tunknown',
+    '1.0.1.0\t1.0.3.255\t0\tNone\tNot routed',
+    'not.an.ip\t1.0.8.255\t1\tXX\tbroken',
+    '1.0.9.0\t1.0.9.255',
+    '1.0.32.0\t1.0.63.255\t4134\tCN\tCHINANET-BACKBONE No.31,Jin-rong Street',
+    '1.0.64.0\t1.0.127.255\t18144\tJP\tEnecom,Inc.\tmobile\tHiroshima',
+]) + '\n'
+
+
+class TestGeoDB(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = None
+
+    def tearDown(self):
+        if self.db:
+            self.db.close()
+        shutil.rmtree(self.dir)
+
+    def build(self, source=SOURCE):
+        path = os.path.join(self.dir, 'source.tsv')
+        with open(path, 'w') as f:
+            f.write(source)
+        self.count = build(path, os.path.join(self.dir, 'geoip.bin'))
+        self.db = GeoDB(os.path.join(self.dir, 'geoip.bin'))
+        return self.db
+
+    def write(self, data):
+        path = os.path.join(self.dir, 'broken.bin')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_build_skips_bad_lines(self):
+        self.build()
+        self.assertEqual(self.count, 5)
+        self.assertEqual(self.db.count, 5)
+        self.assertIsNone(self.db.find('1.0.2.0'))  # 'Not routed' is left out
+
+    def test_type_and_city(self):
+        db = self.build()
+        self.assertEqual(db.find('1.0.0.1'), (13335, 'US', 'CLOUDFLARENET', 'datacenter', ''))
+        self.assertEqual(db.find('1.0.5.5'), (38803, 'AU', 'Wirefreebroadband', 'residential', 'Melbourne'))
+        self.assertEqual(db.find('1.0.16.1')[3], 'business')  # unknown type is guessed from the name
+        self.assertEqual(db.find('1.0.100.1'), (18144, 'JP', 'Enecom,Inc.', 'mobile', 'Hiroshima'))
+
+    def test_boundaries(self):
+        db = self.build()
+        for first, last, asn in [('1.0.0.0', '1.0.0.255', 13335), ('1.0.4.0', '1.0.7.255', 38803),
+                                 ('1.0.64.0', '1.0.127.255', 18144)]:
+            self.assertEqual(db.find(first)[0], asn)
+            self.assertEqual(db.find(last)[0], asn)
+
+    def test_gap_between_ranges(self):
+        db = self.build()
+        self.assertIsNone(db.find('1.0.1.0'))
+        self.assertIsNone(db.find('1.0.3.255'))
+        self.assertIsNone(db.find('1.0.17.0'))
+
+    def test_outside_all_ranges(self):
+        db = self.build()
+        self.assertIsNone(db.find('0.255.255.255'))
+        self.assertIsNone(db.find('0.0.0.0'))
+        self.assertIsNone(db.find('1.0.128.0'))
+        self.assertIsNone(db.find('255.255.255.255'))
+
+    def test_invalid_ip(self):
+        self.assertIsNone(self.build().find('not an ip'))
+
+    def test_empty_source(self):
+        db = self.build('')
+        self.assertEqual(self.count, 0)
+        self.assertIsNone(db.find('1.0.0.1'))
+
+    def test_empty_file(self):
+        self.assertRaises(ValueError, GeoDB, self.write(''))
+
+    def test_not_a_database(self):
+        self.assertRaises(ValueError, GeoDB, self.write('VGGEO1'))
+        self.assertRaises(ValueError, GeoDB, self.write('x' * 100))
+
+    def test_truncated_file(self):
+        self.build()
+        with open(self.db.path, 'rb') as f:
+            data = f.read()
+        for size in [HEADER_SIZE, HEADER_SIZE + 20, self.db.texts, len(data) - 1]:
+            self.assertRaises(ValueError, GeoDB, self.write(data[:size]))
+
+
+if __name__ == '__main__':
+    unittest.main()
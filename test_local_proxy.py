@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = "duc_tin"
+__copyright__ = "Copyright 2015+, duc_tin"
+__license__ = "GPLv2"
+__version__ = "1.0"
+__maintainer__ = "duc_tin"
+__email__ = "nguyenbaduc.tin@gmail.com"
+
+import errno
+import base64
+import socket
+import unittest
+from local_proxy import LocalProxy
+
+
+class TestHttpConnect(unittest.TestCase):
+    """ Handshake of LocalProxy.http over a socket pair, no tunnel: every connect fails with 502 """
+
+    def setUp(self):
+        self.proxy = LocalProxy(None, port=0)
+        self.slots = []
+
+        def connect(host, port, slot, turn):
+            self.slots.append(slot)
+            raise socket.error(errno.ENETUNREACH, 'no tunnel is up')
+        self.proxy.connect = connect
+
+    def tearDown(self):
+        self.proxy.sock.close()
+
+    def request(self, *headers):
+        client, server = socket.socketpair()
+        client.sendall('\r\n'.join(('CONNECT example.com:443 HTTP/1.1',) + headers) + '\r\n\r\n')
+        upstream = self.proxy.http(server, 0)
+        reply = client.recv(4096)
+        client.close()
+        server.close()
+        return upstream, reply
+
+    def test_slot_from_user_name(self):
+        upstream, reply = self.request('Proxy-Authorization: Basic ' + base64.b64encode('1:'))
+        self.assertEqual(self.slots, [1])
+        self.assertIsNone(upstream)
+        self.assertTrue(reply.startswith('HTTP/1.1 502'))
+
+    def test_basic_without_credentials(self):
+        _, reply = self.request('Proxy-Authorization: Basic')
+        self.assertEqual(self.slots, [None])
+        self.assertTrue(reply.startswith('HTTP/1.1 502'))
+
+    def test_credentials_not_base64(self):
+        _, reply = self.request('Proxy-Authorization: Basic abc')
+        self.assertEqual(self.slots, [None])
+        self.assertTrue(reply.startswith('HTTP/1.1 502'))
+
+    def test_other_scheme_is_ignored(self):
+        self.request('Proxy-Authorization: Bearer 1')
+        self.assertEqual(self.slots, [None])
+
+    def test_bad_request_line_is_counted(self):
+        client, server = socket.socketpair()
+        client.sendall('CONNECT\r\n\r\n')
+        self.proxy.handle(server, 0)
+        client.close()
+        self.assertEqual(self.slots, [])
+        self.assertEqual(self.proxy.stats['failed'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = "duc_tin"
+__copyright__ = "Copyright 2015+, duc_tin"
+__license__ = "GPLv2"
+__version__ = "1.0"
+__maintainer__ = "duc_tin"
+__email__ = "nguyenbaduc.tin@gmail.com"
+
+import socket
+import struct
+import unittest
+import netns
+from netns import query_a
+
+
+def name(host):
+    return ''.join(chr(len(label)) + label for label in host.split('.')) + '\0'
+
+
+def record(owner, kind, rdata):
+    return owner + struct.pack('!HHIH', kind, 1, 300, len(rdata)) + rdata
+
+
+def a(address):
+    return socket.inet_aton(address)
+
+
+POINTER = '\xc0\x0c'  # to the name in the question, right after the header
+
+
+class FakeUdp:
+    """ Stands in for the UDP socket of query_a, answers with reply(query) """
+    reply = None
+    sent = []
+
+    def __init__(self, *args):
+        pass
+
+    def settimeout(self, timeout):
+        pass
+
+    def sendto(self, data, address):
+        FakeUdp.sent.append((data, address))
+
+    def recv(self, size):
+        return FakeUdp.reply(FakeUdp.sent[-1][0])
+
+    def close(self):
+        pass
+
+
+class TestQueryA(unittest.TestCase):
+    def setUp(self):
+        self.socket = netns.socket.socket
+        netns.socket.socket = FakeUdp
+        FakeUdp.sent = []
+
+    def tearDown(self):
+        netns.socket.socket = self.socket
+
+    def answer(self, *records, **kwargs):
+        """ Reply to the query with records, keeping its id and question unless told otherwise """
+        def reply(query):
+            ident = kwargs.get('ident', struct.unpack('!H', query[:2])[0])
+            header = struct.pack('!HHHHHH', ident, 0x8180 | kwargs.get('rcode', 0), 1, len(records), 0, 0)
+            return header + query[12:] + ''.join(records)
+        FakeUdp.reply = staticmethod(reply)
+
+    def test_plain_a(self):
+        self.answer(record(POINTER, 1, a('93.184.216.34')))
+        self.assertEqual(query_a('example.com', '10.8.0.1'), '93.184.216.34')
+        query, address = FakeUdp.sent[0]
+        self.assertEqual(address, ('10.8.0.1', 53))
+        self.assertEqual(query[12:], name('example.com') + struct.pack('!HH', 1, 1))
+
+    def test_cname_then_a(self):
+        self.answer(record(POINTER, 5, name('cdn.example.net')),
+                    record(name('cdn.example.net'), 1, a('1.2.3.4')))
+        self.assertEqual(query_a('www.example.com', '10.8.0.1'), '1.2.3.4')
+
+    def test_owner_with_labels_then_pointer(self):
+        # www.example.com is asked, the answer is for cdn + a pointer to "example.com" in the question
+        owner = '\x03cdn' + struct.pack('!H', 0xc000 | 16)
+        self.answer(record(POINTER, 5, owner), record(owner, 1, a('5.6.7.8')))
+        self.assertEqual(query_a('www.example.com', '10.8.0.1'), '5.6.7.8')
+
+    def test_no_a_record(self):
+        self.answer(record(POINTER, 28, socket.inet_pton(socket.AF_INET6, '::1')))
+        self.assertIsNone(query_a('example.com', '10.8.0.1'))
+
+    def test_rcode_error(self):
+        self.answer(rcode=3)  # NXDOMAIN
+        self.assertIsNone(query_a('nowhere.example.com', '10.8.0.1'))
+
+    def test_mismatched_id(self):
+        def reply(query):
+            ident = struct.unpack('!H', query[:2])[0] ^ 1
+            return struct.pack('!HHHHHH', ident, 0x8180, 1, 1, 0, 0) + query[12:] + record(POINTER, 1, a('6.6.6.6'))
+        FakeUdp.reply = staticmethod(reply)
+        self.assertIsNone(query_a('example.com', '10.8.0.1'))
+
+    def test_truncated_packet(self):
+        self.answer(record(POINTER, 1, a('1.2.3.4'))[:8])  # cut inside the fixed part of the record
+        self.assertIsNone(query_a('example.com', '10.8.0.1'))
+        self.answer(record(POINTER, 5, name('cdn.example.net'))[:-4])  # and inside the data of a CNAME
+        self.assertIsNone(query_a('example.com', '10.8.0.1'))
+
+    def test_short_header(self):
+        FakeUdp.reply = staticmethod(lambda query: query[:6])
+        self.assertIsNone(query_a('example.com', '10.8.0.1'))
+
+    def test_bad_host_is_not_asked(self):
+        self.assertIsNone(query_a('a..b', '10.8.0.1'))
+        self.assertIsNone(query_a('x' * 64 + '.com', '10.8.0.1'))
+        self.assertEqual(FakeUdp.sent, [])
+
+    def test_no_answer(self):
+        def reply(query):
+            raise socket.timeout('timed out')
+        FakeUdp.reply = staticmethod(reply)
+        self.assertIsNone(query_a('example.com', '10.8.0.1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = "duc_tin"
+__copyright__ = "Copyright 2015+, duc_tin"
+__license__ = "GPLv2"
+__version__ = "1.0"
+__maintainer__ = "duc_tin"
+__email__ = "nguyenbaduc.tin@gmail.com"
+
+import socket
+import struct
+import unittest
+from split_tunnel import to_range, merge, to_cidrs, exclude
+
+
+def addr(text):
+    return struct.unpack('!I', socket.inet_aton(text))[0]
+
+
+class TestToRange(unittest.TestCase):
+    def test_network(self):
+        self.assertEqual(to_range('10.0.0.0/8'), (addr('10.0.0.0'), addr('10.255.255.255')))
+
+    def test_host_bits_are_dropped(self):
+        self.assertEqual(to_range('192.168.1.77/24'), (addr('192.168.1.0'), addr('192.168.1.255')))
+
+    def test_single_address(self):
+        self.assertEqual(to_range('1.2.3.4'), (addr('1.2.3.4'), addr('1.2.3.4')))
+        self.assertEqual(to_range('1.2.3.4/32'), (addr('1.2.3.4'), addr('1.2.3.4')))
+
+    def test_everything(self):
+        self.assertEqual(to_range('0.0.0.0/0'), (0, 0xffffffff))
+
+    def test_bad_input(self):
+        self.assertRaises(ValueError, to_range, '10.0.0.0/33')
+        self.assertRaises(socket.error, to_range, 'example.com/24')
+
+
+class TestMerge(unittest.TestCase):
+    def test_overlapping_and_adjacent(self):
+        self.assertEqual(merge([(20, 30), (1, 5), (6, 10), (8, 9), (25, 40)]), [(1, 10), (20, 40)])
+
+    def test_gap_is_kept(self):
+        self.assertEqual(merge([(1, 5), (7, 10)]), [(1, 5), (7, 10)])
+
+    def test_empty(self):
+        self.assertEqual(merge([]), [])
+
+
+class TestToCidrs(unittest.TestCase):
+    def test_aligned_network(self):
+        self.assertEqual(to_cidrs(*to_range('10.0.0.0/8')), ['10.0.0.0/8'])
+
+    def test_unaligned_range(self):
+        self.assertEqual(to_cidrs(addr('10.0.0.1'), addr('10.0.0.6')),
+                         ['10.0.0.1/32', '10.0.0.2/31', '10.0.0.4/31', '10.0.0.6/32'])
+
+    def test_everything(self):
+        self.assertEqual(to_cidrs(0, 0xffffffff), ['0.0.0.0/0'])
+
+    def test_empty(self):
+        self.assertEqual(to_cidrs(5, 4), [])
+
+    def test_round_trip(self):
+        ranges = merge([to_range(cidr) for cidr in ['1.0.0.0/24', '1.0.1.0/24', '1.0.3.7/32', '8.8.8.0/23']])
+        cidrs = []
+        for first, last in ranges:
+            cidrs += to_cidrs(first, last)
+        self.assertEqual(cidrs, ['1.0.0.0/23', '1.0.3.7/32', '8.8.8.0/23'])
+
+
+class TestExclude(unittest.TestCase):
+    def test_address_is_cut_out(self):
+        cidrs = exclude(['10.0.0.0/29', '8.8.8.8/32'], '10.0.0.5')
+        self.assertEqual(cidrs, ['10.0.0.0/30', '10.0.0.4/32', '10.0.0.6/31', '8.8.8.8/32'])
+
+    def test_whole_space_keeps_everything_else(self):
+        cidrs = exclude(['0.0.0.0/0'], '1.2.3.4')
+        self.assertEqual(merge([to_range(cidr) for cidr in cidrs]), [(0, addr('1.2.3.3')), (addr('1.2.3.5'), 0xffffffff)])
+
+    def test_outside(self):
+        self.assertEqual(exclude(['10.0.0.0/8'], '192.168.1.1'), ['10.0.0.0/8'])
+
+    def test_only_that_address(self):
+        self.assertEqual(exclude(['1.2.3.4/32'], '1.2.3.4'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
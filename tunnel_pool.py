@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = "duc_tin"
+__copyright__ = "Copyright 2015+, duc_tin"
+__license__ = "GPLv2"
+__version__ = "1.0"
+__maintainer__ = "duc_tin"
+__email__ = "nguyenbaduc.tin@gmail.com"
+
+import time
+import signal
+from Queue import Queue, Empty
+from subprocess import Popen, PIPE
+from threading import Thread
+from netlink import ip, ip_batch, tun_from_log, addr_from_log, ifconfig_from_push, dns_from_push, \
+    strip_time, delete_link
+from ovpn_config import OvpnConfig, write_runtime, remove_runtime
+from vpn_events import server_info
+import netns
+
+MAX_TUNNELS = 16
+CONNECT_TIMEOUT = 40  # seconds for a tunnel to come up before it is replaced
+RETRY_AFTER = 300  # seconds before a server that failed is tried again
+
+# ip rule priorities, lower is looked up first
+PRIO_TO = 20000  # openvpn's own packets to the servers and the proxy go the normal way
+PRIO_FROM = 20100  # + slot, packets from a tunnel's address leave by that tunnel
+PRIO_MAIN = 20500  # lan and other specific routes of the main table still win
+PRIO_BALANCE = 20600  # everything else takes the multipath default route
+
+HASH_POLICY = '/proc/sys/net/ipv4/fib_multipath_hash_policy'  # 1: hash on ports too
+
+FAILURES = ['Restart pause, ', 'Cannot resolve', 'Connection timed out', 'SIGTERM', 'Exiting due']
+
+
+class Tunnel:
+    """ One openvpn process of a TunnelPool, with its own tun device and routing table """
+
+    def __init__(self, server, slot, table):
+        """ :type server: vpn_core.Server """
+        self.server = server
+        self.slot = slot
+        self.table = table
+        self.process = None
+        self.queue = None
+        self.file = None
+        self.dev = None
+        self.addr = None  # local address of dev
+        self.ifconfig = None  # (local address, netmask or peer) pushed by the server
+        self.dns = []  # DNS servers pushed by the server
+        self.netns = None  # namespace of dev when the pool isolates its tunnels
+        self.state = 'connecting'  # connecting, up, failed
+        self.start = time.time()
+        self.up_time = 0
+        self.reason = ''
+
+    def spawn(self, config, output, notify):
+        self.file = write_runtime(config, self.server.ip)
+        self.process = Popen(['openvpn', '--config', self.file], stdout=PIPE, stderr=PIPE, bufsize=1, close_fds=True)
+        self.queue = Queue()
+        t = Thread(target=output, args=(self.process.stdout, self.queue, notify))
+        t.daemon = True
+        t.start()
+
+    def feed(self, line):
+        """ Follow one line of openvpn output, :return: the new state if it changed """
+        if 'TUN/TAP device' in line:
+            self.dev = tun_from_log(line) or self.dev
+        self.addr = self.addr or addr_from_log(line)
+        pushed = ifconfig_from_push(line)
+        if pushed:
+            self.ifconfig = pushed
+            self.addr = self.addr or pushed[0]
+        self.dns = self.dns or dns_from_push(line)
+
+        if 'Initialization Sequence Completed' in line:
+            if not self.dev:
+                return self.fail('no tun device')
+            self.state, self.up_time = 'up', time.time()
+            return 'up'
+        if [text for text in FAILURES if text in line] or 'ERROR' in line and 'add command failed' not in line:
+            return self.fail(strip_time(line))
+        return None
+
+    def fail(self, reason):
+        self.state, self.reason = 'failed', reason
+        return 'failed'
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.send_signal(signal.SIGINT)
+            self.process.wait()
+        remove_runtime(self.file)
+        self.file = None
+        if self.dev and not self.netns:  # names in a namespace may be in use again on the host
+            delete_link(self.dev)
+
+    def info(self):
+        return {'slot': self.slot, 'state': self.state, 'dev': self.dev, 'addr': self.addr, 'table': self.table,
+                'netns': self.netns,
+                'since': round(self.up_time or self.start, 3), 'server': server_info(self.server)}
+
+
+class TunnelPool:
+    """ Keep several tunnels to different top ranked servers and spread flows across them
+
+        Tunnels ignore the routes pushed by their server. Each one gets routing
+        table 'table + 1 + slot' and a rule for its own address, and the up ones
+        share a multipath default route in table 'table', so the kernel hashes
+        every flow (addresses and ports) to one of them. A tunnel that fails or
+        does not come up in time is replaced by the next unused server of
+        Connection.sorted, the others are not touched.
+
+        With isolate, every tunnel lives in its own network namespace
+        (netns.ns_name(slot)) with its own resolv.conf instead, and the host's
+        routes and DNS are left alone. Programs use a tunnel by running in its
+        namespace: 'ip netns exec vpngate0 <command>'.
+
+        check() must be called often by the front end, like vpn_checker().
+    """
+
+    def __init__(self, connection, table=200):
+        """ :type connection: vpn_core.Connection """
+        self.ovpn = connection
+        self.table = table
+        self.size = 0  # wanted number of tunnels, 0 when the pool is off
+        self.tunnels = {}  # slot -> Tunnel
+        self.failed = {}  # ip -> time it failed
+        self.routed = []  # devices in the multipath route now, namespaces of the up tunnels when isolated
+        self.hash_policy = None  # original sysctl value, restored by stop()
+        self.isolate = False  # one namespace per tunnel instead of the multipath route
+
+    # ------------------------- control ---------------------------
+    def start(self, size, isolate=False):
+        size = min(size, MAX_TUNNELS)
+        if self.size and isolate != self.isolate:
+            self.stop()
+        if not self.size:
+            self.isolate = isolate
+            self.flush()
+            if not isolate:
+                self.hash_policy = self.sysctl(HASH_POLICY, '1')
+                if self.ovpn.use_proxy == 'yes':
+                    ip('rule', 'add', 'to', self.ovpn.ip, 'lookup', 'main', 'priority', str(PRIO_TO))
+        self.size = size
+        for slot in [s for s in self.tunnels if s >= size]:
+            self.drop(slot, 'pool shrunk')
+        self.ovpn.log(' %s %d tunnels' % ('Isolating' if isolate else 'Balancing over', size))
+        self.check()
+
+    def stop(self):
+        if not self.size and not self.tunnels:
+            return
+        self.size = 0
+        for slot in self.tunnels.keys():
+            self.drop(slot, 'stopped')
+        self.route()
+        self.flush()
+        if self.hash_policy is not None:
+            self.sysctl(HASH_POLICY, self.hash_policy)
+            self.hash_policy = None
+
+    def check(self):
+        """ Read openvpn output of every tunnel, replace the dead ones and fill empty slots """
+        if not self.size and not self.tunnels:
+            return
+
+        for slot, t in self.tunnels.items():
+            for i in range(20):
+                try:
+                    when, line = t.queue.get_nowait()
+                except Empty:
+                    break
+                state = t.feed(line)
+                if state == 'up':
+                    self.up(t)
+                if t.state == 'failed':
+                    break
+
+            if t.state == 'connecting' and time.time() - t.start > CONNECT_TIMEOUT:
+                t.fail('no tunnel after %ds' % CONNECT_TIMEOUT)
+            elif t.state != 'failed' and t.process.poll() is not None:
+                t.fail('openvpn exited')
+            if t.state == 'failed':
+                self.failed[t.server.ip] = time.time()
+                self.drop(slot, t.reason)
+
+        self.route()
+        for slot in range(self.size):
+            if slot not in self.tunnels:
+                server = self.pick()
+                if not server:
+                    break
+                self.spawn(slot, server)
+
+    def status(self):
+        return [self.tunnels[slot].info() for slot in sorted(self.tunnels)]
+
+    # ------------------------- tunnels ---------------------------
+    def pick(self):
+        """ Best server of the sorted list that is not in use and did not fail lately """
+        in_use = set(t.server.ip for t in self.tunnels.values())
+        now = time.time()
+        for key in list(self.ovpn.sorted):
+            server = self.ovpn.vpndict.get(key)
+            if server and server.ip not in in_use and now - self.failed.get(server.ip, 0) > RETRY_AFTER:
+                return server
+        return None
+
+    def spawn(self, slot, server):
+        ovpn = self.ovpn
+        cfg = OvpnConfig(server.build_config(ovpn.use_proxy, ovpn.ip, ovpn.port))
+        cfg.set('route-nopull')  # routes are ours, see up()
+        t = Tunnel(server, slot, self.table + 1 + slot)
+
+        if self.isolate:
+            cfg.set('ifconfig-noexec')  # the address is set inside the namespace
+            t.netns = netns.ns_name(slot)
+            # with dns_fix the namespace gets our list now, else what the server pushes, see up()
+            netns.create(t.netns, self.dns_list() if ovpn.dns_fix == 'yes' else [])
+        else:
+            # must be in place before any multipath route can catch openvpn's packets
+            ip('rule', 'add', 'to', server.ip, 'lookup', 'main', 'priority', str(PRIO_TO))
+        t.spawn(cfg.render(), ovpn.vpn_output, ovpn.notify)
+        self.tunnels[slot] = t
+        ovpn.log(' Tunnel %d: connecting to %s %s' % (slot, server.country_short, server.ip))
+        ovpn.events.pool('connecting', slot=slot, server=server_info(server))
+
+    def up(self, t):
+        if t.netns:
+            if not t.ifconfig or not netns.attach(t.netns, t.dev, *t.ifconfig):
+                t.fail('cannot set up %s in %s' % (t.dev, t.netns))
+                return
+            if self.ovpn.dns_fix != 'yes':
+                if not t.dns:
+                    self.ovpn.log(' Tunnel %d: no DNS pushed, using the DNS list' % t.slot)
+                netns.set_dns(t.netns, t.dns or self.dns_list())
+            self.ovpn.log(' Tunnel %d: up in namespace %s after %.2fs' % (t.slot, t.netns, t.up_time - t.start))
+        else:
+            commands = ['route replace default dev %s table %d' % (t.dev, t.table)]
+            if t.addr:
+                commands.append('rule add from %s lookup %d priority %d' % (t.addr, t.table, PRIO_FROM + t.slot))
+            ip_batch(commands)
+            self.ovpn.log(' Tunnel %d: up on %s after %.2fs' % (t.slot, t.dev, t.up_time - t.start))
+        self.ovpn.events.pool('up', slot=t.slot, dev=t.dev, netns=t.netns, server=server_info(t.server),
+                              elapsed=round(t.up_time - t.start, 3))
+
+    def drop(self, slot, reason):
+        t = self.tunnels.pop(slot)
+        if not t.netns:
+            commands = ['route flush table %d' % t.table, 'rule del to %s lookup main priority %d' % (t.server.ip, PRIO_TO)]
+            if t.addr:
+                commands.append('rule del from %s lookup %d priority %d' % (t.addr, t.table, PRIO_FROM + slot))
+            ip_batch(commands)
+        self.route(exclude=t)  # stop sending flows to it before it goes away
+        t.stop()
+        if t.netns:
+            netns.destroy(t.netns)
+        self.ovpn.log(' Tunnel %d: closed, %s' % (slot, reason))
+        self.ovpn.events.pool('down', slot=slot, reason=reason, server=server_info(t.server),
+                              duration=round(time.time() - t.up_time, 3) if t.up_time else 0)
+
+    # ------------------------- routing ---------------------------
+    def route(self, exclude=None):
+        """ Point the multipath default route at the tunnels that are up, but exclude """
+        up = [t for slot, t in sorted(self.tunnels.items()) if t.state == 'up' and t is not exclude]
+        devs = [t.netns or t.dev for t in up]
+        if devs == self.routed:
+            return
+        if self.isolate:
+            self.ovpn.messages.set('status', '%d isolated tunnel(s) up' % len(devs), ', '.join(devs) or ' ')
+            self.routed = devs
+            return
+
+        if devs:
+            nexthops = ' '.join('nexthop dev %s weight 1' % dev for dev in devs)
+            commands = ['route replace default table %d %s' % (self.table, nexthops)]
+            if not self.routed:
+                commands += ['rule add lookup main suppress_prefixlength 0 priority %d' % PRIO_MAIN,
+                             'rule add lookup %d priority %d' % (self.table, PRIO_BALANCE)]
+            ip_batch(commands)
+            if not self.routed:
+                self.dns('change', devs[0])
+            self.ovpn.messages.set('status', 'Balancing over %d tunnel(s)' % len(devs), ', '.join(devs))
+        else:
+            ip_batch(['rule del priority %d' % PRIO_BALANCE, 'rule del priority %d' % PRIO_MAIN,
+                      'route flush table %d' % self.table])
+            self.dns('restore')
+            self.ovpn.messages.set('status', 'No balanced tunnel is up', ' ')
+        self.routed = devs
+
+    def dns(self, action, dev=None):
+        ovpn = self.ovpn
+        if ovpn.dns_fix != 'yes':
+            return
+        if action == 'change':
+            ovpn.resolv.submit('change', self.dns_list(), dev)
+        else:
+            ovpn.resolv.submit('restore')
+
+    def dns_list(self):
+        return self.ovpn.dns.replace(' ', '').split(',')
+
+    def flush(self):
+        """ Remove our rules and namespaces, also the ones left by a crashed run """
+        for name in netns.existing():
+            netns.destroy(name)
+        p = Popen(['ip', 'rule', 'show'], stdout=PIPE, stderr=PIPE)
+        out, _ = p.communicate()
+        rules = [line.split(':', 1) for line in out.splitlines() if ':' in line]
+        ip_batch(['rule del priority %s %s' % (prio, rule.strip()) for prio, rule in rules
+                  if prio.isdigit() and PRIO_TO <= int(prio) <= PRIO_BALANCE])
+
+    @staticmethod
+    def sysctl(path, value):
+        """ Set a sysctl through /proc, :return: the old value or None if not possible """
+        try:
+            with open(path) as f:
+                old = f.read().strip()
+            with open(path, 'w') as f:
+                f.write(value)
+            return old
+        except IOError:
+            return None
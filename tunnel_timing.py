@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = "duc_tin"
+__copyright__ = "Copyright 2015+, duc_tin"
+__license__ = "GPLv2"
+__version__ = "1.0"
+__maintainer__ = "duc_tin"
+__email__ = "nguyenbaduc.tin@gmail.com"
+
+import json
+import time
+from collections import OrderedDict
+
+# marks set from openvpn output: (mark, text in the line), the first match wins
+MARKERS = [('connect', 'TCP connection established'),
+           ('connect', 'link remote:'),
+           ('proxy', 'HTTP proxy returned'),
+           ('tls', 'Peer Connection Initiated'),
+           ('push', 'PUSH: Received control message'),
+           ('device', 'TUN/TAP device'),
+           ('routes', 'Initialization Sequence Completed')]
+
+# each phase lasts from the previous mark that is present to its own mark
+PHASES = ['config', 'spawn', 'connect', 'proxy', 'tls', 'push', 'device', 'routes']
+# run in parallel once the tunnel is up, measured from 'routes'
+AFTER_UP = ['dns', 'hooks', 'split']
+
+
+class ConnectTimeline:
+    """ Where the time to a working tunnel went, for one vpn_connect()
+
+        config : render and write the openvpn config
+        spawn  : start openvpn
+        connect: tcp connection or udp link to the server (or to the proxy)
+        proxy  : CONNECT answered by the http proxy
+        tls    : tls handshake with the server
+        push   : options pushed by the server
+        device : tun device opened
+        routes : routes set up, up to 'Initialization Sequence Completed'
+        dns, hooks, split: dns switch, post-up hooks and split tunnel routes, after the tunnel is up
+    """
+
+    def __init__(self, server, proxy=None):
+        """
+        :type server: vpn_core.Server
+        :param proxy: 'ip:port' of the http proxy, None if not used
+        """
+        self.server = {'ip': server.ip, 'country': server.country_short, 'proto': server.proto,
+                       'port': server.port}
+        self.proxy = proxy
+        self.start = time.time()
+        self.marks = {}
+
+    def mark(self, name, when=None):
+        if name not in self.marks:
+            self.marks[name] = when or time.time()
+
+    def feed(self, line, when):
+        """ Set the marks found in a line of openvpn output that arrived at 'when' """
+        for name, text in MARKERS:
+            if name not in self.marks and text in line:
+                self.marks[name] = when
+
+    def phases(self):
+        result = OrderedDict()
+        last = self.start
+        for name in PHASES:
+            if name in self.marks:
+                result[name] = round(self.marks[name] - last, 3)
+                last = self.marks[name]
+        for name in AFTER_UP:
+            if name in self.marks and 'routes' in self.marks:
+                result[name] = round(self.marks[name] - self.marks['routes'], 3)
+        return result
+
+    def total(self):
+        return round(self.marks['routes'] - self.start, 3) if 'routes' in self.marks else None
+
+    def summary(self):
+        phases = ' '.join('%s %.2f' % item for item in self.phases().items())
+        if self.total() is None:
+            return ' No tunnel after %.2fs: %s' % (time.time() - self.start, phases)
+        return ' Time to tunnel %.2fs: %s' % (self.total(), phases)
+
+    def save(self, path, result):
+        """ Append this connection as one JSON line to path, result is how it ended """
+        record = {'time': round(self.start, 3), 'server': self.server, 'proxy': self.proxy, 'result': result,
+                  'total': self.total(), 'phases': self.phases()}
+        try:
+            with open(path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        except IOError:
+            pass
@@ -318,3 +318,53 @@ class AddPopUp(urwid.PopUpLauncher):
         self.result = button.chosen
         self.close_pop_up()
         self._emit('done', self.trigger)
+
+
+class ServerList(urwid.ListBox):
+    """ ListBox that never takes the keyboard, so typing always goes to the command box.
+        Display scrolls it itself on up/down.
+    """
+    _selectable = False
+
+
+class ServerWalker(urwid.ListWalker):
+    """ Rows of the server table, a row widget is only built when urwid shows it
+
+        keys: server names in display order
+        make_row(position, key): return the widget of that row
+    """
+
+    def __init__(self, make_row, cache_size=256):
+        self.keys = []
+        self.make_row = make_row
+        self.cache_size = cache_size
+        self.rows = {}  # position -> widget, for rows that have been on screen
+        self.focus = 0
+
+    def set_data(self, keys):
+        self.keys = keys
+        self.rows.clear()
+        self.focus = min(self.focus, max(len(keys) - 1, 0))
+        self._modified()
+
+    def row(self, position):
+        if not 0 <= position < len(self.keys):
+            return None, None
+        if position not in self.rows:
+            if len(self.rows) >= self.cache_size:
+                self.rows.clear()
+            self.rows[position] = self.make_row(position, self.keys[position])
+        return self.rows[position], position
+
+    def get_focus(self):
+        return self.row(self.focus)
+
+    def set_focus(self, position):
+        self.focus = position
+        self._modified()
+
+    def get_next(self, position):
+        return self.row(position + 1)
+
+    def get_prev(self, position):
+        return self.row(position - 1)
@@ -0,0 +1,727 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = "duc_tin"
+__copyright__ = "Copyright 2015+, duc_tin"
+__license__ = "GPLv2"
+__version__ = "1.4"
+__maintainer__ = "duc_tin"
+__email__ = "nguyenbaduc.tin@gmail.com"
+
+import os, sys, signal
+import base64
+import time
+import datetime
+from config import *
+from Queue import Queue, Empty
+from subprocess import call, Popen, PIPE
+from threading import Thread
+from resolv_manager import ResolvManager
+from hook_runner import HookRunner
+from netlink import tun_from_log, delete_link
+from ovpn_config import OvpnConfig, write_runtime, remove_runtime
+from vpn_events import EventStream, server_info
+from message_bus import MessageBus
+from profiler import profiler
+from tunnel_timing import ConnectTimeline
+from tunnel_pool import TunnelPool
+from local_proxy import LocalProxy
+from split_tunnel import SplitTunnel
+from geoip import GeoDB
+
+# Threading
+ON_POSIX = 'posix' in sys.builtin_module_names
+
+# Define some mirrors of vpngate.net
+mirrors = ["http://www.vpngate.net"]  # add your mirrors to config.ini file, not here
+
+
+# TODO: add user manual to this and can be access by h, help. It may never be done, reads the README file instead
+
+
+class Server:
+    def __init__(self, data):
+        self.ip = data[1]
+        self.score = int(data[2])
+        self.ping = int(data[3]) if data[3] != '-' else 'inf'
+        self.speed = int(data[4])
+        self.country_long = data[5]
+        self.country_short = data[6]
+        self.NumSessions = data[7]
+        self.uptime = data[8]
+        self.logPolicy = data[11]
+        self.config_data = base64.b64decode(data[-1])
+        self.proto = 'tcp' if '\r\nproto tcp\r\n' in self.config_data else 'udp'
+        port = re.findall('remote .+ \d+', self.config_data)
+        if not port:
+            self.port = '0'
+        else:
+            self.port = port[0].split()[-1]
+        self.rendered = {}  # final config per (use_proxy, proxy, port, split)
+        self._cells = None
+        self.asn = self.as_name = self.net_type = self.city = None  # set by GeoDB.enrich
+
+    def build_config(self, use_proxy='no', proxy=None, port=None, split=False):
+        key = use_proxy, proxy, port, split
+        if key not in self.rendered:
+            cfg = OvpnConfig(self.config_data)
+            if use_proxy == 'yes':
+                cfg.set('http-proxy-retry', 3)
+                cfg.set('http-proxy', proxy, port)
+            if split:
+                cfg.set('route-nopull')  # SplitTunnel adds the routes
+
+            cfg.set('keepalive', 5, 30)  # prevent connection drop due to inactivity timeout
+            if self.proto == 'tcp':
+                cfg.set('connect-retry', 2)
+            cfg.set('resolv-retry', 2)
+            self.rendered[key] = cfg.render()
+
+        return self.rendered[key]
+
+    def write_file(self, use_proxy='no', proxy=None, port=None, split=False):
+        """ :return: path of a private config file for this connection only """
+        return write_runtime(self.build_config(use_proxy, proxy, port, split), self.ip)
+
+    def cells(self):
+        """ Text of each column in the server table, formatted once """
+        if self._cells is None:
+            speed = self.speed / 1000. ** 2
+            uptime = datetime.timedelta(milliseconds=int(self.uptime))
+            uptime = re.split(',|\.', str(uptime))[0]
+            self._cells = (self.country_short, str(self.ping), '%.2f' % speed, uptime, self.logPolicy,
+                           str(self.score), self.proto, self.port)
+        return self._cells
+
+    def __str__(self):
+        spaces = [6, 7, 6, 10, 10, 10, 10, 8, 8]
+        txt = [dta.center(spaces[ind + 1]) for ind, dta in enumerate(self.cells())]
+        return ''.join(txt)
+
+    def __repr__(self):
+        speed = self.speed / 1000. ** 2
+        uptime = datetime.timedelta(milliseconds=int(self.uptime))
+        # uptime = re.split(',|\.', str(uptime))[0]
+        uptime = str(uptime)[:-7]
+        txt = [self.country_long.strip('of'), self.ip, str(self.ping), '%.2f' % speed, uptime, self.NumSessions,
+               self.logPolicy, str(self.score), self.proto, self.port]
+        return ';'.join(txt)
+
+
+class Connection:
+    remote = False  # see vpn_remote.RemoteConnection
+
+    def __init__(self):
+        self.path = os.path.realpath(sys.argv[0])
+        self.user_home = sys.argv[1]
+        self.config_file = sys.argv[1] + '/.config/vpngate-with-proxy/config.ini'
+        self.user_script_file = sys.argv[1] + '/.config/vpngate-with-proxy/user_script.sh'
+        self.cfg = Setting(self.config_file)
+        self.args = sys.argv[2:]
+        self.debug = []
+        self.dropped_time = 0
+        self.max_retry = 3
+
+        self.vpndict = {}
+        self.filters = {'Country': 'all', 'Port': 'all'}
+        self.sorted = []
+
+        self.vpn_server = None
+        self.vpn_process = None
+        self.vpn_queue = None
+        self.vpn_file = None  # config of the current openvpn, under ovpn_config.RUNTIME_DIR
+        self.tun_dev = None  # tun device opened by our openvpn, learnt from its output
+        self.is_connected = 0  # 0: not, 1: connecting, 2: connected
+        self.connect_time = self.up_time = self.spawn_time = 0
+        self.timeline = None  # ConnectTimeline of the current connection
+        self.timings_file = os.path.dirname(self.config_file) + '/connect_times.jsonl'
+        self.kill = False
+        self.get_limit = 1
+        self.wakeup = None  # set by the front end, called from any thread when there is news
+
+        # use for probing
+        self.test_timeout = 2
+        self.test_interval = 0.25
+
+        self.connected_servers = []
+        self.connected_set = set()  # the same ips, for fast lookup
+        self.messages = MessageBus()
+        self.messages.add_lines('country', 1)
+        self.messages.add_lines('status', 2)
+        self.messages.add_queue('debug', 200)
+
+        # get proxy from config file
+        if not os.path.exists(self.config_file):
+            self.first_config()
+
+        # make sure there are symlink files of them in this script's directory
+        if not os.path.exists("config.ini"):
+            os.symlink(self.config_file, "config.ini")
+
+        if not os.path.exists("user_script.sh"):
+            call(["cp", "user_script.sh.tmp", self.user_script_file])
+            os.symlink(self.user_script_file, "user_script.sh")
+
+        self.cfg.load()
+        self.resolv = ResolvManager(self.cfg.dns['backend'], logger=self.log)
+        self.hooks = HookRunner('user_script.sh', logger=self.log)
+        self.events = EventStream()  # publisher is plugged in by the front end
+        self.pool = TunnelPool(self)  # several tunnels at once, driven by the daemon
+        self.local_proxy = None  # LocalProxy, started by the front end
+        self.split = SplitTunnel(logger=self.log)
+        self.geo = None  # GeoDB, when a database is set in [geoip]
+        if len(self.args):
+            # process commandline arguments
+            if self.args[0] in ['r', 'restore']:
+                self.dns_manager('restore')
+            else:
+                get_input(self.cfg, self.args)
+
+        self.use_proxy, self.proxy, self.port, self.ip = [''] * 4
+        self.sort_by, self.filters, self.dns_fix, self.dns = [''] * 4
+        self.verbose = ''
+        self.reload()
+
+    def reload(self):
+        mirrors.extend(url for url in self.cfg.mirror['url'].split(', ') if url not in mirrors)  # reloaded often
+        self.use_proxy, self.proxy, self.port, self.ip = self.cfg.proxy.values()
+        self.sort_by = self.cfg.sort.values()[0]
+        self.filters = self.cfg.filter
+        self.dns_fix, self.dns = self.cfg.dns['fix_dns'], self.cfg.dns['dns']
+        self.resolv.backend = self.cfg.dns['backend']
+        self.verbose = self.cfg.openvpn.values()[0]
+        self.hooks.set_timeout(self.cfg.hooks['timeout'])
+        self.hooks.hooks_dir = self.cfg.hooks['hooks_dir'] or os.path.dirname(self.config_file) + '/hooks.d'
+        self.events.path = self.cfg.monitor['event_log']
+        self.pool.table = int(self.cfg.balance['table'])
+        split = self.cfg.split
+        dns = self.dns.replace(' ', '').split(',') if self.dns_fix == 'yes' else []
+        self.split.configure(split['enabled'] == 'yes', split['networks'], split['domains'], split['countries'],
+                             split['zone_dir'] or os.path.dirname(self.config_file) + '/zones', split['rules_file'],
+                             extra=[ip for ip in dns if ip])  # the fixed dns must not leak either
+        profiler.enabled = profiler.enabled or self.cfg.monitor['profile'] == 'yes'
+        if self.cfg.geoip['database'] != (self.geo.path if self.geo else ''):
+            self.geo = self.open_geo(self.cfg.geoip['database'])
+
+    def open_geo(self, path):
+        if self.geo:
+            self.geo.close()
+        if not path:
+            return None
+        try:
+            return GeoDB(path)
+        except (EnvironmentError, ValueError) as e:
+            self.log(' GeoIP database: %s' % e)
+            return None
+
+    def start_local_proxy(self):
+        """ SOCKS5/HTTP CONNECT proxy into the tunnel, when 'listen' is set in [local_proxy] """
+        listen = self.cfg.local_proxy['listen']
+        if not listen:
+            return None
+        host, _, port = listen.rpartition(':')
+        try:
+            self.local_proxy = LocalProxy(self, host or '127.0.0.1', int(port),
+                                          hold=int(self.cfg.local_proxy['hold'])).start()
+        except (socket.error, ValueError) as e:
+            self.log(' Local proxy on %s failed: %s' % (listen, e))
+            return None
+        self.log(' Local proxy on %s:%d' % self.local_proxy.address)
+        return self.local_proxy
+
+    def notify(self):
+        if self.wakeup:
+            self.wakeup()
+
+    def log(self, msg):
+        self.messages.put('debug', msg)
+        self.notify()
+
+    def rewrite(self, section, **contents):
+        for key in contents:
+            self.cfg.sections[section][key] = contents[key]
+        self.cfg.write()
+        self.reload()
+
+    def first_config(self):
+        if not os.path.exists(self.user_home + '/.config/vpngate-with-proxy'):
+            os.makedirs(self.user_home + '/.config/vpngate-with-proxy')
+
+        print '\n' + '_' * 12 + ctext(' First time config ', 'gB') + '_' * 12 + '\n'
+        self.cfg.proxy['use_proxy'] = 'no' if raw_input(
+            ctext('Do you need proxy to connect? ', 'B') + '(yes|[no]):') in 'no' else 'yes'
+
+        if self.cfg.proxy['use_proxy'] == 'yes':
+            proxy = port = ip = ''
+            useit = 'no'
+
+            if "http_proxy" in os.environ:
+                proxy, port = os.environ['http_proxy'].strip('/').split('//')[1].split(':')
+
+                ip = socket.gethostbyname(proxy)
+            elif "HTTP_PROXY" in os.environ:
+                proxy, port = os.environ['http_proxy'].strip('/').split('//')[1].split(':')
+                ip = socket.gethostbyname(proxy)
+
+            if proxy:
+                print ' You are using proxy: ' + ctext('%s:%s' % (proxy, port), 'bB')
+                useit = 'yes' if raw_input(
+                    ctext(' Use this proxy? ', 'B') + '([yes]|no):') in 'yes' else 'no'
+
+            if useit == 'no':
+                print ' Input your http proxy address and port without including "http://" \nsuch as ' \
+                      + ctext('www.abc.com:8080', 'pB')
+                while 1:
+                    try:
+                        proxy, port = raw_input(' Your\033[95m proxy:port \033[0m: ').split(':')
+                        ip = socket.gethostbyname(proxy)
+                        port = port.strip()
+                        if not 0 <= int(port) <= 65535:
+                            raise ValueError
+                    except ValueError:
+                        print ctext(' Error: Http proxy must in format ', 'r') + ctext('address:port', 'B')
+                        print ' Where ' + ctext('address', 'B') + ' is in form of www.abc.com or 123.321.4.5'
+                        print '       ' + ctext('port', 'B') + ' is a number in range 0-65535'
+                    else:
+                        break
+
+            self.cfg.proxy['address'] = proxy
+            self.cfg.proxy['port'] = port
+            self.cfg.proxy['ip'] = ip
+
+        get_input(self.cfg, 'config')
+        print '\n' + '_' * 12 + ctext(' Config done', 'gB') + '_' * 12 + '\n'
+
+    def get_csv(self, url, queue, proxy={}):
+        import requests  # may be installed by the launcher after this module is loaded
+        self.log(' using gate: ' + url)
+        # self.log(str(proxy))
+        try:
+            gate = url + '/api/iphone/'
+            with profiler.span('fetch', url=url):
+                vpn_data = requests.get(gate, proxies=proxy, timeout=3).text.replace('\r', '')
+            with profiler.span('parse'):
+                servers = [line.split(',') for line in vpn_data.split('\n')]
+            if servers[0][0] == '*vpn_servers':
+                with profiler.span('servers', rows=len(servers) - 2):
+                    vpndict = {s[0]: Server(s) for s in servers[2:] if len(s) > 1}
+                self.log(' gate ' + url + ': success')
+                queue.put((1, vpndict))
+            else:
+                self.log(' Received WRONG data file')
+                self.log(' Connection to gate ' + url + ' failed')
+                self.log(vpn_data)
+                queue.put((0, {}))
+
+        except requests.exceptions.ConnectTimeout as e:
+            self.log('ConnectionTimeout')
+            self.log(' Connection to gate ' + url + ' failed')
+            queue.put((0, {}))
+        except requests.exceptions.ConnectionError as e:
+            self.log('ConnectionError')
+            self.log(' Connection to gate ' + url + ' failed')
+            queue.put((0, {}))
+        except requests.exceptions.RequestException as e:
+            self.log(str(e))
+            self.log(' Connection to gate ' + url + ' failed')
+            queue.put((0, {}))
+
+    def get_data(self):
+        if self.use_proxy == 'yes':
+            self.log(' Pinging proxy... ')
+            ping_name = ['ping', '-w 2', '-c 2', '-W 2', self.proxy]
+            ping_ip = ['ping', '-w 2', '-c 2', '-W 2', self.ip]
+            res1, err1 = Popen(ping_name, stdout=PIPE, stderr=PIPE).communicate()
+            res2, err2 = Popen(ping_ip, stdout=PIPE, stderr=PIPE).communicate()
+
+            if err1 and not err2:
+                self.log(' Pinging proxy... [failed]')
+                self.log(" Warning: Cannot resolve proxy's hostname. Use last known IP")
+                self.proxy = self.ip
+            elif err1 and err2:
+                self.log(' Pinging proxy... [failed]')
+                self.log('  Ping proxy got error: ' + err1)
+                self.log('  Check your proxy setting')
+            elif not err1 and '100% packet loss' in res1:
+                self.log(' Pinging proxy... [dead]')
+                self.log(' Warning: Proxy not response to ping')
+                self.log(" Either proxy's security does not allow it to response to "
+                                                  "ping packet or proxy itself is dead")
+            else:
+                self.log(' Pinging proxy... [alive]')
+                self.ip = socket.gethostbyname(self.proxy)
+
+            proxies = {
+                'http': 'http://' + self.ip + ':' + self.port,
+                'https': 'https://' + self.ip + ':' + self.port,
+            }
+
+        else:
+            proxies = {'no': 'pass', }
+
+        i = 0
+        while i < len(mirrors):
+            my_queue = Queue()
+            my_thread = []
+            for url in mirrors[i: i + self.get_limit]:
+                t = Thread(target=self.get_csv, args=(url, my_queue, proxies))
+                t.start()
+                my_thread.append(t)
+
+            for t in my_thread: t.join()
+
+            success = 0
+            vpndict = {}
+            for res in [my_queue.get() for r in xrange(self.get_limit)]:
+                success += res[0]
+                vpndict.update(res[1])
+
+            if success:
+                self.vpndict.clear()
+                self.vpndict.update(vpndict)
+                break
+            else:
+                i += self.get_limit
+
+        else:
+            self.log(' Failed to get VPN servers data\n '
+                                              'Check your network setting and proxy')
+            return False
+
+        self.log(' Fetching servers completed %s' % success)
+        return True
+
+    def refresh_data(self, resort_only=False):
+        if not resort_only:
+            # fetch data from vpngate.net
+            start = time.time()
+            self.events.refresh('fetching')
+            if not self.get_data():
+                self.events.refresh('failed', elapsed=round(time.time() - start, 3))
+                return
+            fetched = time.time()
+
+        if self.geo:
+            with profiler.span('geoip', servers=len(self.vpndict)):
+                found = self.geo.enrich(self.vpndict.values())
+            self.log(' GeoIP: found %d of %d servers' % (found, len(self.vpndict)))
+
+            geo = self.cfg.geoip
+            exclude = set(int(asn) for asn in re.findall(r'\d+', geo['exclude_asn']))
+            avoid = set(word.strip() for word in geo['avoid'].split(',') if word.strip())
+            if exclude or avoid:
+                with profiler.span('filter.geoip'):
+                    self.vpndict = dict([vpn for vpn in self.vpndict.items()
+                                         if vpn[1].asn not in exclude and vpn[1].net_type not in avoid])
+
+        if self.filters['country'] != 'all':
+            name = self.filters['country']
+            with profiler.span('filter.country'):
+                self.vpndict = dict([vpn for vpn in self.vpndict.items()
+                                     if re.search(r'\b%s\b' % name, vpn[1].country_long.lower() + ' '
+                                                  + vpn[1].country_short.lower())])
+        if self.filters['port'] != 'all':
+            port = self.filters['port']
+            with profiler.span('filter.port'):
+                if port[0] == '>':
+                    self.vpndict = dict([vpn for vpn in self.vpndict.items() if int(vpn[1].port) > int(port[1:])])
+                elif port[0] == '<':
+                    self.vpndict = dict([vpn for vpn in self.vpndict.items() if int(vpn[1].port) < int(port[1:])])
+                else:
+                    self.vpndict = dict([vpn for vpn in self.vpndict.items() if vpn[1].port in port])
+
+        if self.filters['score'] != 'all':
+            score = int(self.filters['score'])
+            with profiler.span('filter.score'):
+                self.vpndict = dict([vpn for vpn in self.vpndict.items() if int(vpn[1].score) > score])
+
+        # test alive
+        if not resort_only:
+            self.log(' Filtering out dead servers ...')
+            self.events.refresh('probing', servers=len(self.vpndict), fetch_time=round(fetched - start, 3))
+            with profiler.span('probe', servers=len(self.vpndict)):
+                dead = self.probe()
+            self.events.refresh('done', servers=len(self.vpndict), dead=dead,
+                                probe_time=round(time.time() - fetched, 3), elapsed=round(time.time() - start, 3))
+
+        sort_start = time.time()
+        if self.sort_by == 'speed':
+            sort = sorted(self.vpndict.keys(), key=lambda x: self.vpndict[x].speed, reverse=True)
+        elif self.sort_by == 'ping':
+            sort = sorted(self.vpndict.keys(), key=lambda x: self.vpndict[x].ping)
+        elif self.sort_by == 'score':
+            sort = sorted(self.vpndict.keys(), key=lambda x: self.vpndict[x].score, reverse=True)
+        elif self.sort_by == 'up time':
+            sort = sorted(self.vpndict.keys(), key=lambda x: int(self.vpndict[x].uptime))
+        else:
+            print '\nValueError: sort_by must be in "speed|ping|score|up time" but got "%s" instead.' % self.sort_by
+            print 'Change your setting by "$ ./vpnproxy config"\n'
+            sys.exit()
+        if self.geo and self.cfg.geoip['prefer']:
+            prefer = self.cfg.geoip['prefer'].strip()
+            sort.sort(key=lambda x: self.vpndict[x].net_type != prefer)  # stable, keeps the order in each group
+        profiler.record('sort', sort_start)
+
+        self.sorted[:] = sort
+        if len(sort) == 0:
+            self.log(' No thing to do!')
+        else:
+            self.log(' Sequence completed')
+
+    def probe(self):
+        """ Filter out fetched dead Vpn Servers """
+
+        def is_alive(servers, queue):
+            """ Worker for threading"""
+            target = [(self.vpndict[name].ip, self.vpndict[name].port) for name in servers]
+
+            if self.use_proxy == 'yes':
+                for i in range(len(target)):
+                    start = time.time()
+                    s = socket.socket()
+                    s.settimeout(self.test_timeout)
+                    s.connect((self.ip, int(self.port)))  # connect to proxy server
+                    ip, port = target[i]
+                    data = 'CONNECT %s:%s HTTP/1.0\r\n\r\n' % (ip, port)
+                    s.send(data)
+                    dead = False
+                    try:
+                        response = s.recv(100)
+                    except socket.timeout:
+                        dead = True
+
+                    s.shutdown(socket.SHUT_RD)
+                    s.close()
+
+                    if dead or "200 Connection established" not in response:
+                        queue.put(servers[i])
+                    profiler.record('probe.server', start)
+                    time.sleep(self.test_interval)  # avoid DDos your proxy
+
+            else:
+                for i in range(len(target)):
+                    start = time.time()
+                    s = socket.socket()
+                    s.settimeout(self.test_timeout)
+                    ip, port = target[i]
+                    try:
+                        s.connect((ip, int(port)))
+                        s.shutdown(socket.SHUT_RD)
+                    except socket.timeout:
+                        queue.put(servers[i])
+                    except Exception as e:
+                        queue.put(servers[i])
+                    finally:
+                        s.close()
+                        profiler.record('probe.server', start)
+                        # time.sleep(self.test_interval)      # no need since we make connection to different servers
+
+        my_queue = Queue()
+        chunk_len = 10  # reduce chunk_len will increase number of thread
+        my_chunk = [self.vpndict.keys()[i:i + chunk_len] for i in range(0, len(self.vpndict), chunk_len)]
+        my_thread = []
+        for chunk in my_chunk:
+            t = Thread(target=is_alive, args=(chunk, my_queue))
+            t.start()
+            my_thread.append(t)
+
+        for t in my_thread: t.join()
+
+        count = 0
+        total = len(self.vpndict)
+        while not my_queue.empty():
+            count += 1
+            dead_server = my_queue.get()
+            del self.vpndict[dead_server]
+
+        self.log(' Filtering out dead servers ... [%d/%d dead]' % (count, total))
+        return count
+
+    def post_action(self, when):
+        """ Change DNS, and do additional behaviors defined by user in user_script.sh and hooks.d
+            Both run on worker threads, a slow hook never delays vpn_checker
+        """
+        if when == 'up':
+            timeline = self.timeline
+
+            def run_hooks():
+                self.hooks.run('up', done=lambda: self.timed('hooks', timeline))
+
+            def dns_changed():
+                self.timed('dns', timeline)
+                run_hooks()  # scripts expect resolv.conf to point at the tunnel dns already
+
+            if self.dns_fix == 'yes':
+                self.dns_manager('change', done=dns_changed)
+            else:
+                run_hooks()
+            if self.split.enabled:
+                peer = self.ip if self.use_proxy == 'yes' else self.vpn_server.ip
+                t = Thread(target=self.split_routes, args=(self.tun_dev, peer, timeline))
+                t.daemon = True
+                t.start()
+
+        elif when == 'down':
+            self.dns_manager('restore')
+            self.hooks.run('down')
+
+    def split_routes(self, dev, peer, timeline):
+        """ Worker: route the compiled split tunnel prefixes through dev, except peer """
+        with profiler.span('split', dev=dev):
+            self.split.apply(dev, peer)
+        self.timed('split', timeline)
+
+    def timed(self, name, timeline):
+        """ Called from worker threads when a post-up step of timeline has finished """
+        if timeline:
+            timeline.mark(name)
+            self.log(' %s done %.2fs after tunnel up' % (name, timeline.phases().get(name, 0)))
+
+    def dns_manager(self, action='backup', done=None):
+        """ Hand DNS jobs to the resolv worker so the urwid loop never waits on them """
+        if action == "change" and self.dns_fix == 'yes':
+            DNS = self.dns.replace(' ', '').split(',')
+            self.resolv.submit('change', DNS, self.tun_dev, done=done)
+
+        elif action == "restore":
+            self.messages.set_line('status', 1, 'Restore dns')
+            self.resolv.submit('restore')
+
+        else:
+            self.resolv.submit('backup')
+
+    @staticmethod
+    def vpn_output(out, queue, notify):
+        for line in iter(out.readline, b''):
+            queue.put((time.time(), line))  # arrival time, for ConnectTimeline
+            notify()
+        out.close()
+        notify()
+
+    def vpn_connect(self, chosen):
+        """ Disconnect the current connection and spawn a new one """
+        if self.is_connected:
+            self.vpn_cleanup(1)
+        else:
+            self.is_connected = 1
+
+        server = self.vpndict[self.sorted[chosen]]
+        self.vpn_server = server
+        self.messages.set('country', server.country_long.strip('of') + '  ' + server.ip)
+        self.connected_servers.append(server.ip)
+        self.connected_set.add(server.ip)
+        self.timeline = ConnectTimeline(server, self.ip + ':' + self.port if self.use_proxy == 'yes' else None)
+        with profiler.span('config_write'):
+            self.vpn_file = server.write_file(self.use_proxy, self.ip, self.port, self.split.enabled)
+        self.timeline.mark('config')
+        self.connect_time, self.up_time = self.timeline.start, 0
+        self.spawn_time = 0
+        self.events.tunnel('connecting', server=server_info(server), proxy=self.use_proxy == 'yes')
+
+        command = ['openvpn', '--config', self.vpn_file]
+        with profiler.span('spawn'):
+            p = Popen(command, stdout=PIPE, stderr=PIPE, bufsize=1, close_fds=ON_POSIX)
+        self.spawn_time = time.time()
+        self.timeline.mark('spawn', self.spawn_time)
+        q = Queue()
+        t = Thread(target=self.vpn_output, args=(p.stdout, q, self.notify))
+        t.daemon = True
+        t.start()
+
+        self.vpn_process = p
+        self.vpn_queue = q
+
+    def vpn_cleanup(self, status_code=0, reason='stopped'):
+        p, q = self.vpn_process, self.vpn_queue
+        if p.poll() is None:
+            p.send_signal(signal.SIGINT)
+            p.wait()
+        remove_runtime(self.vpn_file)
+        self.vpn_file = None
+        if self.timeline:
+            # keep the breakdown per server, total is null when the tunnel never came up
+            if self.timeline.total() is None:
+                self.log(self.timeline.summary())
+            self.timeline.save(self.timings_file, reason if not status_code else 'switched')
+            self.timeline = None
+        if self.is_connected and not status_code:
+            server = self.vpn_server
+            self.events.tunnel('down', reason=reason, server=server_info(server) if server else None,
+                               duration=round(time.time() - self.up_time, 3) if self.up_time else 0)
+        self.is_connected = status_code
+        self.post_action('down')
+
+        # make sure openvpn did close its device, leave the others' tun alone
+        if self.tun_dev and not delete_link(self.tun_dev):
+            self.log(' Failed to delete ' + self.tun_dev)
+        self.tun_dev = None
+
+    def kill_other(self):
+        """
+        Kill all openvpn processes no matter they are controlled by
+        this program or not. Use when connection gets trouble
+        """
+        command = ['sudo', 'pkill', 'openvpn']
+        call(command)
+        if self.is_connected:
+            self.events.tunnel('down', reason='killed')
+        self.messages.set('status', 'All openvpn processes are terminated', ' ')
+        self.post_action('down')
+
+    def vpn_checker(self):
+        """ Check VPN season
+            If vpn tunnel break or fail to create, terminate vpn season
+            So openvpn not keep sending requests to proxy server and
+             save you from being blocked.
+        """
+        p, q = self.vpn_process, self.vpn_queue
+
+        if self.kill and self.is_connected:
+            self.kill = False
+            self.vpn_cleanup()
+            self.messages.set('status', 'VPN tunnel is terminated', '')
+            self.messages.set('country', ' ', ' ')
+
+        try:
+            when, line = q.get_nowait()
+        except Empty:
+            return
+        else:
+            self.log(line.strip()[11:])
+            if self.timeline:
+                self.timeline.feed(line, when)
+            if 'TUN/TAP device' in line:
+                self.tun_dev = tun_from_log(line) or self.tun_dev
+            elif 'Initialization Sequence Completed' in line:
+                self.dropped_time = 0
+                self.up_time = time.time()
+                profiler.record('handshake', self.spawn_time, self.up_time, server=self.vpn_server.ip)
+                profiler.record('connect', self.connect_time, self.up_time, server=self.vpn_server.ip)
+                self.events.tunnel('up', server=server_info(self.vpn_server), dev=self.tun_dev,
+                                   elapsed=round(self.up_time - self.connect_time, 3),
+                                   phases=self.timeline.phases() if self.timeline else None)
+                if self.timeline:
+                    self.log(self.timeline.summary())
+                self.post_action('up')
+                self.messages.set('status', 'VPN tunnel established successfully', 'Ctrl+C to quit VPN')
+                self.is_connected = 2
+            elif self.is_connected and 'Restart pause, ' in line and self.dropped_time <= self.max_retry:
+                self.dropped_time += 1
+                self.is_connected = 1
+                self.events.tunnel('degraded', retries=self.dropped_time, max_retry=self.max_retry,
+                                   server=server_info(self.vpn_server))
+                self.messages.set_line('status', 1, 'Vpn has restarted %s time(s)' % self.dropped_time)
+            elif 'Restart pause, ' in line or 'Cannot resolve' in line or 'Connection timed out' in line or 'SIGTERM' in line:
+                self.dropped_time = 0
+                self.messages.set('status', 'Vpn got error, terminated', ' ')
+                self.vpn_cleanup(reason=line.strip()[25:])
+            elif 'ERROR' in line and 'add command failed' not in line or 'Exiting due' in line:
+                self.messages.set('status', 'Vpn got error, exited', ' ')
+                self.vpn_cleanup(reason=line.strip()[25:])
+            elif '--http-proxy MUST' in line:
+                self.messages.set('status', 'Can\'t use udp with proxy!', ' ')
+
+            elif p.poll() is None and not self.is_connected:
+                if 0 < self.dropped_time <= self.max_retry:
+                    self.messages.set_line('status', 0, 'Connecting...')
+                else:
+                    self.messages.set('status', 'Connecting...', ' ')
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = "duc_tin"
+__copyright__ = "Copyright 2015+, duc_tin"
+__license__ = "GPLv2"
+__version__ = "1.0"
+__maintainer__ = "duc_tin"
+__email__ = "nguyenbaduc.tin@gmail.com"
+
+import json
+import time
+from Queue import Queue
+from threading import Thread
+
+# tunnel states, sent as {'type': 'state', 'state': ...}
+TUNNEL_STATES = ('connecting', 'up', 'degraded', 'down')
+# server list refresh, sent as {'type': 'refresh', 'state': ...}
+REFRESH_STATES = ('fetching', 'probing', 'done', 'failed')
+# one tunnel of a TunnelPool, sent as {'type': 'pool', 'state': ..., 'slot': n}
+POOL_STATES = ('connecting', 'up', 'down')
+
+
+def server_info(server):
+    """ Metrics of a vpn_core.Server as a plain dict """
+    return {'ip': server.ip, 'country': server.country_long, 'code': server.country_short,
+            'ping': server.ping, 'speed': server.speed, 'uptime': server.uptime, 'score': server.score,
+            'sessions': server.NumSessions, 'proto': server.proto, 'port': server.port,
+            'log_policy': server.logPolicy, 'asn': server.asn, 'as_name': server.as_name,
+            'net_type': server.net_type, 'city': server.city}
+
+
+class EventStream:
+    """ Emit typed events of the vpn engine
+
+        Every event is a dict with 'type', 'state' and 'time' (unix time) plus
+        event specific data. It is handed to publish (eg: InfoServer.send) and,
+        if path is set, appended to that file as one JSON line by a worker thread.
+        emit() never blocks its caller.
+    """
+
+    def __init__(self, publish=None, path=''):
+        self.publish = publish
+        self.path = path
+        self.last_state = None  # last tunnel state event
+
+        self.lines = Queue()
+        self.writer = None
+
+    def emit(self, kind, state, **data):
+        event = dict(data, type=kind, state=state, time=round(time.time(), 3))
+        if kind == 'state':
+            self.last_state = event
+
+        if self.publish:
+            self.publish(event, keep=kind == 'state')
+
+        if self.path:
+            if not self.writer or not self.writer.isAlive():
+                self.writer = Thread(target=self._write)
+                self.writer.daemon = True
+                self.writer.start()
+            self.lines.put(json.dumps(event))
+        return event
+
+    def tunnel(self, state, **data):
+        return self.emit('state', state, **data)
+
+    def refresh(self, state, **data):
+        return self.emit('refresh', state, **data)
+
+    def pool(self, state, **data):
+        return self.emit('pool', state, **data)
+
+    def _write(self):
+        while True:
+            lines = [self.lines.get()]
+            while not self.lines.empty():
+                lines.append(self.lines.get())
+            try:
+                with open(self.path, 'a') as f:
+                    f.write('\n'.join(lines) + '\n')
+            except IOError:
+                pass
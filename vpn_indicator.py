@@ -2,203 +2,315 @@
 # -*- coding: utf-8 -*-
 __author__ = 'duc_tin'
 
-from Queue import Empty, Queue
-from threading import Thread
+from threading import Thread, Event
+from Queue import Queue
 from subprocess import call, Popen, PIPE
+from collections import deque
+from ovpn_config import RUNTIME_DIR
+from dependencies import find_program
 import datetime
+import errno
+import json
 import select
 import signal, os, sys
-import socket, errno
+import socket
 import time
 
+STATUS_SOCK = RUNTIME_DIR + '/status.sock'
+
 
 def rep_time():
     return str(datetime.datetime.now()).split('.')[0]
 
 
+def pack(msg):
+    """ Frame a message as one JSON line """
+    return json.dumps(msg) + '\n'
+
+
+class Unpacker:
+    """ Collect received chunks and split them into JSON-lines messages """
+
+    def __init__(self):
+        self.data = ''
+
+    def reset(self):
+        self.data = ''
+
+    def feed(self, chunk):
+        self.data += chunk
+        if '\n' not in self.data:
+            return []
+
+        lines = self.data.split('\n')
+        self.data = lines.pop()  # unfinished frame, wait for the rest
+        msgs = []
+        for line in lines:
+            try:
+                msgs.append(json.loads(line))
+            except ValueError:
+                print rep_time(), 'Dropped a broken frame:', line[:40]
+        return msgs
+
+
+def share_with_user(path):
+    """ Let root and the group of the user who ran sudo use socket path """
+    os.chmod(os.path.dirname(path), 0711)
+    os.chown(path, 0, int(os.environ.get('SUDO_GID', 0)))
+    os.chmod(path, 0660)
+
+
+class Subscriber:
+    """ One client of InfoServer with its own bounded outgoing queue """
+
+    def __init__(self, sock, queue_len):
+        self.sock = sock
+        self.sock.setblocking(0)
+        self.unpacker = Unpacker()
+        self.out = deque(maxlen=queue_len)  # oldest frames are dropped when full
+        self.pending = ''  # frame that was partly sent
+        self.dropped = 0
+
+    def push(self, frame):
+        if len(self.out) == self.out.maxlen:
+            self.dropped += 1
+        self.out.append(frame)
+
+    def flush(self):
+        """ Send as much as the socket takes without blocking """
+        while self.pending or self.out:
+            if not self.pending:
+                self.pending = self.out.popleft()
+            try:
+                sent = self.sock.send(self.pending)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            self.pending = self.pending[sent:]
+
+
 class InfoServer:
-    def __init__(self, port):
-        self.host = 'localhost'
-        self.port = port
-        self.backlog = 0
+    """ Publish vpn status to every subscriber (indicator, scripts, monitoring)
+        on a unix socket and collect the commands they send back.
+        A slow subscriber only loses its own oldest messages, it never blocks the others.
+    """
+
+    def __init__(self, path=STATUS_SOCK, queue_len=64):
+        self.path = path
+        self.queue_len = queue_len
 
         self.is_listening = False
-        self.is_connected = False
         self.is_dead = False
-        self.client = None
-
-        self.sock = socket.socket()
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_address = self.host, self.port
+        self.sock = None
+        self.clients = {}  # socket -> Subscriber
+        self.last_msg = None  # replayed to new subscribers
 
-        self.readlist = [self.sock]  # use for select
+        self.wake_r, self.wake_w = os.pipe()  # wake select up when there is something to send
 
     def listen(self):
         try:
-            self.sock.bind(self.server_address)
-            self.sock.listen(self.backlog)
-            print rep_time(),  'listening'
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path), 0711)
 
+            if os.path.exists(self.path):
+                probe = socket.socket(socket.AF_UNIX)
+                try:
+                    probe.connect(self.path)
+                    probe.close()
+                    print rep_time(), 'Server: %s is owned by another process' % self.path
+                    return False
+                except socket.error:
+                    os.remove(self.path)  # left by a crashed season
+
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.bind(self.path)
+            share_with_user(self.path)
+            self.sock.listen(5)
             return True
-        except socket.errno, e:
-            print rep_time(),  e
+        except (socket.error, OSError) as e:
+            print rep_time(), e
             return False
 
     def accept_it(self):
-        if not self.is_connected:
-            self.client, addrr = self.sock.accept()
-            self.readlist.append(self.client)
-            self.is_connected = True
-            print rep_time(), 'Server: Connected with %s:%s' % addrr
-            return 'Connected'
-        else:
-            # reject all other request
-            client, addrr = self.sock.accept()
-            client.close()
-            return 'Another client tried to connect'
-
-    def recv_it(self):
-        data = []
-        while True:
-            char = self.client.recv(1)
-            if not char:  # socket close signal
-                self.is_connected = False
-                self.readlist.remove(self.client)
-                print rep_time(), 'main disconnected'
-                return ''
-
-            elif char=='\n':
-                return ''.join(data)
-
-            else:
-                data.append(char)
+        client, _ = self.sock.accept()
+        sub = Subscriber(client, self.queue_len)
+        if self.last_msg is not None:
+            sub.push(pack(self.last_msg))
+        self.clients[client] = sub
+
+    def drop(self, client):
+        self.clients.pop(client, None)
+        client.close()
+
+    def recv_it(self, client):
+        """ One recv per readiness event, return the complete messages in it """
+        chunk = client.recv(4096)
+        if not chunk:  # socket close signal
+            self.drop(client)
+            return []
+        return self.clients[client].unpacker.feed(chunk)
 
-    def check_io(self, q_info):
-        """Receive information about vpn tunnel
-            :type q_info: Queue
+    def check_io(self, q_cmd):
+        """Send vpn status out, receive commands from subscribers
+            :type q_cmd: Queue
         """
         while True:
 
             # try to bind the socket, only run one time
             while not self.is_listening:
                 self.is_listening = self.listen()
-                time.sleep(2)
+                if not self.is_listening:
+                    time.sleep(2)
 
-            # normal select protocol
-            readable, _, _ = select.select(self.readlist, [], [])
+            writable = [c for c, sub in self.clients.items() if sub.pending or sub.out]
+            readable, writable, _ = select.select([self.sock, self.wake_r] + self.clients.keys(), writable, [])
             for s in readable:
-                if s is self.sock:
-                    # sigterm from indicator
+                if s is self.wake_r:
+                    os.read(self.wake_r, 4096)
                     if self.is_dead:
-                        print rep_time(), 'Server: Received dead signal'
+                        for client in self.clients.keys():
+                            self.drop(client)
                         self.sock.close()
                         return 0
 
-                    # signal from client
-                    else:
-                        data = self.accept_it()
-                        q_info.put(data)
+                elif s is self.sock:
+                    self.accept_it()
 
-                else:  # client sent something
+                else:  # subscriber sent something
                     try:
-                        data = self.recv_it()
-                        q_info.put(data)
-                    except socket.error as e:
-                        print rep_time(),  'Client die unexpectedly'
-                        self.is_connected = False
-                    except Exception as e:
-                        print rep_time(), e
+                        for data in self.recv_it(s):
+                            q_cmd.put(data)
+                    except socket.error:
+                        self.drop(s)
 
-    def send(self, msg):
-        if msg == 'dead':
-            self.is_dead = True
-            if self.is_connected:
-                self.sock.shutdown(socket.SHUT_RDWR)
+            for s in writable:
+                if s in self.clients:
+                    try:
+                        self.clients[s].flush()
+                    except socket.error:
+                        self.drop(s)
 
-        elif self.is_connected:
+    def send(self, msg, keep=True):
+        """ Queue msg for every subscriber, never blocks
+            keep: also replay msg to subscribers that connect later
+        """
+        if keep:
+            self.last_msg = msg
+        frame = pack(msg)
+        for sub in self.clients.values():
+            sub.push(frame)
+        os.write(self.wake_w, '.')
+        return bool(self.clients)
+
+    def close(self):
+        self.is_dead = True
+        if self.is_listening:
             try:
-                self.client.sendall(msg + '\n')
-                return True
-            except socket.error:
-                return False
-        else:
-            return False
+                os.remove(self.path)
+            except OSError:
+                pass
+        os.write(self.wake_w, '.')
 
 
 class InfoClient:
-    def __init__(self, port):
-        self.host = 'localhost'
-        self.port = port
-        self.sock = socket.socket()
-        self.server_address = self.host, port
+    """ Subscribe to the vpn status of the main program and send it commands """
+
+    def __init__(self, path=STATUS_SOCK):
+        self.path = path
+        self.sock = None
         self.is_connected = False
+        self.unpacker = Unpacker()
 
-        self.last_msg = ''
+        self.wake = Event()  # set by send() when a command waits for the main program
+        self.retry = 1
 
     def connect(self):
         while not self.is_connected:
             try:
-                self.sock = socket.create_connection(self.server_address)
-                # print rep_time(),  'socket: connected'
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.connect(self.path)
+                self.unpacker.reset()
                 self.is_connected = True
-
-                # update current status
-                if self.last_msg:
-                    self.send(self.last_msg)
+                self.retry = 1
 
             except socket.error, e:
-                # print rep_time(),  str(e)
-                time.sleep(2)
+                self.sock.close()
+                # sleep until a command is waiting or the backoff ends, not a fixed 2s spin
+                self.wake.wait(self.retry)
+                self.wake.clear()
+                self.retry = min(self.retry * 2, 10)
 
     def recv_it(self):
-        data = []
-        while True:
-            char = self.sock.recv(1)
-            if not char:  # socket close signal
-                self.is_connected = False
-                return ''
-            elif char == '\n':
-                return ''.join(data)
-            else:
-                data.append(char)
+        """ One recv per readiness event, return the complete messages in it """
+        chunk = self.sock.recv(4096)
+        if not chunk:  # socket close signal
+            self.is_connected = False
+            return []
+        return self.unpacker.feed(chunk)
 
-    def check_io(self, q_cmd):
+    def check_io(self, q_info):
         """Receive information about vpn tunnel
-            :type q_cmd: Queue
+            :type q_info: Queue
         """
         while True:
             if self.is_connected:
-                # check if there is cmd from indicator
-                readable, _, _ = select.select([self.sock], [], [])
+                select.select([self.sock], [], [])
                 try:
-                    data = self.recv_it()
-                    if data:
-                        q_cmd.put(data)
+                    for data in self.recv_it():
+                        q_info.put(data)
                 except socket.error as e:
                     print rep_time(),  'Server die unexpectedly'
                     self.is_connected = False
+
+                if not self.is_connected:
+                    q_info.put('Offline')
             else:
                 self.connect()
+                q_info.put('connected')
 
     def send(self, msg):
-        self.last_msg = msg
         if self.is_connected:
             try:
-                self.sock.sendall(msg+'\n')
+                self.sock.sendall(pack(msg))
                 return True
             except socket.error:
                 return False
         else:
+            self.wake.set()
             return False
 
 
+class WakeQueue(Queue):
+    """ Queue that calls wake on every put, for a main loop that sleeps until there is news """
+
+    def __init__(self, wake):
+        Queue.__init__(self)
+        self.wake = wake
+
+    def put(self, item, block=True, timeout=None):
+        Queue.put(self, item, block, timeout)
+        self.wake()
+
+
+class MainLoopQueue:
+    """ Queue look-alike for InfoServer.check_io: hand each message to func
+        inside the Gtk main loop, so nothing has to poll for it
+    """
+
+    def __init__(self, func):
+        self.func = func
+
+    def put(self, item):
+        GLib.idle_add(self.func, item)
+
+
 class VPNIndicator:
-    def __init__(self, q_info, sender):
+    def __init__(self, sender):
         signal.signal(signal.SIGINT, self.handler)
         signal.signal(signal.SIGTERM, self.handler)
 
-        # pipe for send/recv data to tcp server
-        self.q_info = q_info
+        # send commands to main program, its status comes through self.callback
         self.send = sender
 
         self.APPINDICATOR_ID = 'myappindicator'
@@ -223,9 +335,7 @@ class VPNIndicator:
 
         notify.init(self.APPINDICATOR_ID)
 
-    def run(self, *args):
-        GLib.timeout_add(1000, self.callback, *args)
-        GLib.timeout_add(500, self.blinking)
+    def run(self):
         Gtk.main()
 
     def blinking(self):
@@ -234,15 +344,38 @@ class VPNIndicator:
                 self.icon_th = 0
             self.indicator.set_icon(self.icon345[self.icon_th])
             self.icon_th += 1
-        return True
+        return self.is_connecting  # timer stops by itself after connecting
+
+    @staticmethod
+    def event2msg(event):
+        """ Turn a tunnel event of vpn_events.EventStream into the 'kind;field;...' text used here """
+        if event.get('type') != 'state':
+            return ''  # refresh progress is not shown by the indicator
+
+        state = event['state']
+        if state == 'up':
+            s = event['server']
+            uptime = str(datetime.timedelta(milliseconds=int(s['uptime']))).split('.')[0]
+            fields = [s['country'].strip('of'), s['ip'], str(s['ping']), '%.2f' % (s['speed'] / 1000. ** 2), uptime,
+                      s['sessions'], s['log_policy'], str(s['score']), s['proto'], s['port']]
+            return ';'.join(['successfully'] + fields)
+        elif state in ('connecting', 'degraded'):
+            return 'connecting'
+        else:
+            return 'terminate'
 
     def reload(self, data_in):
+        if isinstance(data_in, dict):
+            data_in = self.event2msg(data_in)
+
         if data_in:
             print rep_time(),  data_in[:12]
 
             self.last_recv = data_in.split(';')
             if 'connecting' in data_in:
                 print rep_time(),  'set blinking'
+                if not self.is_connecting:
+                    GLib.timeout_add(500, self.blinking)
                 self.is_connecting = True
             else:
                 self.is_connecting = False
@@ -308,13 +441,12 @@ class VPNIndicator:
         return menu
 
     def quit(self, source=None):
-        # send dead signal to tcp server
-        self.send('dead')
         notify.uninit()
         Gtk.main_quit()
 
     def change_focus(self, menu_obj):
-        call(['wmctrl', '-a', 'vpngate-with-proxy'])
+        if find_program('wmctrl'):  # optional, without it the menu item does nothing
+            call(['wmctrl', '-a', 'vpngate-with-proxy'])
 
     def status(self, menu_obj, messages=''):
         """
@@ -366,16 +498,13 @@ class VPNIndicator:
         print rep_time(),  'Indicator sent:', arg
         self.send(arg)
 
-    def callback(self):
+    def callback(self, data):
         try:
-            data = self.q_info.get_nowait()
             self.reload(data)
-        except Empty:
-            pass
         except Exception as e:
             self.notifier.update("Error", str(e), icon=None)
             self.notifier.show()
-        return True
+        return False  # run once per message
 
 
 if __name__ == '__main__':
@@ -407,18 +536,15 @@ if __name__ == '__main__':
             print rep_time(),  'exist another me', another_me[1:]
             sys.exit()
 
-        # queue for interacting between indicator and server
-        q = Queue()
+        client = InfoClient()
+        indicator = VPNIndicator(client.send)
 
-        server = InfoServer(8088)
-        t = Thread(target=server.check_io, args=(q,))     # shouldn't be daemon
+        # messages from main program are delivered straight into the Gtk loop
+        t = Thread(target=client.check_io, args=(MainLoopQueue(indicator.callback),))
+        t.daemon = True  # the main program owns the socket, nothing to clean up
         t.start()
 
-        indicator = VPNIndicator(q, server.send)
         try:
             indicator.run()
         except Exception as e:
             print rep_time(), 'Indicator:', e
-            if not server.is_dead:
-                server.send('dead')
-        t.join()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = "duc_tin"
+__copyright__ = "Copyright 2015+, duc_tin"
+__license__ = "GPLv2"
+__version__ = "1.0"
+__maintainer__ = "duc_tin"
+__email__ = "nguyenbaduc.tin@gmail.com"
+
+import os
+import sys
+import socket
+from threading import Thread, Lock, Condition
+from config import Setting, get_input
+from message_bus import MessageBus
+from vpn_core import Server
+from vpn_indicator import InfoClient
+
+STATES = {'up': 2, 'connecting': 1, 'degraded': 1}  # tunnel event state -> Connection.is_connected
+
+
+class RemoteServer(Server):
+    """ One row of the daemon's server list, with what the table shows of a Server """
+
+    def __init__(self, info):
+        self.ip, self.port, self.proto = info['ip'], info['port'], info['proto']
+        self.country_long, self.country_short = info['country'], info['code']
+        self.ping, self.speed, self.score = info['ping'], info['speed'], info['score']
+        self.uptime, self.logPolicy = info['uptime'], info['log_policy']
+        self.asn, self.as_name, self.net_type, self.city = info['asn'], info['as_name'], info['net_type'], info['city']
+        self._cells = None
+
+
+class RemoteConnection:
+    """ Stand-in for vpn_core.Connection when a daemon owns the tunnel
+
+        The TUI reads the same attributes, a thread subscribed to the daemon's
+        status and log events on status.sock fills them, and its calls become
+        commands on the control socket. Nothing here touches openvpn, DNS or
+        routes, so the screen attaches at once and leaves the tunnel running
+        when it quits.
+    """
+    remote = True
+
+    def __init__(self, client):
+        """
+        :type client: vpnproxy_daemon.DaemonClient
+        """
+        self.path = os.path.realpath(sys.argv[0])
+        self.user_home = sys.argv[1]
+        self.config_file = sys.argv[1] + '/.config/vpngate-with-proxy/config.ini'
+        self.cfg = Setting(self.config_file)
+        self.cfg.load()
+        self.args = sys.argv[2:]
+        self.client = client
+        self.lock = Lock()  # one request at a time on the socket
+        self.gone = False
+
+        self.vpndict = {}
+        self.sorted = []
+        self.vpn_process = None
+        self.vpn_queue = None
+        self.local_proxy = None
+        self.is_connected = 0
+        self.kill = False
+        self.get_limit = 1
+        self.wakeup = None
+        self.connected_servers = []
+        self.connected_set = set()
+        self.messages = MessageBus()
+        self.messages.add_lines('country', 1)
+        self.messages.add_lines('status', 2)
+        self.messages.add_queue('debug', 200)
+
+        self.status = {}  # last status of the daemon
+        self.changed = Condition()  # notified with each new status
+        self.logged = 0  # daemon log lines already shown
+        self.loaded = False  # has taken the daemon's list once
+        self.fetching = False  # refresh_data is waiting for the daemon
+
+        if len(self.args):
+            if self.args[0] in ['r', 'restore']:
+                self.log(' DNS belongs to the daemon, it is restored when its tunnel goes down')
+            else:
+                get_input(self.cfg, self.args)
+                self.call('reload')
+
+        self.use_proxy, self.proxy, self.port, self.ip = [''] * 4
+        self.sort_by, self.filters, self.verbose = [''] * 3
+        self.read_config()
+        self.log(' Attached to the daemon, q leaves its tunnel up, Ctrl+C stops it')
+
+        self.events = InfoClient()
+        self.listener = Thread(target=self.events.check_io, args=(self,))
+        self.listener.daemon = True
+        self.listener.start()
+
+    def read_config(self):
+        self.use_proxy, self.proxy, self.port, self.ip = self.cfg.proxy.values()
+        self.sort_by = self.cfg.sort.values()[0]
+        self.filters = self.cfg.filter
+        self.verbose = self.cfg.openvpn.values()[0]
+
+    def reload(self):
+        """ Save the settings changed on screen and let the daemon read them """
+        self.cfg.write()
+        self.read_config()
+        self.call('reload')
+
+    def rewrite(self, section, **contents):
+        for key in contents:
+            self.cfg.sections[section][key] = contents[key]
+        self.reload()
+
+    def notify(self):
+        if self.wakeup:
+            self.wakeup()
+
+    def log(self, msg):
+        self.messages.put('debug', msg)
+        self.notify()
+
+    def call(self, cmd, **kwargs):
+        """ :return: result of the daemon command, or None once the failure is logged """
+        if self.gone:
+            return None
+        try:
+            with self.lock:
+                return self.client.call(cmd, **kwargs)
+        except ValueError as e:
+            self.log(' Daemon refused %s: %s' % (cmd, e))
+        except socket.error as e:
+            self.gone = True
+            self.log(' Lost the daemon: %s' % e)
+            self.messages.set('status', 'Daemon is gone', "'q' to quit")
+            with self.changed:
+                self.changed.notify_all()
+        return None
+
+    # ------------------------- events ----------------------------
+    def put(self, event):
+        """ Called by InfoClient.check_io with each event of the daemon, mirror its state and log """
+        kind = event.get('type') if isinstance(event, dict) else event
+        if kind == 'connected':
+            self.sync()  # what happened before this subscription
+        elif kind == 'Offline':
+            self.call('status')  # is it gone, or only status.sock
+        elif kind == 'status':
+            self.update(dict((k, v) for k, v in event.items() if k not in ('type', 'time')))
+        elif kind == 'log':
+            if event['count'] == self.logged + 1:
+                self.logged = event['count']
+                self.log(' ' + event['line'])
+            elif event['count'] > self.logged:
+                self.sync_log()  # our queue in the daemon was full, some lines were dropped
+
+    def sync(self):
+        status = self.call('status')
+        if status:
+            self.update(status)
+        self.sync_log()
+
+    def sync_log(self):
+        log = self.call('log', since=self.logged)
+        if log:
+            self.logged = log['count']
+            for line in log['lines']:
+                self.log(' ' + line)
+
+    def update(self, status):
+        self.is_connected = STATES.get(status['state'], 0)
+        ip = status['ip']
+        if self.is_connected and ip and (not self.connected_servers or self.connected_servers[-1] != ip):
+            self.connected_servers.append(ip)
+            self.connected_set.add(ip)
+
+        if status['refreshed'] > self.status.get('refreshed', 0) and self.loaded and not self.fetching:
+            self.log(' The daemon has a new server list, r to refresh')
+        if status != self.status:
+            self.messages.set('country', status['country'])
+            self.messages.set('status', *status['message'])
+            self.notify()
+        with self.changed:
+            self.status = status
+            self.changed.notify_all()
+
+    def vpn_checker(self):
+        """ Run by the screen when it wakes up: pass Ctrl+C on to the daemon """
+        if self.kill:
+            self.kill = False
+            t = Thread(target=self.call, args=('stop',))
+            t.daemon = True
+            t.start()
+
+    # ------------------------- commands --------------------------
+    def refresh_data(self, resort_only=False):
+        """ Run by the screen's fetch thread: the first time take the daemon's list as it is,
+            later ask for a refresh and wait for it
+        """
+        self.fetching = True
+        status = self.call('status') or {}
+        start = status.get('refreshed', 0)
+        wait = status.get('refreshing')
+        if not wait and (self.loaded or not status.get('servers')):
+            wait = self.call('refresh', resort_only=bool(resort_only))
+        self.loaded = True
+
+        with self.changed:
+            while wait and not self.gone and self.status.get('refreshed', 0) <= start:
+                self.changed.wait()
+
+        servers = [RemoteServer(info) for info in self.call('list') or []]
+        self.vpndict = dict((server.ip, server) for server in servers)
+        self.sorted[:] = [server.ip for server in servers]
+        self.fetching = False
+        self.log(' Got %d servers from the daemon' % len(servers))
+
+    def vpn_connect(self, chosen):
+        server = self.vpndict[self.sorted[chosen]]
+        self.messages.set('country', server.country_long.strip('of') + '  ' + server.ip)
+        self.messages.set('status', 'Connecting...', ' ')
+        # by address, the daemon's list may have moved on since ours was taken
+        t = Thread(target=self.call, args=('connect',), kwargs={'ip': server.ip})
+        t.daemon = True
+        t.start()
+
+    def profile(self):
+        """ Profiling summary of the daemon, as text lines for the debug pane """
+        result = self.call('profile')
+        if not result:
+            return []
+        if not result['enabled']:
+            return [' Profiling is off in the daemon, set profile = yes in [monitor] and restart it']
+        lines = [' %-16s %5s %8s %8s %8s' % ('span', 'n', 'mean', 'max', 'last')]
+        for name, s in sorted(result['summary'].items()):
+            lines.append(' %-16s %5d %8.3f %8.3f %8.3f' % (name[:16], s['count'], s['mean'], s['max'], s['last']))
+        return lines
+
+    def dns_manager(self, action='backup', done=None):
+        if action == 'restore':
+            self.log(' DNS belongs to the daemon, it is restored when its tunnel goes down')
+
+    def kill_other(self):
+        self.log(' openvpn belongs to the daemon, stop its tunnel with Ctrl+C or "./run ctl stop"')
+
+    def start_local_proxy(self):
+        return None  # served by the daemon
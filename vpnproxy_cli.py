@@ -11,11 +11,19 @@ import os
 import signal
 import base64
 import time
+import select
 import datetime
+import argparse
 from config import *
 from Queue import Queue
 from threading import Thread
-from subprocess import call, Popen, PIPE, check_output
+from subprocess import call, Popen, PIPE
+from resolv_manager import ResolvManager
+from hook_runner import HookRunner
+from netlink import tun_from_log, strip_time, delete_link
+from ovpn_config import OvpnConfig, write_runtime, remove_runtime
+from dependencies import missing_modules, missing_programs, package_manager
+from vpnproxy_daemon import find_daemon
 
 # Get sudo privilege
 euid = os.geteuid()
@@ -24,13 +32,6 @@ if euid != 0:
     # os.execlpe('sudo', *args)
     raise RuntimeError('Permission deny! You need to "sudo" or use "./run cli" instead')
 
-# detect Debian based or Redhat based OS's package manager
-pkg_mgr = None
-check_ls = ["apt-get", "yum", "dnf"]
-for pkg in check_ls:
-    if check_output("whereis -b {}".format(pkg).split()).strip().split(":")[1]:
-        pkg_mgr = pkg
-
 # Define some mirrors of vpngate.net
 mirrors = ["http://www.vpngate.net"]  # add your mirrors to config.ini file, not here
 
@@ -56,23 +57,25 @@ class Server:
             self.port = '1'
         else:
             self.port = port[0].split()[-1]
+        self.rendered = {}  # final config per (use_proxy, proxy, port)
 
-    def write_file(self):
-        txt_data = self.config_data
-        if use_proxy == 'yes':
-            txt_data = txt_data.replace('\r\n;http-proxy-retry\r\n', '\r\nhttp-proxy-retry 3\r\n')
-            txt_data = txt_data.replace('\r\n;http-proxy [proxy server] [proxy port]\r\n',
-                                        '\r\nhttp-proxy %s %s\r\n' % (proxy, port))
+    def build_config(self):
+        key = use_proxy, proxy, port
+        if key not in self.rendered:
+            cfg = OvpnConfig(self.config_data)
+            if use_proxy == 'yes':
+                cfg.set('http-proxy-retry', 3)
+                cfg.set('http-proxy', proxy, port)
 
-        extra_option = ['keepalive 5 30\r\n',  # prevent connection drop due to inactivity timeout
-                        'connect-retry 2\r\n']
-        if True:
-            index = txt_data.find('client\r\n')
-            txt_data = txt_data[:index] + ''.join(extra_option) + txt_data[index:]
+            cfg.set('keepalive', 5, 30)  # prevent connection drop due to inactivity timeout
+            cfg.set('connect-retry', 2)
+            self.rendered[key] = cfg.render()
 
-        tmp_vpn = open('vpn_tmp', 'w+')
-        tmp_vpn.write(txt_data)
-        return tmp_vpn
+        return self.rendered[key]
+
+    def write_file(self):
+        """ :return: path of a private config file for this connection only """
+        return write_runtime(self.build_config(), self.ip)
 
     def __str__(self):
         speed = self.speed / 1000. ** 2
@@ -144,9 +147,9 @@ def refresh_data():
                         if re.search(r'\b%s\b' % s_country, vpn[1].country_long.lower() + ' '
                                      + vpn[1].country_short.lower())])
     if s_port != 'all':
-        if port[0] == '>':
+        if s_port[0] == '>':
             vpnlist = dict([vpn for vpn in vpnlist.items() if int(vpn[1].port) > int(s_port[1:])])
-        elif port[0] == '<':
+        elif s_port[0] == '<':
             vpnlist = dict([vpn for vpn in vpnlist.items() if int(vpn[1].port) < int(s_port[1:])])
         else:
             vpnlist = dict([vpn for vpn in vpnlist.items() if vpn[1].port in s_port])
@@ -240,65 +243,57 @@ def probe(vpndict):
     print 'Deleted %d dead servers out of %d' % (count, total)
 
 
-def post_action(when):
-    """ Change DNS, and do additional behaviors defined by user in user_script.sh"""
+def post_action(when, dev=None):
+    """ Change DNS, and do additional behaviors defined by user in user_script.sh and hooks.d"""
     if when == 'up':
-        dns_manager('change', dns)
-
-        # call user_script
-        up = 'bash user_script.sh up'.split()
-        call(up)
+        dns_manager('change', dns, dev)  # in this thread, hooks start after resolv.conf is changed
+        hooks.run('up')
 
     elif when == 'down':
         dns_manager('restore')
-
-        # call user_script
-        down = 'bash user_script.sh down'.split()
-        call(down)
+        hooks.run('down')
 
 
-def dns_manager(action='backup', DNS='8.8.8.8'):
+def dns_manager(action='backup', DNS='8.8.8.8', dev=None):
     global dns_fix
 
-    dns_orig = '/etc/resolv.conf.bak'
-
-    if not os.path.exists(dns_orig):
-        print ctext('Backup DNS setting', 'yB')
-        backup = ['-aL', '/etc/resolv.conf', '/etc/resolv.conf.bak']
-        call(['cp'] + backup)
-
     if action == "change" and dns_fix == 'yes':
         DNS = DNS.replace(' ', '').split(',')
-
-        with open('/etc/resolv.conf', 'w+') as resolv:
-            for dns in DNS:
-                resolv.write('nameserver ' + dns + '\n')
+        resolv.do('change', DNS, dev)
         print ctext('\nChanged DNS', 'yB').center(38)
 
     elif action == "restore":
         print ctext('\nRestore DNS', 'yB')
-        reverseDNS = ['-a', '/etc/resolv.conf.bak', '/etc/resolv.conf']
-        call(['cp'] + reverseDNS)
+        resolv.do('restore')
+
+    else:
+        resolv.do('backup')
 
 
-def vpn_manager(ovpn):
+def vpn_manager(ovpn, p=None, tun_dev=None):
     """ Check VPN season
         If vpn tunnel break or fail to create, terminate vpn season
         So openvpn not keep sending requests to proxy server and
          save you from being blocked.
+        p, tun_dev: openvpn already started by connect_batch, followed from where it is
+        :return: True if the user stopped the tunnel
     """
     global dns, verbose, dropped_time
 
-    command = ['openvpn', '--config', ovpn]
-    p = Popen(command, stdout=PIPE, stdin=PIPE)
+    if not p:
+        command = ['openvpn', '--config', ovpn]
+        p = Popen(command, stdout=PIPE, stdin=PIPE)
+    stopped = False
     try:
         while p.poll() is None:
             line = p.stdout.readline()
             if verbose == 'yes':
                 print line,
-            if 'Initialization Sequence Completed' in line:
+            if 'TUN/TAP device' in line:
+                tun_dev = tun_from_log(line) or tun_dev
+            elif 'Initialization Sequence Completed' in line:
                 dropped_time = 0
-                post_action('up')
+                post_action('up', tun_dev)
                 print ctext('VPN tunnel established successfully'.center(40), 'B')
                 print 'Ctrl+C to quit VPN'.center(40)
             elif 'Restart pause, ' in line and dropped_time <= max_retry:
@@ -312,9 +307,251 @@ def vpn_manager(ovpn):
     except KeyboardInterrupt:
         p.send_signal(signal.SIGINT)
         p.wait()
+        stopped = True
         print ctext('VPN tunnel is terminated'.center(40), 'B')
     finally:
+        if p.poll() is None:  # left running by another exception, waiting alone would block forever
+            p.send_signal(signal.SIGINT)
+            p.wait()
         post_action('down')
+        if tun_dev:
+            delete_link(tun_dev)
+    return stopped
+
+
+def parse_batch(argv):
+    """ Options of the non-interactive mode """
+    parser = argparse.ArgumentParser(
+        prog='./run cli', description='Fetch, filter, probe and connect without any question, for scripts.',
+        epilog='Exit status: 0 tunnel up (or stopped by the user in the foreground), 1 no server, '
+               '2 no server came up, 3 tunnel lost in the foreground, 4 the daemon owns the tunnel')
+    parser.add_argument('--connect', default='best', metavar='best|INDEX',
+                        help='best ranked live server, or start from this index of the ranked list')
+    parser.add_argument('--country', help='country code or name, all for any (default: config.ini)')
+    parser.add_argument('--min-score', help='keep servers with a higher score (default: config.ini)')
+    parser.add_argument('--port', help='server port, eg: 443, >1000 (default: config.ini)')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds for each server to come up [30]')
+    parser.add_argument('--tries', type=int, default=5, help='servers to try down the ranked list [5]')
+    parser.add_argument('--detach', action='store_true',
+                        help='exit once the tunnel is up and keep it from a background process')
+    parser.add_argument('--pidfile', help='with --detach, write the pid of the background process here')
+    opts = parser.parse_args(argv)
+    if opts.connect != 'best' and not opts.connect.isdigit():
+        parser.error('--connect takes best or an index')
+    return opts
+
+
+def wait_up(p, timeout):
+    """ Follow openvpn output until the tunnel is up
+        :return: (tun device, None) or (None, why it failed)
+    """
+    deadline = time.time() + timeout
+    tun_dev = None
+    while True:
+        left = deadline - time.time()
+        if left <= 0 or not select.select([p.stdout], [], [], left)[0]:
+            return None, 'not up after %gs' % timeout
+        line = p.stdout.readline()
+        if not line:
+            return None, 'openvpn exited'
+        if verbose == 'yes':
+            print line,
+        if 'TUN/TAP device' in line:
+            tun_dev = tun_from_log(line) or tun_dev
+        elif 'Initialization Sequence Completed' in line:
+            return tun_dev, None
+        elif 'Restart pause, ' in line or 'Connection timed out' in line or 'Cannot resolve' in line or \
+                'Exiting due' in line or 'ERROR' in line and 'add command failed' not in line:
+            return None, strip_time(line)
+
+
+def detach():
+    """ Fork, the parent exits with the status that the child reports on the pipe
+        :return: in the child, the write end of that pipe
+    """
+    read_end, write_end = os.pipe()
+    sys.stdout.flush()
+    pid = os.fork()
+    if pid:
+        os.close(write_end)
+        status = os.read(read_end, 1)
+        status = ord(status) if status else 2
+        if status == 0:
+            print 'Tunnel is kept by process %d, "sudo kill %d" to disconnect' % (pid, pid)
+        os._exit(status)
+
+    os.close(read_end)
+    os.setsid()  # no SIGHUP when the caller's terminal goes away
+    return write_end
+
+
+def report(ready, status, log=None):
+    """ Tell the waiting parent how it went, then write to log instead of its terminal """
+    os.write(ready, chr(status))
+    os.close(ready)
+    if log:
+        sys.stdout.flush()
+        with open(log, 'a') as f:
+            os.dup2(f.fileno(), sys.stdout.fileno())
+            os.dup2(f.fileno(), sys.stderr.fileno())
+        with open(os.devnull) as f:
+            os.dup2(f.fileno(), sys.stdin.fileno())
+
+
+def connect_batch(opts):
+    """ Connect to the best live server, going down the ranked list on failure, no question asked
+        :return: exit status
+    """
+    ranked, vpn_list = refresh_data()
+    first = 0 if opts.connect == 'best' else int(opts.connect)
+    candidates = ranked[first:first + opts.tries]
+    if not candidates:
+        print ctext('No server for country=%s min-score=%s port=%s' % (s_country, s_score, s_port), 'rB')
+        return 1
+
+    ready = detach() if opts.detach else None
+    p = vpn_file = None
+    posted = up = False
+    try:
+        if ready and opts.pidfile:
+            with open(opts.pidfile, 'w') as f:
+                f.write('%d\n' % os.getpid())
+
+        for n, key in enumerate(candidates):
+            server = vpn_list[key]
+            print ctext('[%d/%d]' % (n + 1, len(candidates)), 'B'), server.country_long, server.ip, server.proto, server.port
+            vpn_file = server.write_file()
+            p = Popen(['openvpn', '--config', vpn_file], stdout=PIPE, stdin=PIPE)
+            tun_dev, reason = wait_up(p, opts.timeout)
+            if tun_dev:
+                break
+            print ctext('  failed: %s' % reason, 'r')
+            if p.poll() is None:
+                p.send_signal(signal.SIGINT)
+                p.wait()
+            remove_runtime(vpn_file)
+        else:
+            return 2
+
+        posted = True
+        post_action('up', tun_dev)
+        print ctext('VPN tunnel established', 'gB'), server.ip, tun_dev
+        up = True
+    except KeyboardInterrupt:  # Ctrl+C, or SIGTERM through signal_term_handler
+        print ctext('Interrupted, no tunnel is kept', 'B')
+        return 2
+    finally:
+        # whatever stopped us before the tunnel was handed over, leave nothing behind
+        # and do not let a detached parent guess
+        if not up:
+            if p and p.poll() is None:
+                p.send_signal(signal.SIGINT)
+                p.wait()
+            if posted:
+                post_action('down')
+            remove_runtime(vpn_file)
+            if ready:
+                report(ready, 2)
+
+    if ready:
+        report(ready, 0, os.path.split(path)[0] + '/logs/cli.log')
+    try:
+        stopped = vpn_manager(vpn_file, p, tun_dev)
+    finally:
+        remove_runtime(vpn_file)
+        hooks.wait()
+    return 0 if stopped else 3
+
+
+def daemon_row(index, s):
+    """ Table row of a server from the daemon's list, like str(Server) """
+    uptime = datetime.timedelta(milliseconds=int(s['uptime']))
+    uptime = re.split(',|\.', str(uptime))[0]
+    txt = [s['code'], str(s['ping']), '%.2f' % (s['speed'] / 1000. ** 2), uptime,
+           '2wk' if s['log_policy'] == '2weeks' else 'inf', str(s['score']), s['proto'], s['ip'], s['port']]
+    return '%2d:'.center(6) % index + ''.join(dta.center(spaces[ind + 1]) for ind, dta in enumerate(txt))
+
+
+def wait_daemon(client, busy, timeout=60):
+    """ Poll the daemon until busy(status) is false, Ctrl+C gives up waiting, :return: last status """
+    deadline = time.time() + timeout
+    status = client.call('status')
+    try:
+        while busy(status) and time.time() < deadline:
+            time.sleep(0.5)
+            status = client.call('status')
+    except KeyboardInterrupt:
+        print
+    return status
+
+
+def attach_daemon(client):
+    """ A daemon owns the tunnel: show its list and send it commands, no engine of our own
+        :return: exit status
+    """
+    connected_servers = []
+    try:
+        while True:
+            status = client.call('status')
+            servers = client.call('list', limit=20)
+            if status['ip'] and (not connected_servers or connected_servers[-1] != status['ip']):
+                connected_servers.append(status['ip'])
+
+            print ctext('Daemon: ', 'B'), status['state'],
+            print ' || ', ctext('Server: ', 'B'), status['country'].strip() or '-',
+            print ' || ', ctext('Servers: ', 'B'), status['servers'], '(refreshing)' if status['refreshing'] else ''
+            print ctext(''.join(labels), 'gB')
+            for index, s in enumerate(servers):
+                text = daemon_row(index, s)
+                if connected_servers and s['ip'] == connected_servers[-1] and status['state'] != 'down':
+                    text = ctext(text, 'y')
+                elif s['ip'] in connected_servers:
+                    text = ctext(text, 'r')
+                print text
+
+            try:
+                user_input = raw_input(ctext('Vpn command: ', 'gB')).strip().lower()
+            except (KeyboardInterrupt, EOFError):
+                user_input = 'q'
+
+            try:
+                if user_input in ['q', 'quit', 'exit']:
+                    print ctext('Goodbye'.center(40), 'gB'), '(the daemon keeps its tunnel)'
+                    return 0
+                elif user_input in ('r', 'refresh'):
+                    client.call('refresh')
+                    print 'Refreshing, Ctrl+C to stop waiting'
+                    wait_daemon(client, lambda st: st['refreshing'], timeout=300)
+                elif user_input in ('c', 'config'):
+                    get_input(cfg, [user_input])
+                    client.call('reload')
+                    client.call('refresh')
+                    wait_daemon(client, lambda st: st['refreshing'], timeout=300)
+                elif user_input in ('s', 'stop'):
+                    client.call('stop')
+                elif user_input in ('n', 'next'):
+                    print ctext('Connect to', 'B'), client.call('next')['ip']
+                    status = wait_daemon(client, lambda st: st['state'] not in ('up', 'down'))
+                    print ctext('Tunnel is %s' % status['state'], 'yB')
+                elif user_input.isdigit() and int(user_input) < len(servers):
+                    server = servers[int(user_input)]
+                    print time.ctime().center(40)
+                    print ('Connect to ' + server['country']).center(40)
+                    print server['ip'].center(40)
+                    client.call('connect', ip=server['ip'])
+                    status = wait_daemon(client, lambda st: st['state'] not in ('up', 'down'))
+                    print ctext('Tunnel is %s' % status['state'], 'yB')
+                else:
+                    print 'Invalid command!'
+                    print '  q(uit) to quit, the tunnel stays up\n  r(efresh) to refresh table\n' \
+                          '  c(onfig) to change setting\n  s(top) to terminate the tunnel\n  n(ext) for the next server\n' \
+                          '  number in range 0~%s to choose vpn\n' % (len(servers) - 1)
+                    time.sleep(3)
+            except ValueError as e:
+                print ctext('Daemon: %s' % e, 'rB')
+    except socket.error as e:
+        print ctext('Lost the daemon: %s' % e, 'rB')
+        return 1
 
 
 def signal_term_handler(signal, frame):
@@ -336,6 +573,10 @@ max_retry = 3
 test_interval = 0.25
 test_timeout = 1
 
+labels = ['Idx', 'Geo', 'Ping', 'Speed', 'UpTime', 'Log', 'Score', 'proto', 'Ip', 'Port']
+spaces = [5, 4, 5, 8, 12, 4, 8, 6, 16, 6]
+labels = [label.center(spaces[ind]) for ind, label in enumerate(labels)]
+
 # get config file path
 user_home = sys.argv[1]
 path = os.path.realpath(sys.argv[0])
@@ -343,17 +584,42 @@ config_file = user_home + '/.config/vpngate-with-proxy/config.ini'
 user_script_file = user_home + '/.config/vpngate-with-proxy/user_script.sh'
 cfg = Setting(config_file)
 args = sys.argv[2:]
+batch = parse_batch(args) if args and args[0].startswith('-') else None
+resolv = ResolvManager(logger=lambda msg: sys.stdout.write(msg + '\n'))
+hooks = HookRunner('user_script.sh', logger=lambda msg: sys.stdout.write(msg + '\n'))
+
+# a running daemon owns the tunnel and DNS, be its client instead of a second engine
+daemon = find_daemon()
+if daemon and batch:
+    print ctext('The daemon owns the tunnel, use "./run ctl connect <index>" instead', 'rB')
+    sys.exit(4)
+elif daemon:
+    if os.path.exists(config_file):
+        cfg.load()
+    if args and args[0] in ['r', 'restore']:
+        print 'DNS belongs to the daemon, it is restored when its tunnel goes down'
+    elif args:
+        get_input(cfg, args)
+        daemon.call('reload')
+    sys.exit(attach_daemon(daemon))
 
 # get proxy from config file
 if os.path.exists(config_file):
     cfg.load()
-    if len(args):
+    resolv.backend = cfg.dns['backend']
+    if len(args) and not batch:
         # process commandline arguments
         if args[0] in ['r', 'restore']:
             dns_manager('restore')
         else:
             get_input(cfg, args)
 
+elif batch:
+    # no question in batch mode, start from the defaults
+    if not os.path.exists(user_home+'/.config/vpngate-with-proxy'):
+        os.makedirs(user_home+'/.config/vpngate-with-proxy')
+    cfg.write()
+
 else:
     if not os.path.exists(user_home+'/.config/vpngate-with-proxy'):
         os.makedirs(user_home+'/.config/vpngate-with-proxy')
@@ -413,21 +679,23 @@ mirrors.extend(cfg.mirror['url'].split(', '))
 use_proxy, proxy, port, ip = cfg.proxy.values()
 sort_by = cfg.sort.values()[0]
 s_country, s_port, s_score = cfg.filter.values()
-dns_fix, dns = cfg.dns.values()
+dns_fix, dns = cfg.dns['fix_dns'], cfg.dns['dns']
+resolv.backend = cfg.dns['backend']
 verbose = cfg.openvpn.values()[0]
-
-required = {'openvpn': 0, 'python-requests': 0}
-
-try:
-    import requests
-except ImportError:
-    required['python-requests'] = 1
-
-if not os.path.exists('/usr/sbin/openvpn'):
-    required['openvpn'] = 1
-
-need = [p for p in required if required[p]]
+hooks.set_timeout(cfg.hooks['timeout'])
+hooks.hooks_dir = cfg.hooks['hooks_dir'] or os.path.dirname(config_file) + '/hooks.d'
+if batch:
+    s_country = batch.country.lower() if batch.country else s_country
+    s_score = batch.min_score or s_score
+    s_port = batch.port or s_port
+
+# no fork unless something is missing
+need = missing_programs(['openvpn'])
+if missing_modules(['requests']):
+    need.append('python-requests')
 if need:
+    # detect Debian based or Redhat based OS's package manager
+    pkg_mgr = package_manager(os.path.dirname(config_file))
     print ctext('\n**Lack of dependencies**', 'rB')
     env = dict(os.environ)
     env['http_proxy'] = 'http://' + proxy + ':' + port
@@ -438,16 +706,14 @@ if need:
         print
         call([pkg_mgr, '-y', 'install', package], env=env)
 
-    import requests
+import requests
 
 
 # -------- all dependencies should be available after this line ----------------------
 dns_manager()
+if batch:
+    sys.exit(connect_batch(batch))
 ranked, vpn_list = refresh_data()
-
-labels = ['Idx', 'Geo', 'Ping', 'Speed', 'UpTime', 'Log', 'Score', 'proto', 'Ip', 'Port']
-spaces = [5, 4, 5, 8, 12, 4, 8, 6, 16, 6]
-labels = [label.center(spaces[ind]) for ind, label in enumerate(labels)]
 connected_servers = []
 
 while True:
@@ -472,6 +738,7 @@ while True:
         server_sum = min(len(ranked), 20)
         user_input = raw_input(ctext('Vpn command: ', 'gB'))
         if user_input.strip().lower() in ['q', 'quit', 'exit']:
+            hooks.wait()
             print ctext('Goodbye'.center(40), 'gB')
             sys.exit()
         elif user_input.strip().lower() in ('r', 'refresh'):
@@ -483,8 +750,11 @@ while True:
             use_proxy, proxy, port, ip = cfg.proxy.values()
             sort_by = cfg.sort.values()[0]
             s_country, s_port, s_score = cfg.filter.values()
-            dns_fix, dns = cfg.dns.values()
+            dns_fix, dns = cfg.dns['fix_dns'], cfg.dns['dns']
+            resolv.backend = cfg.dns['backend']
             verbose = cfg.openvpn.values()[0]
+            hooks.set_timeout(cfg.hooks['timeout'])
+            hooks.hooks_dir = cfg.hooks['hooks_dir'] or os.path.dirname(config_file) + '/hooks.d'
 
             ranked, vpn_list = refresh_data()
         elif re.findall(r'^\d+$', user_input.strip()) and int(user_input) < server_sum:
@@ -494,8 +764,10 @@ while True:
             print vpn_list[ranked[chose]].ip.center(40)
             connected_servers.append(vpn_list[ranked[chose]].ip)
             vpn_file = vpn_list[ranked[chose]].write_file()
-            vpn_file.close()
-            vpn_manager(os.path.abspath(vpn_file.name))
+            try:
+                vpn_manager(vpn_file)
+            finally:
+                remove_runtime(vpn_file)
         else:
             print 'Invalid command!'
             print '  q(uit) to quit\n  r(efresh) to refresh table\n' \
@@ -503,6 +775,7 @@ while True:
             time.sleep(3)
 
         if SIGTERM:
+            hooks.wait()
             print ctext('Goodbye'.center(40), 'gB')
             sys.exit()
 
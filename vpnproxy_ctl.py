@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = "duc_tin"
+__copyright__ = "Copyright 2015+, duc_tin"
+__license__ = "GPLv2"
+__version__ = "1.0"
+__maintainer__ = "duc_tin"
+__email__ = "nguyenbaduc.tin@gmail.com"
+
+import sys
+import time
+import socket
+from config import ctext
+from vpnproxy_daemon import DaemonClient
+
+usage = """Usage: ./run ctl <command> [arg]
+    status          state of the tunnel
+    list [n]        the first n ranked servers
+    log [n]         the last n log lines of the daemon
+    refresh         fetch and probe servers again
+    connect <idx>   connect to server idx of the list
+    next            connect to the next server
+    reconnect       connect to the current server again
+    stop            terminate the tunnel, or all of them
+    balance <n>     keep n tunnels and spread connections across them, 0 to stop
+    isolate <n>     keep n tunnels, each in its own network namespace vpngate0..n-1
+    tunnels         state of each balanced or isolated tunnel
+    proxy           counters of the local SOCKS5/HTTP proxy
+    profile         timing spans, when profiling is on
+    reload          read config.ini again
+    shutdown        stop the tunnel and the daemon
+"""
+
+args = sys.argv[1:]
+if not args or args[0] in ['h', 'help', '-h', '--help']:
+    print usage
+    sys.exit(0)
+
+cmd, arg = args[0], args[1:]
+kwargs = {}
+if cmd == 'connect':
+    kwargs['index'] = int(arg[0]) if arg else 0
+elif cmd in ['balance', 'isolate']:
+    kwargs['count'] = int(arg[0]) if arg else 2 if cmd == 'balance' else 1
+elif cmd == 'list' and arg:
+    kwargs['limit'] = int(arg[0])
+elif cmd == 'log' and arg:
+    kwargs['lines'] = int(arg[0])
+
+try:
+    client = DaemonClient()
+    result = client.call(cmd, **kwargs)
+    client.close()
+except socket.error as e:
+    print ctext('Cannot reach the daemon: %s' % e, 'rB')
+    print 'Start it by "./run daemon"'
+    sys.exit(2)
+except ValueError as e:
+    print ctext(str(e), 'rB')
+    sys.exit(1)
+
+if cmd == 'status':
+    for key in ['state', 'since', 'server', 'chosen', 'servers', 'refreshing', 'balanced', 'message']:
+        print ctext('%-11s' % key, 'B'), result[key]
+elif cmd == 'list':
+    labels = ['Idx', 'Geo', 'Ping', 'Speed', 'Score', 'proto', 'Ip', 'Port']
+    print ctext(''.join(label.center(8) for label in labels[:-2]) + labels[-2].center(16) + labels[-1].center(6), 'gB')
+    for s in result:
+        row = [str(s['index']), s['code'], str(s['ping']), '%.2f' % (s['speed'] / 1000. ** 2), str(s['score']),
+               s['proto']]
+        print ''.join(txt.center(8) for txt in row) + s['ip'].center(16) + s['port'].center(6)
+elif cmd == 'tunnels':
+    print ctext(' Slot  State       Dev     Namespace  Geo  Ip               Since', 'gB')
+    for t in result:
+        print ' %-5d %-11s %-7s %-10s %-4s %-16s %s' % (t['slot'], t['state'], t['dev'] or '-', t['netns'] or '-',
+                                                       t['server']['code'], t['server']['ip'],
+                                                       time.strftime('%H:%M:%S', time.localtime(t['since'])))
+elif cmd == 'proxy':
+    for key in ['listen', 'active', 'connections', 'socks', 'http', 'held', 'failed', 'bytes']:
+        print ctext('%-12s' % key, 'B'), result[key]
+elif cmd == 'log':
+    print '\n'.join(reversed(result))
+elif cmd == 'profile':
+    if not result['enabled']:
+        print 'Profiling is off, set profile = yes in [monitor] or VPNGATE_PROFILE=1 before starting the daemon'
+    print ctext(' %-16s %5s %8s %8s %8s' % ('span', 'n', 'mean', 'max', 'last'), 'gB')
+    for name, s in sorted(result['summary'].items()):
+        print ' %-16s %5d %8.3f %8.3f %8.3f' % (name[:16], s['count'], s['mean'], s['max'], s['last'])
+elif isinstance(result, dict):
+    print ctext(cmd, 'gB'), result.get('country', ''), result.get('ip', '')
+else:
+    print result
@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = "duc_tin"
+__copyright__ = "Copyright 2015+, duc_tin"
+__license__ = "GPLv2"
+__version__ = "1.0"
+__maintainer__ = "duc_tin"
+__email__ = "nguyenbaduc.tin@gmail.com"
+
+import os
+import sys
+import json
+import time
+import errno
+import select
+import signal
+import socket
+from Queue import Empty
+from threading import Thread
+from collections import deque
+from ovpn_config import RUNTIME_DIR
+from log_writer import LogWriter
+from profiler import profiler
+from vpn_events import server_info
+from vpn_indicator import InfoServer, WakeQueue, share_with_user
+
+CONTROL_SOCK = RUNTIME_DIR + '/control.sock'
+CHECK_INTERVAL = 1  # seconds between ticks while tunnels run: connect timeouts, openvpn that exits silently
+
+
+class Daemon:
+    """ Own the vpn engine and serve commands on a unix socket
+
+        Protocol: one JSON object per line in both directions.
+            request : {"cmd": "connect", "index": 3}
+            response: {"ok": true, "result": ...} or {"ok": false, "error": "..."}
+
+        Commands: status, list, log, refresh, connect, next, reconnect, stop, balance, isolate, tunnels, proxy,
+                  profile, reload, shutdown
+
+        Besides the tunnel events, subscribers of status.sock get every line of
+        the log as {"type": "log", "line": ..., "count": n} and the reply of
+        'status' as {"type": "status", ...} each time it changes.
+    """
+
+    def __init__(self, vpn_connection, sock_path=CONTROL_SOCK, failover=True):
+        """
+        :type vpn_connection: vpn_core.Connection
+        """
+        self.ovpn = vpn_connection
+        self.sock_path = sock_path
+        self.failover = failover  # connect the next server when the tunnel breaks
+
+        self.chosen = -1
+        self.want_up = False  # user wants a tunnel, cleared by 'stop'
+        self.prev_status = 0
+        self.get_data = None
+        self.refreshing = False
+        self.refreshed = 0  # finished refreshes, clients wait for this to grow
+        self.running = True
+        self.logs = deque(maxlen=200)
+        self.logged = 0  # lines ever logged, clients ask for the ones after what they have seen
+        cfg = self.ovpn.cfg.log
+        self.logger = LogWriter(os.path.split(self.ovpn.path)[0] + '/logs/daemon.log',
+                                max_bytes=int(cfg['max_size']) * 1024, backups=int(cfg['backups']),
+                                compress=cfg['compress'] == 'yes')
+
+        self.sock = None
+        self.clients = {}  # socket -> unfinished input
+
+        # no polling: worker threads write to this pipe when they have news
+        self.wake_pending = False
+        self.wake_r, self.wake_w = os.pipe()
+        self.ovpn.wakeup = self.wake
+        self.last_tick = 0
+
+        # status for vpn_indicator and other subscribers, they talk to whoever owns the tunnel
+        self.q_indicator = WakeQueue(self.wake)
+        self.infoserver = InfoServer()
+        self.ovpn.events.publish = self.infoserver.send
+        self.published = None  # last status sent to subscribers
+
+        signal.signal(signal.SIGINT, self.signal_handler)
+        signal.signal(signal.SIGTERM, self.signal_handler)
+
+    def listen(self):
+        if not os.path.isdir(RUNTIME_DIR):
+            os.makedirs(RUNTIME_DIR, 0700)
+        try:
+            os.remove(self.sock_path)
+        except OSError:
+            pass
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.sock_path)
+        share_with_user(self.sock_path)
+        self.sock.listen(5)
+        self.log('Daemon: listening on ' + self.sock_path)
+
+    def signal_handler(self, signum, frame):
+        self.log('Daemon: got signal %s, exiting' % signum)
+        self.running = False
+
+    def wake(self):
+        """ Ask the main loop for a tick, safe to call from any thread or signal handler """
+        if not self.wake_pending:
+            self.wake_pending = True
+            try:
+                os.write(self.wake_w, '.')
+            except OSError:
+                pass
+
+    def log(self, msg):
+        line = time.strftime('%Y-%m-%d %H:%M:%S ') + msg
+        self.logs.appendleft(line)
+        self.logged += 1
+        self.logger.write(line)
+        self.infoserver.send({'type': 'log', 'line': line, 'count': self.logged}, keep=False)
+
+    # ------------------------- commands --------------------------
+    def refresh(self, resort_only=False):
+        if self.refreshing:
+            return False
+        self.refreshing = True
+        self.get_data = Thread(target=self.fetch, args=(resort_only,))
+        self.get_data.daemon = True
+        self.get_data.start()
+        return True
+
+    def fetch(self, resort_only):
+        try:
+            self.ovpn.refresh_data(resort_only=resort_only)
+        finally:
+            self.refreshing = False
+            self.refreshed += 1
+            self.wake()
+
+    def connect(self, index):
+        if not 0 <= index < len(self.ovpn.sorted):
+            return False
+        self.ovpn.pool.stop()  # one mode at a time, balanced or single
+        self.chosen = index
+        self.want_up = True
+        self.ovpn.vpn_connect(index)
+        return True
+
+    def balance(self, count, isolate=False):
+        """ Keep count tunnels at once, each in its own namespace if isolate. 0 goes back to no tunnel """
+        ovpn = self.ovpn
+        self.want_up = False
+        if ovpn.vpn_process and ovpn.vpn_process.poll() is None:
+            ovpn.vpn_cleanup()
+        if count > 0:
+            ovpn.pool.start(count, isolate)
+        else:
+            ovpn.pool.stop()
+
+    def server_info(self, index):
+        return dict(server_info(self.ovpn.vpndict[self.ovpn.sorted[index]]), index=index)
+
+    def status(self):
+        server = self.ovpn.vpn_server
+        last = self.ovpn.events.last_state
+        return {'state': last['state'] if last else 'down',
+                'since': last['time'] if last else None,
+                'server': repr(server) if server else None,
+                'ip': server.ip if server else None,
+                'country': self.ovpn.messages.get('country')[0],
+                'chosen': self.chosen,
+                'servers': len(self.ovpn.sorted),
+                'refreshing': self.refreshing,
+                'refreshed': self.refreshed,
+                'balanced': len(self.ovpn.pool.routed),
+                'message': self.ovpn.messages.get('status')}
+
+    def handle(self, request):
+        cmd = request.get('cmd')
+        if cmd == 'status':
+            return self.status()
+        elif cmd == 'list':
+            limit = int(request.get('limit', len(self.ovpn.sorted)))
+            return [self.server_info(i) for i in range(min(limit, len(self.ovpn.sorted)))]
+        elif cmd == 'log':
+            if 'since' in request:
+                # what a client has not seen yet, oldest first
+                lines = list(self.logs)[:max(self.logged - int(request['since']), 0)]
+                return {'count': self.logged, 'lines': lines[::-1]}
+            return list(self.logs)[:int(request.get('lines', 20))]
+        elif cmd == 'refresh':
+            if not self.refresh(request.get('resort_only', False)):
+                raise ValueError('last refresh is not finished')
+            return 'refreshing'
+        elif cmd == 'connect':
+            index = int(request.get('index', 0))
+            if request.get('ip'):
+                # clients may show an older list, the address still points at the right server
+                ips = [self.ovpn.vpndict[key].ip for key in self.ovpn.sorted]
+                index = ips.index(request['ip']) if request['ip'] in ips else -1
+            if not self.connect(index):
+                raise ValueError('no such server')
+            return self.server_info(self.chosen)
+        elif cmd == 'next':
+            if not self.connect(self.chosen + 1):
+                raise ValueError('end of server list, refresh first')
+            return self.server_info(self.chosen)
+        elif cmd == 'reconnect':
+            if not self.connect(max(self.chosen, 0)):
+                raise ValueError('no such server')
+            return self.server_info(self.chosen)
+        elif cmd == 'stop':
+            self.want_up = False
+            self.ovpn.kill = True
+            self.ovpn.pool.stop()
+            return 'stopping'
+        elif cmd == 'balance':
+            self.balance(int(request.get('count', 2)))
+            return 'balancing over %d tunnels' % self.ovpn.pool.size
+        elif cmd == 'isolate':
+            self.balance(int(request.get('count', 1)), isolate=True)
+            return 'isolating %d tunnels in their own namespaces' % self.ovpn.pool.size
+        elif cmd == 'tunnels':
+            return self.ovpn.pool.status()
+        elif cmd == 'proxy':
+            if not self.ovpn.local_proxy:
+                raise ValueError('local proxy is off, set listen in [local_proxy]')
+            return self.ovpn.local_proxy.status()
+        elif cmd == 'profile':
+            return {'enabled': profiler.enabled, 'summary': profiler.summary()}
+        elif cmd == 'reload':
+            self.ovpn.cfg.load()  # a client changed config.ini
+            self.ovpn.reload()
+            return 'reloaded'
+        elif cmd == 'shutdown':
+            self.running = False
+            return 'shutting down'
+        else:
+            raise ValueError('unknown command %r' % cmd)
+
+    # ------------------------- socket io -------------------------
+    def accept(self):
+        client, _ = self.sock.accept()
+        self.clients[client] = ''
+
+    def serve_client(self, client):
+        try:
+            data = client.recv(4096)
+        except socket.error:
+            data = ''
+        if not data:
+            self.drop(client)
+            return
+
+        self.clients[client] += data
+        while '\n' in self.clients[client]:
+            line, self.clients[client] = self.clients[client].split('\n', 1)
+            if not line.strip():
+                continue
+            try:
+                reply = {'ok': True, 'result': self.handle(json.loads(line))}
+            except Exception as e:
+                reply = {'ok': False, 'error': str(e)}
+            try:
+                client.sendall(json.dumps(reply) + '\n')
+            except socket.error:
+                self.drop(client)
+                return
+
+    def drop(self, client):
+        self.clients.pop(client, None)
+        client.close()
+
+    # ------------------------- main loop -------------------------
+    def tick(self):
+        ovpn = self.ovpn
+        self.last_tick = time.time()
+        for i in range(20):  # no screen to redraw, so take several openvpn lines per tick
+            if not ovpn.vpn_process:
+                break
+            ovpn.vpn_checker()
+            if ovpn.vpn_queue.empty():
+                break
+
+        ovpn.pool.check()
+
+        for msg in ovpn.messages.drain('debug'):
+            self.log(msg)
+
+        # tunnel broke by itself, move on to the next server
+        if self.prev_status and not ovpn.is_connected and self.want_up and self.failover:
+            self.log('Daemon: tunnel lost, failover to the next server')
+            if not self.connect(self.chosen + 1):
+                self.want_up = False
+                self.refresh()
+
+        self.prev_status = ovpn.is_connected
+
+        try:
+            cmd = self.q_indicator.get_nowait()
+            if cmd in ('next', 'stop', 'reconnect'):
+                try:
+                    self.handle({'cmd': cmd})
+                except ValueError as e:
+                    self.log('Daemon: indicator %s: %s' % (cmd, e))
+        except Empty:
+            pass
+
+        status = self.status()
+        if status != self.published:
+            self.published = status
+            self.infoserver.send(dict(status, type='status', time=round(time.time(), 3)), keep=False)
+
+    def timeout(self):
+        """ Seconds until the next tick is due, None when only a client or a wake up can bring news """
+        ovpn = self.ovpn
+        if ovpn.vpn_queue and not ovpn.vpn_queue.empty() or not self.q_indicator.empty():
+            return 0  # more than one tick takes, openvpn lines or indicator commands
+        if ovpn.pool.tunnels or ovpn.vpn_process and ovpn.vpn_process.poll() is None:
+            return max(self.last_tick + CHECK_INTERVAL - time.time(), 0)
+        return None
+
+    def run(self):
+        self.listen()
+        self.refresh()
+        self.ovpn.start_local_proxy()
+        cfg = self.ovpn.cfg.balance
+        if int(cfg['tunnels']) > 1 or cfg['namespaces'] == 'yes':
+            # slots fill once the list is ready
+            self.balance(int(cfg['tunnels']), isolate=cfg['namespaces'] == 'yes')
+
+        t = Thread(target=self.infoserver.check_io, args=(self.q_indicator,))
+        t.daemon = True
+        t.start()
+
+        while self.running:
+            try:
+                readable, _, _ = select.select([self.sock, self.wake_r] + self.clients.keys(), [], [],
+                                               self.timeout())
+            except select.error as e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+
+            for s in readable:
+                if s is self.wake_r:
+                    self.wake_pending = False  # before reading, a wake during this tick is not lost
+                    os.read(self.wake_r, 4096)
+                elif s is self.sock:
+                    self.accept()
+                else:
+                    self.serve_client(s)
+            self.tick()
+
+        # dead gracefully
+        if self.ovpn.vpn_process and self.ovpn.vpn_process.poll() is None:
+            self.ovpn.vpn_cleanup()
+        self.ovpn.pool.stop()
+        if self.ovpn.local_proxy:
+            self.ovpn.local_proxy.stop()
+        self.ovpn.resolv.wait()
+        self.ovpn.hooks.wait()
+
+        for client in self.clients.keys():
+            self.drop(client)
+        self.sock.close()
+        os.remove(self.sock_path)
+        self.infoserver.close()
+        self.logger.close()
+        if profiler.enabled:
+            profiler.dump(os.path.split(self.logger.path)[0] + '/profile.json')
+
+
+class DaemonClient:
+    """ Thin client of Daemon, send one command and get its result """
+
+    def __init__(self, sock_path=CONTROL_SOCK, timeout=10):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(sock_path)
+        self.buffer = ''
+
+    def call(self, cmd, **kwargs):
+        kwargs['cmd'] = cmd
+        self.sock.sendall(json.dumps(kwargs) + '\n')
+        while '\n' not in self.buffer:
+            data = self.sock.recv(65536)
+            if not data:
+                raise socket.error('daemon closed the connection')
+            self.buffer += data
+        line, self.buffer = self.buffer.split('\n', 1)
+        reply = json.loads(line)
+        if not reply['ok']:
+            raise ValueError(reply['error'])
+        return reply['result']
+
+    def close(self):
+        self.sock.close()
+
+
+def find_daemon(sock_path=CONTROL_SOCK):
+    """ :return: a DaemonClient when a daemon answers on sock_path, else None """
+    if not os.path.exists(sock_path):
+        return None
+    try:
+        client = DaemonClient(sock_path, timeout=2)
+        client.call('status')
+    except (socket.error, ValueError):
+        return None
+    client.sock.settimeout(10)
+    return client
+
+
+if __name__ == '__main__':
+    from config import ctext
+    from vpn_core import Connection
+
+    if os.geteuid() != 0:
+        raise RuntimeError('Permission deny! You need to "sudo" or use "./run daemon" instead')
+
+    if not os.path.exists(sys.argv[1] + '/.config/vpngate-with-proxy/config.ini'):
+        print ctext('No config file, run "./run config" once before starting the daemon', 'rB')
+        sys.exit(1)
+
+    try:
+        __import__('requests')
+    except ImportError:
+        print ctext('Lack of python-requests, run "./run" once to install dependencies', 'rB')
+        sys.exit(1)
+
+    daemon = Daemon(Connection())
+    daemon.run()